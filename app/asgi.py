@@ -0,0 +1,195 @@
+"""ASGI version of the app in main.py, for serving many slow clients from one process without a thread per request.
+
+The routes and responses are the same as main.py's. The differences are that vehicle snapshots are fetched from the
+API on a non-blocking client (see datamanager._query_api_async), and that rendering, which is CPU bound, runs in
+worker threads so the event loop is only ever waiting on the network. Run it with any ASGI server, e.g.
+
+    uvicorn asgi:app --port 8080
+
+The sync Flask app in main.py is still the default, see app.yaml.
+"""
+import asyncio
+import time
+
+from markupsafe import escape
+from quart import Quart, Response, abort, g, redirect, render_template, request, url_for
+
+from datamanager import (VEHICLE_POSITION_SECONDS, VEHICLE_TTL_SECONDS, close_async_client, get_vehicle_snapshot_async,
+                         static_data, tune_gc)
+from maptypes import get_routes, map_types, parse_view_args
+from mapping import (INITIAL_ZOOM, generate_map, generate_positions_json, generate_shapes_json, generate_vehicles_json,
+                     generate_view_json, get_vehicles_etag, warm_up)
+from mbta import ICON_URL
+from metrics import CONTENT_TYPE, exposition, profiler, request_seconds
+from simplify import SHAPE_ZOOMS
+
+app = Quart(__name__)
+
+
+@app.before_serving
+async def load_static_data():
+    # once per process, before the static data's loaded so it isn't frozen, see datamanager.tune_gc
+    tune_gc()
+    # loading the static data reads files from disk, so do it once up front rather than in the first request
+    await asyncio.to_thread(static_data.get)
+
+
+@app.after_serving
+async def close_client():
+    await close_async_client()
+
+
+@app.route('/')
+async def index():
+    return await render_template('index.html', base_url=request.root_url)
+
+
+@app.route('/map/<map_type>')
+async def map_page(map_type: str):
+    map_type = escape(map_type).lower()
+    if map_type not in map_types:
+        # invalid type, redirect home
+        return redirect(url_for('index'))
+
+    routes = get_routes(map_type)
+    snapshot = await get_vehicle_snapshot_async()
+
+    generation = await asyncio.to_thread(get_vehicles_etag, routes, snapshot)
+    etag = f'{map_type}.{static_data.get().version}.{generation}'
+    if request.if_none_match.contains(etag):
+        return _not_modified(etag)
+
+    iframe = await asyncio.to_thread(generate_map, routes, snapshot)
+    response = Response(await render_template('map.html', iframe=iframe, base_url=request.root_url,
+                                              map_type=map_type, generation=generation,
+                                              refresh_ms=int(VEHICLE_TTL_SECONDS * 1000),
+                                              positions_ms=int(VEHICLE_POSITION_SECONDS * 1000), icon_url=ICON_URL,
+                                              shape_zooms=list(SHAPE_ZOOMS), initial_zoom=INITIAL_ZOOM))
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/api/vehicles/<map_type>')
+async def vehicles_api(map_type: str):
+    """Same as main.vehicles_api"""
+    map_type = escape(map_type).lower()
+    if map_type not in map_types:
+        abort(404)
+
+    routes = get_routes(map_type)
+    since = request.args.get('since')
+    snapshot = await get_vehicle_snapshot_async()
+
+    etag = await asyncio.to_thread(get_vehicles_etag, routes, snapshot)
+    if since == etag or request.if_none_match.contains(etag):
+        return _not_modified(etag)
+
+    generation, feed = await asyncio.to_thread(generate_vehicles_json, routes, since, snapshot)
+    response = Response(feed, mimetype='application/json')
+    response.set_etag(generation)
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/api/positions/<map_type>')
+async def positions_api(map_type: str):
+    """Same as main.positions_api"""
+    map_type = escape(map_type).lower()
+    if map_type not in map_types or VEHICLE_POSITION_SECONDS <= 0:
+        abort(404)
+
+    snapshot = await get_vehicle_snapshot_async()
+    feed = await asyncio.to_thread(generate_positions_json, get_routes(map_type), None, snapshot)
+    response = Response(feed, mimetype='application/json')
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/api/shapes/<map_type>')
+async def shapes_api(map_type: str):
+    """Same as main.shapes_api"""
+    map_type = escape(map_type).lower()
+    if map_type not in map_types:
+        abort(404)
+    try:
+        zoom = float(request.args.get('zoom', INITIAL_ZOOM))
+    except ValueError:
+        abort(400)
+
+    etag, feed = await asyncio.to_thread(generate_shapes_json, get_routes(map_type), zoom)
+    if request.if_none_match.contains(etag):
+        return _not_modified(etag)
+
+    response = Response(feed, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/api/view/<map_type>')
+async def view_api(map_type: str):
+    """Same as main.view_api"""
+    map_type = escape(map_type).lower()
+    if map_type not in map_types:
+        abort(404)
+    try:
+        bbox, zoom = parse_view_args(request.args)
+    except ValueError:
+        abort(400)
+
+    snapshot = await get_vehicle_snapshot_async()
+    feed = await asyncio.to_thread(generate_view_json, get_routes(map_type), bbox, zoom, snapshot)
+    response = Response(feed, mimetype='application/json')
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/_ah/warmup')
+async def warmup():
+    """Same as main.warmup"""
+    return await asyncio.to_thread(warm_up, [get_routes(m) for m in sorted(map_types)])
+
+
+@app.before_request
+async def start_request_timer():
+    g.started = time.perf_counter()
+    # the loop's thread is what's sampled, see metrics.py
+    g.profiled = profiler.sample()
+    if g.profiled:
+        profiler.start()
+
+
+@app.after_request
+async def record_request_time(response: Response) -> Response:
+    if 'started' in g:
+        request_seconds.observe(time.perf_counter() - g.started, request.endpoint or 'none', str(response.status_code))
+    return response
+
+
+@app.teardown_request
+async def stop_profiler(_err=None):
+    if g.get('profiled'):
+        profiler.stop()
+        g.profiled = False
+
+
+@app.route('/metrics')
+async def metrics_page():
+    """Same as main.metrics_page"""
+    return Response(exposition(), content_type=CONTENT_TYPE)
+
+
+@app.route('/metrics/profile')
+async def profile_page():
+    """Same as main.profile_page"""
+    if not profiler.enabled:
+        abort(404)
+    return Response(profiler.collapsed(), mimetype='text/plain')
+
+
+def _not_modified(etag: str) -> Response:
+    response = Response('', status=304)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
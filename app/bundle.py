@@ -0,0 +1,204 @@
+"""Reads and writes the static data bundle the app starts from, see tools/build_static.py for building one.
+
+A bundle is a directory of .npy files, one per column, with a manifest.json describing it. Columns are plain NumPy
+arrays (strings as UTF-8, ragged lists as values plus offsets) so they load without pickle and without
+depending on the pandas version, and can be memory-mapped. Bundles are kept side by side under a root directory, one
+per version, with a CURRENT file naming the one to load:
+
+    data/static/CURRENT                       the version to load
+    data/static/<version>/manifest.json
+    data/static/<version>/<network>/shapes/   a ShapeStore, see shapestore.py
+    data/static/<version>/<network>/*.npy     stops and lookup tables
+
+The networks are 'rail', which is everything in mbta.all_routes (including the Silver Line), and optionally 'bus'
+for the rest of the bus routes, see staticdata.BusData.
+"""
+from __future__ import annotations
+
+import datetime
+import hashlib
+import json
+import os
+import shutil
+
+from lazy import lazy_import
+from mbta import STOP_LABEL
+from shapestore import ShapeStore
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# Bumped whenever the layout changes in a way older code can't read
+BUNDLE_FORMAT = 1
+
+
+def current_version(root: str) -> str:
+    with open(os.path.join(root, 'CURRENT'), 'r') as inf:
+        return inf.read().strip()
+
+
+def write_bundle(root: str, networks: dict, validators: dict, source: str, version: str = None) -> str:
+    """Writes a bundle under root and makes it the current one
+
+    :param networks: dict of network name to a dict with the same keys as staticdata.BusData's arguments (routes is
+        optional)
+    :param validators: HTTP validators of the upstream resources, see StaticData.validators
+    :param source: Where the data came from, for the manifest
+    :param version: Name of the bundle, defaults to when it was built
+    :return: Path of the bundle's directory
+    """
+    built = datetime.datetime.now(datetime.timezone.utc)
+    version = version or built.strftime('%Y%m%dT%H%M%SZ')
+    path = os.path.join(root, version)
+
+    manifest = {'format': BUNDLE_FORMAT, 'version': version, 'built': built.isoformat(timespec='seconds'),
+                'source': source, 'validators': validators, 'networks': {}}
+    for name, parts in networks.items():
+        directory = os.path.join(path, name)
+        parts['shapes'].save(os.path.join(directory, 'shapes'))
+        _save_stops(directory, parts['stops'])
+        _save_ragged(directory, 'route_to_stops', parts['route_to_stops'])
+        _save_mapping(directory, 'shape_to_route', parts['shape_to_route'])
+        _save_mapping(directory, 'stop_names', parts['stop_names'])
+        manifest['networks'][name] = {'routes': list(parts.get('routes', [])), 'shapes': len(parts['shapes']),
+                                      'stops': len(parts['stops'])}
+
+    manifest['files'] = {}
+    for directory, _, files in sorted(os.walk(path)):
+        for f in sorted(files):
+            name = os.path.relpath(os.path.join(directory, f), path)
+            with open(os.path.join(directory, f), 'rb') as inf:
+                manifest['files'][name] = hashlib.sha256(inf.read()).hexdigest()
+    with open(os.path.join(path, 'manifest.json'), 'w') as outf:
+        json.dump(manifest, outf, indent=2)
+
+    # swap CURRENT in whole, so a running app never reads it half written
+    tmp = os.path.join(root, 'CURRENT.tmp')
+    with open(tmp, 'w') as outf:
+        outf.write(version + '\n')
+    os.replace(tmp, os.path.join(root, 'CURRENT'))
+    return path
+
+
+def read_bundle(root: str, version: str = None) -> (dict, dict):
+    """Loads a bundle written by write_bundle, the current one unless a version is given. Shapes are memory-mapped.
+
+    :return: tuple of the manifest and a dict of network name to a dict of its parts, like write_bundle takes
+    """
+    path = os.path.join(root, version or current_version(root))
+    with open(os.path.join(path, 'manifest.json'), 'r') as inf:
+        manifest = json.load(inf)
+    if manifest['format'] != BUNDLE_FORMAT:
+        raise ValueError(f"Bundle {manifest['version']} is format {manifest['format']}, expected {BUNDLE_FORMAT}")
+
+    networks = {}
+    for name, meta in manifest['networks'].items():
+        directory = os.path.join(path, name)
+        networks[name] = {
+            'routes': meta['routes'],
+            'shapes': ShapeStore.load(os.path.join(directory, 'shapes')),
+            'stops': _load_stops(directory),
+            'route_to_stops': _load_ragged(directory, 'route_to_stops'),
+            'shape_to_route': _load_mapping(directory, 'shape_to_route'),
+            'stop_names': _load_mapping(directory, 'stop_names'),
+        }
+    return manifest, networks
+
+
+def verify_bundle(root: str, version: str = None) -> list:
+    """Checks a bundle's files against the hashes in its manifest
+
+    :return: Names of the files that are missing or don't match, empty if the bundle is intact
+    """
+    path = os.path.join(root, version or current_version(root))
+    with open(os.path.join(path, 'manifest.json'), 'r') as inf:
+        manifest = json.load(inf)
+
+    bad = []
+    for name, digest in manifest['files'].items():
+        try:
+            with open(os.path.join(path, name), 'rb') as inf:
+                if hashlib.sha256(inf.read()).hexdigest() != digest:
+                    bad.append(name)
+        except FileNotFoundError:
+            bad.append(name)
+    return bad
+
+
+def prune(root: str, keep: int) -> list:
+    """Deletes all but the newest keep bundles under root, never the current one
+
+    :return: Versions deleted
+    """
+    current = current_version(root)
+    versions = sorted((v for v in os.listdir(root) if os.path.isfile(os.path.join(root, v, 'manifest.json'))),
+                      reverse=True)
+    old = [v for v in versions[keep:] if v != current]
+    for v in old:
+        shutil.rmtree(os.path.join(root, v))
+    return old
+
+
+def _save(directory: str, name: str, a: np.ndarray):
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, f'{name}.npy'), a)
+
+
+def _load(directory: str, name: str) -> np.ndarray:
+    return np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+
+
+def _save_strings(directory: str, name: str, values):
+    # As UTF-8 with each string ended by a NUL. Fixed width unicode arrays pad every string out to the longest one at
+    # 4 bytes a character, which makes the stop names alone several MB, and object arrays can only be pickled.
+    _save(directory, name, np.frombuffer(''.join(f'{v}\0' for v in values).encode(), dtype=np.uint8))
+
+
+def _load_strings(directory: str, name: str) -> list:
+    return _load(directory, name).tobytes().decode().split('\0')[:-1]
+
+
+def _save_ragged(directory: str, name: str, d: dict):
+    # dict of key to list, as the keys, every list end to end, and where each key's list starts
+    offsets = np.zeros(len(d) + 1, dtype=np.int64)
+    np.cumsum([len(v) for v in d.values()], out=offsets[1:])
+    _save_strings(directory, f'{name}.keys', d)
+    _save_strings(directory, f'{name}.values', (v for values in d.values() for v in values))
+    _save(directory, f'{name}.offsets', offsets)
+
+
+def _load_ragged(directory: str, name: str) -> dict:
+    keys = _load_strings(directory, f'{name}.keys')
+    values = _load_strings(directory, f'{name}.values')
+    offsets = _load(directory, f'{name}.offsets').tolist()
+    return {k: values[a:b] for k, a, b in zip(keys, offsets[:-1], offsets[1:])}
+
+
+def _save_mapping(directory: str, name: str, d: dict):
+    _save_strings(directory, f'{name}.keys', d.keys())
+    _save_strings(directory, f'{name}.values', d.values())
+
+
+def _load_mapping(directory: str, name: str) -> dict:
+    return dict(zip(_load_strings(directory, f'{name}.keys'), _load_strings(directory, f'{name}.values')))
+
+
+def _save_stops(directory: str, df: pd.DataFrame):
+    # label is always made from the name, so it isn't stored
+    _save_strings(directory, 'stops.id', df['id'])
+    _save_strings(directory, 'stops.name', df['name'])
+    _save(directory, 'stops.location', np.array(df['location'].tolist(), dtype=np.float64).reshape(-1, 2))
+    _save(directory, 'stops.color', np.array(df['color'].tolist(), dtype=np.uint8).reshape(-1, 3))
+    _save_ragged(directory, 'stops.routes_served', dict(enumerate(df['routes_served'])))
+
+
+def _load_stops(directory: str) -> pd.DataFrame:
+    names = _load_strings(directory, 'stops.name')
+    return pd.DataFrame({
+        'name': names,
+        'label': [STOP_LABEL.format(n) for n in names],
+        'id': _load_strings(directory, 'stops.id'),
+        'location': _load(directory, 'stops.location').tolist(),
+        'routes_served': list(_load_ragged(directory, 'stops.routes_served').values()),
+        'color': [tuple(c) for c in _load(directory, 'stops.color').tolist()],
+    }, columns=['name', 'label', 'id', 'location', 'routes_served', 'color'])
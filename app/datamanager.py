@@ -1,12 +1,35 @@
+from __future__ import annotations
+
 import os
-import json
-import requests
-import polyline
-import pandas as pd
+import asyncio
+import gc
+import logging
+import random
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 from dotenv import load_dotenv
 
+from lazy import lazy_import
 from mbta import *
+import bundle
+import ingest
+from shapestore import FULL, ShapeStore
+from staticdata import BusData, StaticData, StaticDataCache
+from livedata import SnapshotCache, VehicleSnapshot
+import recording
+from metrics import conditional_requests, observe_upstream, timed, upstream_path
+from streaming import LiveStore, StreamIngester
+
+requests = lazy_import('requests')
+httpx = lazy_import('httpx')
+polyline = lazy_import('polyline')
+pd = lazy_import('pandas')
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 USER_AGENT = os.getenv('USER_AGENT')
@@ -17,10 +40,129 @@ HEADERS = {
     'x-api-key': MBTA_API_KEY
 }
 
-BASE_URL = 'https://api-v3.mbta.com/'
+BASE_URL = os.getenv('MBTA_BASE_URL', 'https://api-v3.mbta.com/')
 
 all_routes = commuter_routes + silver_line_routes + rapid_routes
 
+# Where the static data bundles are, see bundle.py and tools/build_static.py
+STATIC_DATA_DIR = os.getenv('MBTA_STATIC_DATA_DIR', './data/static')
+STATIC_REVALIDATE_SECONDS = float(os.getenv('STATIC_REVALIDATE_SECONDS', 3600))
+# How long a vehicle snapshot is served before it's refreshed, and how long a stale one may be served while refreshing
+VEHICLE_TTL_SECONDS = float(os.getenv('VEHICLE_TTL_SECONDS', 20))
+VEHICLE_MAX_STALE_SECONDS = float(os.getenv('VEHICLE_MAX_STALE_SECONDS', 60))
+# How often the map pages move vehicles along their routes between snapshots, see deadreckoning.py. 0 turns it off,
+# in which case VEHICLE_TTL_SECONDS should be brought down to keep vehicles moving.
+VEHICLE_POSITION_SECONDS = float(os.getenv('VEHICLE_POSITION_SECONDS', 1))
+# 'poll' to query /vehicles and /predictions when a snapshot expires, 'stream' to keep them current from the
+# streaming API in the background
+LIVE_SOURCE = os.getenv('MBTA_LIVE_SOURCE', 'poll')
+# Longest to wait for the streams to connect on startup. Vehicles are polled for whenever they aren't connected.
+STREAM_CONNECT_SECONDS = float(os.getenv('MBTA_STREAM_CONNECT_SECONDS', 10))
+# Record every polled vehicles snapshot to this directory, keeping the latest RECORD_MAX_BYTES of them, or serve the
+# vehicles and predictions from a recording in REPLAY_DIR instead of the API at REPLAY_SPEED times real time (0 to
+# step a snapshot per refresh). See recording.py. Only polling is recorded, and replaying always polls.
+RECORD_DIR = os.getenv('MBTA_RECORD_DIR')
+RECORD_MAX_BYTES = int(os.getenv('MBTA_RECORD_MAX_BYTES', 256 * 2 ** 20))
+REPLAY_DIR = os.getenv('MBTA_REPLAY_DIR')
+REPLAY_SPEED = float(os.getenv('MBTA_REPLAY_SPEED', 1))
+
+# Seconds to wait for a connection to the API and then for each read, and how many times to retry failed requests
+API_CONNECT_TIMEOUT = float(os.getenv('MBTA_CONNECT_TIMEOUT', 3.05))
+API_READ_TIMEOUT = float(os.getenv('MBTA_READ_TIMEOUT', 15))
+API_RETRIES = int(os.getenv('MBTA_RETRIES', 3))
+# Warn when there are fewer requests than this left in the current rate limit window
+RATE_LIMIT_WARNING = 50
+
+# Lists of IDs in filters are split up to keep URLs under this many characters, which is well under the limits of
+# the API and anything in between
+MAX_URL_LENGTH = 2000
+# Resources per page when paging through big collections, see _iter_pages
+PAGE_LIMIT = int(os.getenv('MBTA_PAGE_LIMIT', 500))
+# Allocations between the garbage collector's youngest collections, see tune_gc
+GC_THRESHOLD = int(os.getenv('GC_THRESHOLD', 50_000))
+
+
+def tune_gc():
+    """Sets the garbage collector up for the app. Called once per process by whatever starts it serving (main's
+    __main__, gunicorn.conf.py or asgi.py's before_serving), after the app's been imported and before anything's
+    loaded.
+
+    A big /predictions response decodes to hundreds of thousands of dicts and lists, none of which can be garbage
+    yet, and with the default threshold of 700 the collector goes through them over and over while they're made,
+    taking longer than the decoding itself. Raising the threshold to GC_THRESHOLD cuts that to a few collections.
+    The modules imported by then are frozen so that full collections skip them too. Nothing loaded later is, since
+    frozen objects are never collected and the static data gets swapped out when it's revalidated.
+    """
+    gc.set_threshold(GC_THRESHOLD, *gc.get_threshold()[1:])
+    gc.collect()
+    gc.freeze()
+
+
+def _build_session() -> requests.Session:
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    # Retries 429s and 5xxs (and connection errors) with exponential backoff plus jitter, honoring Retry-After
+    retry = Retry(
+        total=API_RETRIES,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({'GET'}),
+        backoff_factor=0.5,
+        backoff_jitter=0.5,
+        backoff_max=10,
+        respect_retry_after_header=True,
+        # hand back the last response once retries run out so it's raised like any other error status
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retry)
+
+    s = requests.Session()
+    s.mount('https://', adapter)
+    s.mount('http://', adapter)
+    return s
+
+
+# Shared between threads so connections to the API are kept alive and reused rather than opened for every call.
+# Built on first use, which saves importing requests when starting up.
+_session = None
+_session_lock = threading.Lock()
+
+
+def _get_session() -> requests.Session:
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+# For running independent background fetches (loading and revalidating static data) concurrently, sized to match the
+# session's connection pool
+executor = ThreadPoolExecutor(max_workers=int(os.getenv('MBTA_FETCH_WORKERS', 8)), thread_name_prefix='fetch')
+
+
+# One client per event loop for the ASGI app (see asgi.py), since httpx clients can't be shared between loops
+_async_clients = weakref.WeakKeyDictionary()
+_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def _get_async_client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(API_READ_TIMEOUT, connect=API_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+        )
+        _async_clients[loop] = client
+    return client
+
+
+async def close_async_client():
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
 
 def _list_for_url(values: list) -> str:
     s = ''
@@ -29,6 +171,134 @@ def _list_for_url(values: list) -> str:
     return s[1:]
 
 
+def _chunk_for_url(template: str, values) -> list:
+    """Splits values into comma separated lists short enough that template (a route with {} where the list goes)
+    stays under MAX_URL_LENGTH once one is filled in and paging parameters are added
+
+    :return: list of routes, one per chunk
+    """
+    room = MAX_URL_LENGTH - len(BASE_URL) - len(template) - len('&page[limit]=0000&page[offset]=000000')
+    chunks, current, length = [], [], 0
+    for v in values:
+        if len(current) > 0 and length + len(v) + 1 > room:
+            chunks.append(current)
+            current, length = [], 0
+        current.append(v)
+        length += len(v) + 1
+    if len(current) > 0:
+        chunks.append(current)
+    return [template.format(_list_for_url(c)) for c in chunks]
+
+
+def _page(route: str, offset: int) -> str:
+    return f"{route}{'&' if '?' in route else '?'}page[limit]={PAGE_LIMIT}&page[offset]={offset}"
+
+
+def _is_last_page(j: dict) -> bool:
+    # The API only sends links when a response is paginated, with a next link on every page but the last
+    return len(j.get('data', ())) < PAGE_LIMIT or ('links' in j and 'next' not in j['links'])
+
+
+def _iter_pages(route: str):
+    """Yields the decoded pages of a paginated query one at a time, so they can be read as they arrive rather than
+    holding one huge response in memory. Offsets can shift between pages when the data changes, so readers should
+    expect the odd resource to show up twice."""
+    offset = 0
+    while True:
+        j, _ = _query_api(_page(route, offset))
+        yield j
+        if _is_last_page(j):
+            return
+        offset += PAGE_LIMIT
+
+
+def _iter_chunked(template: str, values):
+    """Yields the pages of template filtered by every value in values, see _chunk_for_url and _iter_pages"""
+    for route in _chunk_for_url(template, values):
+        yield from _iter_pages(route)
+
+
+async def _fetch_pages_async(route: str) -> list:
+    pages, offset = [], 0
+    while True:
+        j, _ = await _query_api_async(_page(route, offset))
+        pages.append(j)
+        if _is_last_page(j):
+            return pages
+        offset += PAGE_LIMIT
+
+
+async def _fetch_chunked_async(template: str, values) -> list:
+    # chunks are independent, so fetch them all at once
+    results = await asyncio.gather(*(_fetch_pages_async(r) for r in _chunk_for_url(template, values)))
+    return [j for pages in results for j in pages]
+
+
+def _request(route: str, headers=HEADERS) -> requests.Response:
+    start = time.perf_counter()
+    try:
+        r = _get_session().get(f"{BASE_URL}{route}", headers=headers, timeout=(API_CONNECT_TIMEOUT, API_READ_TIMEOUT))
+    except requests.exceptions.RequestException:
+        observe_upstream(route, 'error', time.perf_counter() - start)
+        raise
+    observe_upstream(route, r.status_code, time.perf_counter() - start, len(r.content))
+
+    _log_rate_limit(r)
+    r.raise_for_status()
+    return r
+
+
+def _retry_delay(attempt: int, r: httpx.Response = None) -> float:
+    # Same schedule as the sync session's Retry: exponential backoff plus jitter, or Retry-After if the API sent one
+    if r is not None and r.headers.get('Retry-After', '').isdigit():
+        return float(r.headers['Retry-After'])
+    return min(0.5 * 2 ** attempt + random.uniform(0, 0.5), 10)
+
+
+async def _request_async(route: str, headers=HEADERS) -> httpx.Response:
+    client = _get_async_client()
+    # requests skips headers set to None (e.g. no API key configured) but httpx doesn't
+    headers = {k: v for k, v in headers.items() if v is not None}
+    start = time.perf_counter()
+    for attempt in range(API_RETRIES + 1):
+        last = attempt == API_RETRIES
+        try:
+            r = await client.get(f"{BASE_URL}{route}", headers=headers)
+        except httpx.TransportError:
+            if last:
+                observe_upstream(route, 'error', time.perf_counter() - start)
+                raise
+            await asyncio.sleep(_retry_delay(attempt))
+            continue
+
+        _log_rate_limit(r)
+        if r.status_code in _RETRY_STATUSES and not last:
+            await asyncio.sleep(_retry_delay(attempt, r))
+            continue
+        observe_upstream(route, r.status_code, time.perf_counter() - start, len(r.content))
+        r.raise_for_status()
+        return r
+
+
+def _log_rate_limit(r: requests.Response):
+    remaining = r.headers.get('x-ratelimit-remaining')
+    if remaining is None:
+        return
+    logger.debug('%s requests left in rate limit window', remaining)
+    if int(remaining) < RATE_LIMIT_WARNING:
+        logger.warning('Only %s requests left in rate limit window, resets at %s', remaining,
+                       r.headers.get('x-ratelimit-reset'))
+
+
+def _decode(r: requests.Response) -> dict:
+    # Necessary to play nicely with 304, etc.
+    if len(r.content) > 0:
+        return loads(r.content)
+    else:
+        return {}
+
+
+@timed('query_api')
 def _query_api(route: str, headers=HEADERS) -> (dict, int):
     """Returns a (dict, int) tuple with the decoded response JSON and
         the response status code.
@@ -42,21 +312,63 @@ def _query_api(route: str, headers=HEADERS) -> (dict, int):
         :rtype (dict, int) tuple
 
         """
-    try:
-        r = requests.get(f"{BASE_URL}{route}", headers=headers)
-        r.raise_for_status()
-    except requests.exceptions.HTTPError as err:
-        raise err
+    if replay is not None and recording.covers(route):
+        return replay.response(route)
+    r = _request(route, headers=headers)
+    if recorder is not None:
+        recorder.add(route, r.status_code, r.content)
+    return _decode(r), r.status_code
 
-    status = r.status_code
-    if status > 399:
-        raise requests.exceptions.HTTPError(f'Encountered HTTP error, status {status}')
 
-    # Necessary to play nicely with 304, etc.
-    if len(r.content) > 0:
-        return json.loads(r.content.decode()), status
-    else:
-        return {}, r.status_code
+@timed('query_api')
+async def _query_api_async(route: str, headers=HEADERS) -> (dict, int):
+    """Same as _query_api, but on the event loop's non-blocking client for the ASGI app.
+
+        :param route: The API route to query
+        :type route: str
+
+        :raises httpx.HTTPStatusError
+
+        :return: tuple with decoded JSON and request status code
+        :rtype (dict, int) tuple
+
+        """
+    if replay is not None and recording.covers(route):
+        return await asyncio.to_thread(replay.response, route)
+    r = await _request_async(route, headers=headers)
+    if recorder is not None:
+        recorder.add(route, r.status_code, r.content)
+    return _decode(r), r.status_code
+
+
+def _query_api_conditional(route: str, validators: dict) -> (dict, int, dict):
+    """Like _query_api, but sends If-Modified-Since/If-None-Match built from validators and also returns the
+        validators of the response, which are the same ones passed in on a 304.
+
+        :param route: The API route to query
+        :type route: str
+        :param validators: dict with optional 'Last-Modified' and 'ETag' values from a previous response
+        :type validators: dict
+
+        :raises requests.Exception.HTTPError
+
+        :return: tuple with decoded JSON, request status code and validators
+        :rtype (dict, int, dict) tuple
+
+        """
+    _headers = dict(HEADERS)
+    if validators.get('Last-Modified'):
+        _headers['If-Modified-Since'] = validators['Last-Modified']
+    if validators.get('ETag'):
+        _headers['If-None-Match'] = validators['ETag']
+
+    r = _request(route, headers=_headers)
+    conditional_requests.inc(upstream_path(route), 'hit' if r.status_code == 304 else 'miss')
+    if r.status_code == 304:
+        return {}, r.status_code, validators
+
+    new_validators = {k: r.headers[k] for k in ('Last-Modified', 'ETag') if k in r.headers}
+    return _decode(r), r.status_code, new_validators
 
 
 def _polyline_to_coords(poly: str) -> list:
@@ -69,18 +381,6 @@ def _polyline_to_coords(poly: str) -> list:
     return coords
 
 
-def _filter_deque(d: deque, included_elements: set) -> deque:
-    # filters deque to include only the elements in a set, while maintaining relative positions in the deque
-    d_prime = deque([])
-    d.reverse()
-    while len(d) > 0:
-        e = d.pop()
-        if e in included_elements:
-            d_prime.append(e)
-
-    return d_prime
-
-
 def build_route_df(route_ids: list):
     # TODO NYI
     # use /routes?filter[type]=<routes> to get name, route_id, color, text_color, direction names,
@@ -90,182 +390,401 @@ def build_route_df(route_ids: list):
     raise NotImplementedError
 
 
-def fetch_shapes(route_ids: list) -> pd.DataFrame:
-    # there might be a better way to do this but it's still a significant improvement I think
-    # todo update dynamically, will implement once I have a middleman server or a service updating this csv in a bucket
-    _headers = {
-        'User-Agent': USER_AGENT,
-        'x-api-key': MBTA_API_KEY,
-        'If-Modified-Since': 'Thu, 27 Mar 2025 15:46:06 GMT'
-        }
+def _load_static_data() -> StaticData:
+    manifest, networks = bundle.read_bundle(STATIC_DATA_DIR)
+    rail = networks['rail']
+    bus = networks.get('bus')
+    logger.info('Loaded static data bundle %s', manifest['version'])
+    if bus is None:
+        logger.warning('Bundle %s has no bus network, so it will be fetched from the API. Build bundles with '
+                       'tools/build_static.py (without --no-bus) to include it.', manifest['version'])
+
+    return StaticData(
+        shapes=rail['shapes'],
+        stops=rail['stops'],
+        route_to_stops=rail['route_to_stops'],
+        shape_to_route=rail['shape_to_route'],
+        stop_names=rail['stop_names'],
+        # when the data was fetched from the API, so the first revalidation only fetches it again if it's changed
+        validators=manifest['validators'],
+        bus=BusData(**bus) if bus is not None else None,
+    )
+
+
+def _revalidate_shapes(data: StaticData) -> dict:
+    j, status, validators = _query_api_conditional(f'/shapes?filter[route]={_list_for_url(all_routes)}',
+                                                   data.validators['shapes'])
+    if status == 304:
+        return {}
+    return {'shapes': build_shape_store(j, data.parts['shape_to_route']),
+            'validators': {'shapes': validators}}
 
-    j, status = _query_api(f'/shapes?filter[route]={_list_for_url(route_ids)}', headers=_headers)
 
+def _revalidate_stops(data: StaticData) -> dict:
+    j, status, validators = _query_api_conditional(f'/stops?filter[route]={_list_for_url(all_routes)}',
+                                                   data.validators['stops'])
     if status == 304:
-        # load from pickle
-        df = pd.read_pickle('./data/shapes.pkl')
-    else:
-        df = build_shape_df(j)
+        return {}
+    return {'stops': build_stop_df(j, data.parts['route_to_stops']), 'validators': {'stops': validators}}
+
+
+@timed('load_bus_data')
+def _load_bus_data() -> BusData:
+    """Fetches the routes, shapes and stops of every bus route the rail data doesn't already cover (the Silver
+    Line). That's a few hundred pages of API responses so it's read page by page into columns, see ingest."""
+    routes = ingest.route_ids(_iter_pages('/routes?filter[type]=3&fields[route]=short_name'))
+    new_routes = [r for r in routes if r not in all_routes]
+
+    trip_to_route, trip_to_shape = ingest.representative_trips(_iter_chunked(
+        '/route_patterns?filter[route]={}&fields[route_pattern]=typicality&include=representative_trip', new_routes))
+    shape_to_route = {shape: trip_to_route[trip] for trip, shape in trip_to_shape.items()}
+
+    shapes = ingest.shape_store(_iter_chunked('/shapes?filter[route]={}', new_routes), shape_to_route)
+    stops, route_to_stops = ingest.stop_df(_iter_chunked(
+        '/schedules?filter[trip]={}&fields[schedule]=stop_sequence&include=stop&fields[stop]=name,latitude,longitude',
+        list(trip_to_route)), trip_to_route)
+
+    logger.info('Loaded %s bus routes with %s shapes and %s stops', len(new_routes), len(shapes), len(stops))
+    return BusData(routes, shapes, stops, route_to_stops, shape_to_route, dict(zip(stops['id'], stops['name'])))
+
+
+def fetch_static_data(bus: bool = True) -> (dict, dict):
+    """Fetches everything that goes in a static data bundle from the API, see tools/build_static.py
+
+    :param bus: Whether to include the bus network, which is a few hundred more requests
+    :return: tuple of a dict of network name to its parts and the validators of the shapes and stops, as taken by
+        bundle.write_bundle
+    """
+    # the shapes drawn are the canonical ones, see build_shape_store
+    trip_to_route, trip_to_shape = ingest.representative_trips(_iter_chunked(
+        '/route_patterns?filter[route]={}&filter[canonical]=true&include=representative_trip', all_routes),
+        typicality=None)
+    shape_to_route = {shape: trip_to_route[trip] for trip, shape in trip_to_shape.items()}
+
+    # each route's stops are fetched on their own since that's the only way to get them in order
+    def stops_of(route):
+        return route, [s['id'] for page in _iter_pages(f'/stops?filter[route]={route}') for s in page['data']]
+    route_to_stops = dict(executor.map(stops_of, all_routes))
+
+    j, _, shape_validators = _query_api_conditional(f'/shapes?filter[route]={_list_for_url(all_routes)}', {})
+    shapes = build_shape_store(j, shape_to_route)
+    j, _, stop_validators = _query_api_conditional(f'/stops?filter[route]={_list_for_url(all_routes)}', {})
+    stops = build_stop_df(j, route_to_stops)
+
+    networks = {'rail': {'shapes': shapes, 'stops': stops, 'route_to_stops': route_to_stops,
+                         'shape_to_route': shape_to_route,
+                         # every stop, since vehicles and predictions refer to platforms and bus stops too
+                         'stop_names': ingest.stop_names(_iter_pages('/stops?fields[stop]=name'))}}
+    if bus:
+        networks['bus'] = vars(_load_bus_data())
+    return networks, {'shapes': shape_validators, 'stops': stop_validators}
+
+
+def _revalidate_static_data(data: StaticData) -> StaticData | None:
+    # shapes and stops are independent, so check both at once
+    futures = [executor.submit(f, data) for f in (_revalidate_shapes, _revalidate_stops)]
+
+    changes = {'validators': {}}
+    for f in futures:
+        c = f.result()
+        changes['validators'].update(c.pop('validators', {}))
+        changes.update(c)
+
+    # The bus data is too big to revalidate cheaply, but it comes from the same GTFS release as the rail data so
+    # it's reloaded whenever that changes, and until it's been loaded once
+    if len(changes) > 1 or data.parts['bus'] is None:
+        try:
+            changes['bus'] = _load_bus_data()
+        except (requests.exceptions.RequestException, KeyError, ValueError) as err:
+            logger.warning('Failed to load bus data, will retry on the next revalidation: %s', err)
 
-    # Sort df based on color values to follow draw order priority
-    color_sorter = dict(zip(df_color_sort_order, range(len(df_color_sort_order))))
-    df['sort_order'] = df['color'].map(color_sorter)
-    df.sort_values('sort_order', inplace=True)
-    df.drop('sort_order', axis='columns', inplace=True)
+    if len(changes) == 1:
+        return None
+    return data.replace(**changes)
 
-    # filter just the routes passed as an argument
-    return df[df['label'].isin(route_ids)]
 
+# Shared by every request in the process, see StaticDataCache
+static_data = StaticDataCache(_load_static_data, _revalidate_static_data, interval=STATIC_REVALIDATE_SECONDS)
 
-def build_shape_df(jdata: dict) -> pd.DataFrame:
-    rows, shapes, shape_ids = [], [], []
 
-    with open('./data/shape-to-route.json', 'r') as inf:
-        shape_to_route = json.load(inf)
+def fetch_shapes(route_ids: list, level=FULL) -> list:
+    # Shapes are cached for the whole process and kept up to date in the background, and are already in draw order.
+    # Returns (label, color, path) for each shape, with path a view into the ShapeStore at the given level
+    return static_data.get().shapes_for_routes(route_ids, level)
 
-    for d in jdata['data']:
-        if 'canonical' in d['id']:
-            shapes.append(_polyline_to_coords(d['attributes']['polyline']))
-            shape_ids.append(d['id'])
 
-    for i in range(len(shape_ids)):
-        r = shape_to_route[shape_ids[i]]
-        rows.append([r, shapes[i], get_color(r)])
+@timed('build_shape_store')
+def build_shape_store(jdata: dict, shape_to_route: dict) -> ShapeStore:
+    labels, paths = [], []
 
-    df = pd.DataFrame(rows, columns=['label', 'path', 'color'])
+    for d in jdata['data']:
+        if 'canonical' in d['id']:
+            labels.append(shape_to_route[d['id']])
+            paths.append(_polyline_to_coords(d['attributes']['polyline']))
 
-    # write pickle for all routes, since if this is running, all the cached data should be updated
-    #df.to_pickle('./data/shapes.pkl')
+    store = ShapeStore.from_paths(labels, [get_color(r) for r in labels], paths)
 
-    return df
+    return store
 
 
 def fetch_stops(route_ids: list) -> pd.DataFrame:
-    # there might be a better way to do this but it's still a significant improvement I think
-    # todo update dynamically, will implement once I have a middleman server or a service updating this csv in a bucket
-    _headers = {
-        'User-Agent': USER_AGENT,
-        'x-api-key': MBTA_API_KEY,
-        'If-Modified-Since': 'Thu, 27 Mar 2025 15:46:06 GMT'
-        }
-
-    j, status = _query_api(f'/stops?filter[route]={_list_for_url(route_ids)}', headers=_headers)
-    if status == 304:
-        # load from pickle
-        df = pd.read_pickle('./data/stops.pkl')
-    else:
-        df = build_stop_df(j)
-
-    # If SL stops stop loading again, add the 'SL'- route names back to this as copies of the numerical k-v pairs
-    with open('./data/route-to-stops.json', 'r') as inf:
-        route_to_stops = json.load(inf)
-
-    # filter just the routes passed as an argument
-    r = set(route_ids)
-
-    # TODO get rid of this and rename SL routes later down the line rather than when building the DF
-    # hacky fix for silver line stops being filtered accidentally
-    if not r.isdisjoint({'741', '742', '734', '746', '749', '751'}):
-        r = r.union({'SL1', 'SL2', 'SL3', 'SL4', 'SL5', 'SLW'})
-    stops = set()
-    for s in r:
-        stops = stops.union(set(route_to_stops[s]))
-
-    # Filter the routes_served for each stop to only include routes in route_ids and
-    # update the color to be based on this new filtered group of routes
-    df = df[df['id'].isin(stops)]
-    # filter routes_served to only include those in route_types
-    df['routes_served'] = df['routes_served'].apply(lambda x: list(_filter_deque(x, r)))
-    df = df[df.routes_served.astype(bool)]
-    # update color
-    df['color'] = df['routes_served'].apply(update_color)
-
-    return df
+    data = static_data.get()
 
+    # The stops served by any of route_ids, with routes_served narrowed down to route_ids and the color updated to
+    # be based on that, all looked up from the precomputed StopRouteIndex
+    rows, primary, served = data.stop_routes.select(route_ids)
+    df = data.stops.iloc[rows].copy()
+    df['routes_served'] = served
+    df['color'] = data.stop_routes.colors(primary).tolist()
 
-def build_stop_df(jdata: dict) -> pd.DataFrame:
-    stop_dict = {}
-
-    with open('./data/route-to-stops.json', 'r') as inf:
-        rts = json.load(inf)
+    return df
 
-    route_to_stops = {}
 
-    for k in rts.keys():
-        route_to_stops[k] = set(rts[k])
+@timed('build_stop_df')
+def build_stop_df(jdata: dict, route_to_stops: dict) -> pd.DataFrame:
+    # which routes serve each stop, in the order of route_to_stops, in one pass over it
+    served_by = {}
+    for r, stops in route_to_stops.items():
+        for s in stops:
+            served_by.setdefault(s, []).append(r)
 
+    stop_dict = {}
     for d in jdata['data']:
         _id = d['id']
         stop_dict[_id] = Stop(d)
-        for r in route_to_stops.keys():
-            if _id in route_to_stops[r]:
-                stop_dict[_id].add_route(r)
+        for r in served_by.get(_id, ()):
+            stop_dict[_id].add_route(r)
 
     rows = [v.row() for v in stop_dict.values()]
-    df = pd.DataFrame(rows, columns=['name', 'label', 'id', 'location', 'routes_served', 'color'])
-    #df.to_pickle('./data/stops.pkl')
-    return df
+    return pd.DataFrame(rows, columns=['name', 'label', 'id', 'location', 'routes_served', 'color'])
+
+
+_VEHICLES_ROUTE = ('/vehicles?fields[vehicle]=bearing,current_status,carriages,'
+                   'latitude,longitude,direction_id,revenue_status,speed,updated_at'
+                   '&include=trip,route&filter[route]={}')
+
+
+# Set once a bus map has been asked for. The bus routes are most of the upstream requests (or streams) a refresh makes,
+# so until someone wants them only the rail routes and the Silver Line are tracked.
+_bus_wanted = threading.Event()
+
+
+def want_bus_vehicles():
+    """Has the bus routes' vehicles tracked from the next refresh on, see live_routes"""
+    _bus_wanted.set()
+
+
+def live_routes() -> list:
+    """Every route vehicles are tracked for: the rail routes and the Silver Line, plus the bus routes once they've
+    been loaded and a bus map has been asked for (see want_bus_vehicles)"""
+    if not _bus_wanted.is_set():
+        return list(all_routes)
+    return all_routes + [r for r in static_data.get().bus_routes if r not in all_routes]
 
 
+@timed('build_vehicle_df')
 def build_vehicle_df(route_ids: list) -> pd.DataFrame:
+    return parse_vehicles(_iter_chunked(_VEHICLES_ROUTE, route_ids))
+
+
+@timed('parse_vehicles')
+def parse_vehicles(pages) -> pd.DataFrame:
     vehicle_dict = {}
-    jdata, _ = _query_api(f'/vehicles?fields[vehicle]=bearing,current_status,carriages,'
-                               f'latitude,longitude,direction_id,revenue_status,speed'
-                               f'&include=trip,route&filter[route]={_list_for_url(route_ids)}')
-
-    headsigns = {}
-    route_colors = {}
-    for d in jdata['included']:
-        if 'headsign' in d['attributes'].keys():
-            headsigns[d['id']] = d['attributes']['headsign']
-        elif 'color' in d['attributes'].keys():
-            route_colors[d['id']] = parse_color(d['attributes']['color'])
-
-    for v in jdata['data']:
-        try:
-            headsign = headsigns[v['relationships']['trip']['data']['id']]
-        except KeyError:
-            # if trip doesn't exist in the included data (which seems to happen for a small number of IDs,
-            # set it to None
-            headsign = None
+    for jdata in pages:
+        included = index_included(jdata.get('included'))
+        for v in jdata['data']:
+            # if the trip or route doesn't exist in the included data (which seems to happen for a small number of
+            # IDs), the headsign or color is set to None. Keyed by ID since a vehicle can turn up on two pages.
+            vehicle_dict[v['id']] = Vehicle(v, included=included)
 
-        try:
-            color = route_colors[v['relationships']['route']['data']['id']]
-        except KeyError:
-            # if trip doesn't exist in the included data (which seems to happen for a small number of IDs,
-            # set it to None
-            color = None
+    return _vehicles_to_df(vehicle_dict.values())
 
-        vehicle_dict[v['id']] = Vehicle(v, headsign=headsign, color=color)
 
-    rows = [v.row() for v in vehicle_dict.values()]
-    return pd.DataFrame(rows, columns=['label', 'location', 'color', 'bearing', 'icon', 'trip_id', 'vehicle_id'])
+def _vehicles_to_df(vehicles) -> pd.DataFrame:
+    rows = [v.row() for v in vehicles]
+    return pd.DataFrame(rows, columns=['label', 'location', 'color', 'bearing', 'icon', 'trip_id', 'vehicle_id',
+                                       'route_id', 'speed', 'current_status', 'updated_at'])
 
 
-def get_predictions(df: pd.DataFrame):
-    # https://api-v3.mbta.com/predictions?sort=arrival_time&include=vehicle.status&filter[trip]=TRIPS
-    trip_ids = df['trip_id'].unique()
-    j, _ = _query_api(f'/predictions?sort=arrival_time&include=vehicle.status&filter[trip]={_list_for_url(trip_ids)}')
-    predictions_dict = {}
+# https://api-v3.mbta.com/predictions?sort=arrival_time&include=vehicle.status&filter[trip]=TRIPS
+# Only the attributes Prediction uses are asked for, which cuts down what has to be sent and decoded
+_PREDICTIONS_ROUTE = ('/predictions?sort=arrival_time&fields[prediction]=arrival_time,arrival_uncertainty,'
+                      'departure_time,departure_uncertainty,direction_id,status,stop_sequence'
+                      '&include=vehicle.status&filter[trip]={}')
 
-    with open('./data/stop-id-to-name.json', 'r') as inf:
-        stop_lookup = json.load(inf)
 
-    for d in j['data']:
-        if d['relationships']['vehicle']['data'] is None:
-            continue
-        v = d['relationships']['vehicle']['data']['id']
-        if v not in predictions_dict:
-            predictions_dict[v] = Prediction(d, j['included'])
-        else:
-            predictions_dict[v].update_time_and_stop(d)
+@timed('get_predictions')
+def get_predictions(df: pd.DataFrame):
+    return label_predictions(df, parse_predictions(_iter_chunked(_PREDICTIONS_ROUTE, df['trip_id'].unique())))
 
-    for k in predictions_dict.keys():
-        # get vehicle ID
-        p = predictions_dict[k]
 
-        # for the row in vehicles_df where trip ids match:
-        idx = df.index[df['vehicle_id'] == p.vehicle][0]
-        df.at[idx, 'label'] = f"{df.at[idx, 'label']}<br><b>Next stop: </b>{stop_lookup[p.stop_id]}: {p.get_countdown_string()}"
+@timed('parse_predictions')
+def parse_predictions(pages) -> dict:
+    # vehicle ID -> Prediction for the vehicle's next stop
+    predictions_dict = {}
+    for j in pages:
+        included = index_included(j.get('included'))
+        for d in j['data']:
+            if d['relationships']['vehicle']['data'] is None:
+                continue
+            v = d['relationships']['vehicle']['data']['id']
+            if v not in predictions_dict:
+                predictions_dict[v] = Prediction(d, included)
+            else:
+                predictions_dict[v].update_time_and_stop(d)
+
+    return predictions_dict
+
+
+@timed('label_predictions')
+def label_predictions(df: pd.DataFrame, predictions_dict: dict) -> pd.DataFrame:
+    # adds the next stop and countdown for each vehicle in predictions_dict (vehicle ID -> Prediction) to its label
+    if len(predictions_dict) == 0 or len(df) == 0:
+        return df
+
+    nan = float('nan')
+    preds = pd.DataFrame(
+        [(p.vehicle, p.stop_id,
+          p.arrival_time.timestamp() if p.arrival_time is not None else nan,
+          p.departure_time.timestamp() if p.departure_time is not None else nan,
+          p.status,
+          p.vehicle_status == 'STOPPED_AT' and p.vehicle_stop == p.stop_id) for p in predictions_dict.values()],
+        columns=['vehicle_id', 'stop_id', 'arrival', 'departure', 'status', 'boarding'])
+
+    countdown = get_countdown_strings(preds['arrival'].to_numpy(), preds['departure'].to_numpy(),
+                                      preds['status'].to_numpy(), preds['boarding'].to_numpy(dtype=bool))
+    stop_names = preds['stop_id'].map(static_data.get().stop_name_index).fillna(preds['stop_id'])
+    preds['next_stop'] = '<br><b>Next stop: </b>' + stop_names + ': ' + countdown
+
+    # vehicle IDs are unique, so this lines each vehicle up with its prediction (if it has one) in a single pass
+    next_stop = df['vehicle_id'].map(preds.set_index('vehicle_id')['next_stop'])
+    df['label'] = df['label'] + next_stop.fillna('')
 
     return df
+
+
+# (route with {} where the routes go, resource types it returns) of each stream kept per chunk of routes
+_STREAM_ROUTES = [
+    ('/vehicles?fields[vehicle]=bearing,current_status,carriages,latitude,longitude,direction_id,revenue_status,speed,'
+     'updated_at&include=trip,route&filter[route]={}', {'vehicle', 'trip', 'route'}),
+    ('/predictions?filter[route]={}', {'prediction'}),
+]
+
+live_store = LiveStore()
+# URL -> StreamIngester
+_stream_ingesters = {}
+_streams_lock = threading.Lock()
+# time.monotonic() when streams were last started
+_streams_started = None
+
+
+def start_streams():
+    """Makes sure there are background ingesters streaming the vehicles and predictions of every route in
+    live_routes(). The rail routes get a pair of streams to themselves and the bus routes are split over as many as it
+    takes to keep the URLs short enough (see _chunk_for_url), which are started once the bus routes have loaded and
+    replaced whenever they change."""
+    global _streams_started
+    bus_routes = [r for r in live_routes() if r not in all_routes]
+    wanted = {f'{BASE_URL}{route}': types for routes in (all_routes, bus_routes) if len(routes) > 0
+              for template, types in _STREAM_ROUTES for route in _chunk_for_url(template, routes)}
+    if wanted.keys() == _stream_ingesters.keys():
+        return
+
+    with _streams_lock:
+        for url in [url for url in _stream_ingesters if url not in wanted]:
+            ingester = _stream_ingesters.pop(url)
+            ingester.stop()
+            # take out what it had streamed, with a reset that has nothing in it
+            live_store.apply('reset', [], ingester.types, source=url)
+        for url, types in wanted.items():
+            if url not in _stream_ingesters:
+                _stream_ingesters[url] = StreamIngester(url, live_store, types=types, headers=HEADERS)
+                _stream_ingesters[url].start()
+                _streams_started = time.monotonic()
+
+
+recorder = recording.Recorder(RECORD_DIR, max_bytes=RECORD_MAX_BYTES) if RECORD_DIR else None
+replay = recording.Replay(REPLAY_DIR, speed=REPLAY_SPEED) if REPLAY_DIR else None
+
+
+@contextmanager
+def _snapshot_recording():
+    # Groups the responses of one refresh into one recorded snapshot. Replays pick their snapshot before this, see
+    # Replay.begin.
+    if recorder is None:
+        yield
+        return
+    recorder.begin()
+    try:
+        yield
+    except BaseException:
+        recorder.discard()
+        raise
+    recorder.commit()
+
+
+@timed('fetch_vehicle_snapshot')
+def _fetch_vehicle_snapshot(_key=None) -> VehicleSnapshot:
+    # Always covers every route in live_routes(), map types filter the result with VehicleSnapshot.for_routes
+    if LIVE_SOURCE == 'stream' and replay is None:
+        start_streams()
+        # on a cold start wait for the streams' first resets rather than rendering an empty map, but after that don't
+        # hold refreshes up waiting on one that's reconnecting
+        deadline = _streams_started + STREAM_CONNECT_SECONDS
+        ingesters = list(_stream_ingesters.values())
+        if all(s.connected.wait(timeout=max(deadline - time.monotonic(), 0)) for s in ingesters):
+            vehicles, predictions = live_store.snapshot()
+            df = label_predictions(_vehicles_to_df(vehicles), predictions)
+            return VehicleSnapshot(df, previous=vehicle_snapshots.peek('all'))
+        # the store stops being kept current while a stream is down, so poll until it's back
+        logger.warning('Polling for vehicles while a stream is disconnected')
+
+    routes = live_routes()
+    if replay is not None:
+        replay.begin()
+    with _snapshot_recording():
+        df = get_predictions(build_vehicle_df(routes))
+
+    return VehicleSnapshot(df, previous=vehicle_snapshots.peek('all'))
+
+
+@timed('fetch_vehicle_snapshot')
+async def _fetch_vehicle_snapshot_async(_key=None) -> VehicleSnapshot:
+    # The ASGI app's version of _fetch_vehicle_snapshot. Only the upstream calls are awaited here, parsing is CPU
+    # bound so it's handed to a thread to keep the event loop free for other requests.
+    if LIVE_SOURCE == 'stream' and replay is None:
+        return await asyncio.to_thread(_fetch_vehicle_snapshot)
+
+    routes = await asyncio.to_thread(live_routes)
+    if replay is not None:
+        # reads and decompresses the snapshot's frame from disk
+        await asyncio.to_thread(replay.begin)
+    with _snapshot_recording():
+        pages = await _fetch_chunked_async(_VEHICLES_ROUTE, routes)
+        df = await asyncio.to_thread(parse_vehicles, pages)
+        pages = await _fetch_chunked_async(_PREDICTIONS_ROUTE, df['trip_id'].unique())
+
+    def build():
+        return VehicleSnapshot(label_predictions(df, parse_predictions(pages)), previous=vehicle_snapshots.peek('all'))
+
+    return await asyncio.to_thread(build)
+
+
+# Shared by every request in the process so concurrent viewers of any map share one set of upstream calls.
+# With streaming the store is already current, so this just limits how often a new DataFrame gets built from it
+vehicle_snapshots = SnapshotCache(_fetch_vehicle_snapshot, ttl=VEHICLE_TTL_SECONDS,
+                                  max_stale=VEHICLE_MAX_STALE_SECONDS, fetch_async=_fetch_vehicle_snapshot_async,
+                                  name='vehicles')
+
+
+def get_vehicle_snapshot() -> VehicleSnapshot:
+    return vehicle_snapshots.get('all')
+
+
+async def get_vehicle_snapshot_async() -> VehicleSnapshot:
+    return await vehicle_snapshots.aget('all')
+
+
+def fetch_vehicles(route_ids: list) -> pd.DataFrame:
+    # The returned DataFrame is shared with other requests, so it shouldn't be modified
+    return get_vehicle_snapshot().for_routes(route_ids)
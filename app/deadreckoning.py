@@ -0,0 +1,271 @@
+"""Moves vehicles along their routes between snapshots, so the maps can show them moving every second or so while
+the API is only polled every VEHICLE_TTL_SECONDS.
+
+Each vehicle's last fix is projected onto the nearest of its route's shapes (at full detail) that runs the way it's
+heading, and it's then moved along that shape from where it was at updated_at. The speed is the one the API reports
+when there is one, which is mostly for buses, or otherwise how far along the shape the vehicle got between its
+previous fix and this one. Vehicles that are stopped, aren't near any of their route's shapes (detours, yards) or
+whose speed isn't known stay where they were last seen, and nothing is moved more than MAX_EXTRAPOLATION_SECONDS past
+its fix, since by then the next snapshot is overdue and there's no telling what happened. Vehicles aren't moved past
+the next of their route's stops along the shape either, since they'll most likely wait there, and the next snapshot
+will show them leaving.
+
+Shapes are projected to metres on a plane tangent to the middle of the network, which is plenty accurate over an
+area the size of the MBTA's.
+"""
+from __future__ import annotations
+
+import math
+
+from lazy import lazy_import
+from shapestore import FULL, ShapeStore
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+EARTH_RADIUS_METRES = 6371008.8
+# Fixes further than this from all of their route's shapes aren't moved
+MAX_SNAP_METRES = 150
+MAX_EXTRAPOLATION_SECONDS = 45
+# Speeds estimated from consecutive fixes above this (about 90 mph) are put down to bad fixes
+MAX_SPEED = 40
+# Vehicles stay on the shape they were on at their previous fix unless another is this much closer. Branches share
+# shapes up to where they split, so otherwise which one a vehicle on the trunk ends up on would flip back and forth.
+STICKY_METRES = 10
+# Stops less than this far ahead of a fix are taken to be the one the vehicle's at or just leaving, so it's held at
+# the one after. Fixes are usually within a few metres of where the vehicle is, but stations are a point in the middle
+# of the platforms.
+STOP_MARGIN_METRES = 30
+
+
+def stop_locations(stops: pd.DataFrame, route_to_stops) -> dict:
+    """Route ID -> [lng, lat] of each of the route's stops, for Tracks
+
+    :param stops: e.g. StaticData.stops
+    :param route_to_stops: e.g. StaticData.route_to_stops
+    """
+    locations = dict(zip(stops['id'], stops['location']))
+    return {r: [locations[s] for s in ids if s in locations] for r, ids in route_to_stops.items()}
+
+
+class Tracks:
+    """Every shape in a ShapeStore as a polyline in metres, for projecting vehicles onto and moving them along
+
+    :param shapes: e.g. StaticData.shapes
+    :param level: Level of shapes to use, see ShapeStore
+    :param stops: Optionally the stops of each route, see stop_locations, for next_stop
+    """
+    def __init__(self, shapes: ShapeStore, level=FULL, stops: dict = None):
+        coords, offsets = shapes.levels[level]
+        lonlat = np.asarray(coords, dtype=np.float64)
+        self.origin = lonlat.mean(axis=0) if len(lonlat) else np.zeros(2)
+        self._scale = np.radians([math.cos(math.radians(self.origin[1])), 1]) * EARTH_RADIUS_METRES
+        self.xy = self.to_xy(lonlat)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+        # segments run from each point to the next one in the same shape
+        owners = np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+        starts = np.flatnonzero(owners[:-1] == owners[1:]) if len(owners) else np.zeros(0, dtype=np.int64)
+        self.seg_starts = starts
+        self.seg_owners = owners[starts]
+        self.seg_vectors = self.xy[starts + 1] - self.xy[starts]
+        self.seg_lengths = np.hypot(self.seg_vectors[:, 0], self.seg_vectors[:, 1])
+
+        # distance of every point from the start of its shape
+        steps = np.zeros(len(self.xy))
+        steps[starts + 1] = self.seg_lengths
+        self.along = np.cumsum(steps)
+        self.along -= self.along[self.offsets[:-1]].repeat(np.diff(self.offsets))
+        self.lengths = self.along[self.offsets[1:] - 1] if len(self.xy) else np.zeros(0)
+        # where each segment starts with every shape laid end to end (a metre apart, so no two shapes' distances
+        # overlap), for finding the segment at a distance along any shape in one search
+        self._bases = np.concatenate([[0], np.cumsum(self.lengths + 1)[:-1]]) if len(self.lengths) else self.lengths
+        self._seg_positions = self.along[self.seg_starts] + self._bases[self.seg_owners]
+
+        # every shape's segments are together, and every route's shapes are too, so a route's segments are a slice
+        bounds = np.searchsorted(self.seg_owners, np.arange(len(self.offsets)))
+        self.route_segments = {label: slice(bounds[s.start], bounds[s.stop])
+                               for label, s in shapes.route_slices.items()}
+
+        # where each shape passes its route's stops, laid end to end like _seg_positions
+        positions = []
+        for label, rows in shapes.route_slices.items():
+            xy = self.to_xy((stops or {}).get(label, []))
+            for row in range(rows.start, rows.stop):
+                segments = slice(bounds[row], bounds[row + 1])
+                if len(xy) == 0 or segments.stop <= segments.start:
+                    continue
+                t, distances = self._distances(segments, xy)
+                best = np.argmin(distances, axis=1)
+                i = np.arange(len(xy))
+                near = distances[i, best] <= MAX_SNAP_METRES
+                seg = segments.start + best[near]
+                along = self.along[self.seg_starts[seg]] + t[i[near], best[near]] * self.seg_lengths[seg]
+                positions.append(self._bases[row] + along)
+        self._stop_positions = np.sort(np.concatenate(positions)) if positions else np.zeros(0)
+
+    def to_xy(self, lonlat) -> np.ndarray:
+        return (np.asarray(lonlat, dtype=np.float64).reshape(-1, 2) - self.origin) * self._scale
+
+    def to_lonlat(self, xy: np.ndarray) -> np.ndarray:
+        return xy / self._scale + self.origin
+
+    def project(self, route_id: str, xy: np.ndarray, bearings: np.ndarray,
+                prefer: np.ndarray = None) -> (np.ndarray, np.ndarray, np.ndarray):
+        """Finds where points are on a route's shapes
+
+        :param xy: (n, 2) points, see to_xy
+        :param bearings: Compass bearing of each point in degrees, NaN where there isn't one. Points are only put on
+            segments running within 90 degrees of their bearing unless there aren't any close enough.
+        :param prefer: Optionally a shape for each point (or -1) to keep it on unless another is more than
+            STICKY_METRES closer
+        :return: tuple of the shape each point is on (-1 if none is within MAX_SNAP_METRES), its distance along that
+            shape, and how far it was from it
+        """
+        segments = self.route_segments.get(route_id, slice(0, 0))
+        n = len(xy)
+        if segments.stop <= segments.start or n == 0:
+            return np.full(n, -1), np.zeros(n), np.full(n, np.inf)
+
+        a = self.xy[self.seg_starts[segments]]
+        v = self.seg_vectors[segments]
+        t, cost = self._distances(segments, xy)
+
+        heading = np.stack([np.sin(np.radians(bearings)), np.cos(np.radians(bearings))], axis=1)
+        cost += (np.nan_to_num(heading @ v.T) < 0) * MAX_SNAP_METRES
+        if prefer is not None:
+            cost -= (self.seg_owners[segments] == prefer[:, None]) * STICKY_METRES
+        best = np.argmin(cost, axis=1)
+
+        i = np.arange(n)
+        seg = segments.start + best
+        offset = xy - (a[best] + t[i, best][:, None] * v[best])
+        error = np.hypot(offset[:, 0], offset[:, 1])
+        rows = np.where(error <= MAX_SNAP_METRES, self.seg_owners[seg], -1)
+        along = self.along[self.seg_starts[seg]] + t[i, best] * self.seg_lengths[seg]
+        return rows, along, error
+
+    def _distances(self, segments: slice, xy: np.ndarray) -> (np.ndarray, np.ndarray):
+        # (points, segments) arrays of how far along each segment (0 to 1) the nearest point on it to each point is,
+        # and how far away that is. Worked on in place since there can be thousands of segments on a route.
+        a = self.xy[self.seg_starts[segments]]
+        v = self.seg_vectors[segments]
+        dx = xy[:, 0:1] - a[:, 0]
+        dy = xy[:, 1:2] - a[:, 1]
+        t = dx * v[:, 0]
+        t += dy * v[:, 1]
+        t /= np.maximum(self.seg_lengths[segments] ** 2, 1e-9)
+        np.clip(t, 0, 1, out=t)
+        dx -= t * v[:, 0]
+        dy -= t * v[:, 1]
+        return t, np.hypot(dx, dy, out=dx)
+
+    def next_stop(self, rows: np.ndarray, along: np.ndarray) -> np.ndarray:
+        """Distance along each shape of the first of its route's stops more than STOP_MARGIN_METRES past along, or
+        the shape's length if there isn't one
+        """
+        ahead = self._bases[rows] + along + STOP_MARGIN_METRES
+        k = np.minimum(np.searchsorted(self._stop_positions, ahead), len(self._stop_positions) - 1)
+        stop = self._stop_positions[k] - self._bases[rows] if len(self._stop_positions) else np.full(len(rows), np.inf)
+        # the next one found may be on a later shape
+        return np.where((stop >= along + STOP_MARGIN_METRES) & (stop <= self.lengths[rows]), stop, self.lengths[rows])
+
+    def locate(self, rows: np.ndarray, along: np.ndarray) -> (np.ndarray, np.ndarray):
+        """The inverse of project: where points are given the shape they're on and their distance along it, which
+        is clamped to the shape's ends
+
+        :return: tuple of (n, 2) points (see to_xy) and the compass bearing of the shape at each one
+        """
+        along = np.clip(along, 0, self.lengths[rows])
+        # the last segment of the shape starting at or before each point
+        seg = np.searchsorted(self._seg_positions, self._bases[rows] + along, side='right') - 1
+        seg = np.clip(seg, np.searchsorted(self.seg_owners, rows),
+                      np.searchsorted(self.seg_owners, rows, side='right') - 1)
+
+        t = (along - self.along[self.seg_starts[seg]]) / np.maximum(self.seg_lengths[seg], 1e-9)
+        v = self.seg_vectors[seg]
+        xy = self.xy[self.seg_starts[seg]] + np.clip(t, 0, 1)[:, None] * v
+        return xy, np.degrees(np.arctan2(v[:, 0], v[:, 1])) % 360
+
+
+class Motion:
+    """Where each vehicle in a snapshot was on its route at its last fix and how fast it was going, to move it on
+    from there with positions
+
+    :param df: Vehicles DataFrame, see datamanager.build_vehicle_df
+    :param tracks: Tracks of the routes' shapes
+    :param previous: Motion of the snapshot before, for estimating the speeds the API doesn't give and keeping
+        vehicles on the same shapes
+    :param now: Time of the snapshot, used for vehicles without an updated_at
+    """
+    def __init__(self, df: pd.DataFrame, tracks: Tracks, previous: 'Motion' = None, now: float = None):
+        self.tracks = tracks
+        self.vehicle_ids = df['vehicle_id'].to_numpy()
+        n = len(df)
+        self.locations = np.array(df['location'].tolist(), dtype=np.float64).reshape(-1, 2)
+        self.bearings = pd.to_numeric(df['bearing'], errors='coerce').to_numpy(dtype=np.float64)
+        self.fixed_at = pd.to_numeric(df['updated_at'], errors='coerce').to_numpy(dtype=np.float64)
+        if now is not None:
+            self.fixed_at = np.where(np.isnan(self.fixed_at), now, self.fixed_at)
+
+        # where each vehicle is in previous, if it's there and on the same shapes
+        if previous is not None and previous.tracks is not tracks:
+            previous = None
+        before = pd.Index(previous.vehicle_ids).get_indexer(self.vehicle_ids) if previous is not None else \
+            np.full(n, -1)
+        prefer = np.full(n, -1)
+        prefer[before >= 0] = previous.rows[before[before >= 0]] if previous is not None else -1
+
+        self.rows = np.full(n, -1)
+        self.along = np.zeros(n)
+        xy = tracks.to_xy(self.locations)
+        for route, i in df.groupby('route_id').indices.items():
+            self.rows[i], self.along[i], _ = tracks.project(route, xy[i], self.bearings[i], prefer[i])
+
+        speeds = pd.to_numeric(df['speed'], errors='coerce').to_numpy(dtype=np.float64)
+        if previous is not None:
+            speeds = np.where(np.isnan(speeds), self._estimate_speeds(previous, before), speeds)
+        speeds = np.nan_to_num(speeds)
+        speeds[(df['current_status'] == 'STOPPED_AT').to_numpy()] = 0
+        self.speeds = speeds
+        # how far along its shape each vehicle is held, see Tracks.next_stop
+        self.stops_at = np.full(n, np.inf)
+        on = self.rows >= 0
+        self.stops_at[on] = tracks.next_stop(self.rows[on], self.along[on])
+
+    def _estimate_speeds(self, previous: 'Motion', before: np.ndarray) -> np.ndarray:
+        # how far along the same shape each vehicle got since its previous fix, or failing that the speed it was
+        # going at then if that's still the latest fix, NaN for anything else
+        seen = before >= 0
+        same = np.zeros(len(before), dtype=bool)
+        same[seen] = (previous.rows[before[seen]] == self.rows[seen]) & (self.rows[seen] >= 0)
+
+        estimates = np.full(len(before), np.nan)
+        b = before[same]
+        elapsed = self.fixed_at[same] - previous.fixed_at[b]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            moved = (self.along[same] - previous.along[b]) / elapsed
+        estimates[same] = np.where(elapsed > 0, np.where((moved >= 0) & (moved <= MAX_SPEED), moved, 0),
+                                   np.where(elapsed == 0, previous.speeds[b], np.nan))
+        return estimates
+
+    def positions(self, now: float, rows: np.ndarray = None) -> (np.ndarray, np.ndarray, np.ndarray):
+        """Where the vehicles are at now
+
+        :param rows: Positions of the vehicles to move in the snapshot's df, defaults to all of them
+        :return: tuple of (n, 2) locations as [lng, lat], bearings, and whether each vehicle was moved from its fix
+        """
+        if rows is None:
+            rows = np.arange(len(self.rows))
+        locations, bearings = self.locations[rows], self.bearings[rows]
+        moving = (self.rows[rows] >= 0) & (self.speeds[rows] > 0)
+        if moving.any():
+            m = rows[moving]
+            elapsed = np.clip(now - self.fixed_at[m], 0, MAX_EXTRAPOLATION_SECONDS)
+            along = np.minimum(self.along[m] + self.speeds[m] * elapsed, self.stops_at[m])
+            xy, headings = self.tracks.locate(self.rows[m], along)
+            locations = locations.copy()
+            bearings = bearings.copy()
+            locations[moving] = self.tracks.to_lonlat(xy)
+            bearings[moving] = headings
+        return locations, bearings, moving
@@ -0,0 +1,158 @@
+"""Imports the static data from a GTFS feed zip (https://cdn.mbta.com/MBTA_GTFS.zip) rather than the API, so bundles
+can be built offline and reproducibly, see tools/build_static.py.
+
+Files are streamed out of the zip rather than extracted. stop_times.txt and shapes.txt run to millions of rows, so
+they're read in chunks of CHUNK_ROWS, keeping only the rows for the trips and shapes that are actually drawn.
+
+Which trips those are comes from the MBTA's route_patterns.txt extension to GTFS when the feed has it: the canonical
+patterns for the rail network, like fetch_static_data does with the API, and the typical ones for buses (and rail
+routes without a canonical pattern), like _load_bus_data. Without it, every shape that runs at least MIN_SHAPE_SHARE
+as many trips as the busiest shape of its route and direction is used. tests/test_gtfs.py checks all of this against
+a small feed with known output.
+"""
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+import ingest
+from mbta import get_color
+from shapestore import ShapeStore
+
+CHUNK_ROWS = 500_000
+MIN_SHAPE_SHARE = 0.1
+
+
+def read_feed(path: str, rail_routes: list, bus: bool = True, chunksize: int = CHUNK_ROWS) -> (dict, dict):
+    """Reads the rail network, and optionally the bus network, out of a GTFS zip
+
+    :param rail_routes: Route IDs of the rail network, i.e. datamanager.all_routes
+    :param bus: Whether to read the bus routes not in rail_routes as well
+    :return: tuple of a dict of network name to its parts, as taken by bundle.write_bundle, and the feed_info.txt
+        row (empty if the feed doesn't have one)
+    """
+    with zipfile.ZipFile(path) as zf:
+        routes = _read(zf, 'routes.txt', ['route_id', 'route_type'])
+        stops = _read(zf, 'stops.txt', ['stop_id', 'stop_name', 'stop_lat', 'stop_lon', 'parent_station'],
+                      dtype={'stop_lat': np.float64, 'stop_lon': np.float64})
+        trips = _read(zf, 'trips.txt', ['route_id', 'trip_id', 'direction_id', 'shape_id'])
+        patterns = _read(zf, 'route_patterns.txt', ['route_pattern_typicality', 'representative_trip_id',
+                                                     'canonical_route_pattern'])
+        feed_info = _read(zf, 'feed_info.txt', None)
+
+        reps = {'rail': representative_trips(trips, patterns, list(rail_routes), canonical=True)}
+        if bus:
+            bus_routes = routes.loc[(routes['route_type'] == '3') & ~routes['route_id'].isin(rail_routes), 'route_id']
+            reps['bus'] = representative_trips(trips, patterns, bus_routes.tolist(), canonical=False)
+
+        # the big files are read once for every network
+        every = pd.concat(reps.values())
+        stop_times = _read_chunked(zf, 'stop_times.txt', ['trip_id', 'stop_id', 'stop_sequence'], 'trip_id',
+                                   every['trip_id'], chunksize, dtype={'stop_sequence': np.int64})
+        points = _read_chunked(zf, 'shapes.txt', ['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'],
+                               'shape_id', every['shape_id'], chunksize,
+                               dtype={'shape_pt_lat': np.float64, 'shape_pt_lon': np.float64,
+                                      'shape_pt_sequence': np.int64})
+
+    networks = {name: _network(r, stops, stop_times[stop_times['trip_id'].isin(r['trip_id'])],
+                               points[points['shape_id'].isin(r['shape_id'])]) for name, r in reps.items()}
+    # every stop, since vehicles and predictions refer to platforms and bus stops too
+    networks['rail']['stop_names'] = dict(zip(stops['stop_id'], stops['stop_name']))
+    return networks, feed_info.iloc[0].to_dict() if feed_info is not None and len(feed_info) else {}
+
+
+def representative_trips(trips: pd.DataFrame, patterns: pd.DataFrame | None, route_ids: list,
+                         canonical: bool) -> pd.DataFrame:
+    """One trip for each shape drawn for route_ids, see the module docstring
+
+    :param trips: trips.txt
+    :param patterns: route_patterns.txt, or None if the feed doesn't have it
+    :param canonical: Use the canonical route patterns rather than the typical ones
+    :return: DataFrame of trip_id, route_id and shape_id, in route then direction order
+    """
+    trips = trips[trips['route_id'].isin(route_ids) & (trips['shape_id'] != '')]
+
+    if patterns is not None and 'route_pattern_typicality' in patterns:
+        typical = trips[trips['trip_id'].isin(
+            patterns.loc[patterns['route_pattern_typicality'] == '1', 'representative_trip_id'])]
+        picked = typical
+        if canonical and 'canonical_route_pattern' in patterns:
+            picked = trips[trips['trip_id'].isin(
+                patterns.loc[patterns['canonical_route_pattern'] == '1', 'representative_trip_id'])]
+            # routes without a canonical pattern are drawn with their typical ones
+            picked = pd.concat([picked, typical[~typical['route_id'].isin(picked['route_id'])]])
+    else:
+        counts = trips.groupby(['route_id', 'direction_id', 'shape_id'], sort=False).size()
+        busiest = counts.groupby(level=['route_id', 'direction_id']).transform('max')
+        shapes = counts[counts >= busiest * MIN_SHAPE_SHARE].index.get_level_values('shape_id')
+        picked = trips[trips['shape_id'].isin(shapes)]
+
+    picked = picked.drop_duplicates('shape_id')
+    order = pd.Categorical(picked['route_id'], categories=list(dict.fromkeys(route_ids)), ordered=True)
+    return (picked.assign(_order=order).sort_values(['_order', 'direction_id'], kind='stable')
+            [['trip_id', 'route_id', 'shape_id']].reset_index(drop=True))
+
+
+def _network(reps: pd.DataFrame, stops: pd.DataFrame, stop_times: pd.DataFrame, points: pd.DataFrame) -> dict:
+    # Builds one network's parts from its representative trips and their rows of stop_times.txt and shapes.txt
+    shape_to_route = dict(zip(reps['shape_id'], reps['route_id']))
+
+    # stops are drawn as their stations, e.g. place-pktrm rather than each of its platforms
+    station = stops['parent_station'].where(stops['parent_station'] != '', stops['stop_id'])
+    stop_to_station = pd.Series(station.values, index=stops['stop_id'])
+
+    # in the order of reps, so each route's stops are listed starting with its first direction
+    stop_times = stop_times.assign(_trip=pd.Categorical(stop_times['trip_id'], categories=reps['trip_id'],
+                                                        ordered=True))
+    stop_times = stop_times.sort_values(['_trip', 'stop_sequence'], kind='stable')
+    stop_times['route_id'] = stop_times['trip_id'].map(dict(zip(reps['trip_id'], reps['route_id'])))
+    stop_times['station'] = stop_times['stop_id'].map(stop_to_station).fillna(stop_times['stop_id'])
+
+    route_to_stops = {r: list(dict.fromkeys(g['station']))
+                      for r, g in stop_times.groupby('route_id', sort=False)}
+    served = stops[stops['stop_id'].isin(stop_times['station'])]
+    df, route_to_stops = ingest.stop_frame(
+        route_to_stops, dict(zip(served['stop_id'], served['stop_name'])),
+        dict(zip(served['stop_id'], served[['stop_lon', 'stop_lat']].values.tolist())))
+
+    return {'routes': list(route_to_stops), 'shapes': _shape_store(points, shape_to_route), 'stops': df,
+            'route_to_stops': route_to_stops, 'shape_to_route': shape_to_route,
+            'stop_names': dict(zip(df['id'], df['name']))}
+
+
+def _shape_store(points: pd.DataFrame, shape_to_route: dict) -> ShapeStore:
+    # Splits rows of shapes.txt into one path per shape
+    points = points.sort_values(['shape_id', 'shape_pt_sequence'], kind='stable')
+    shape_ids = points['shape_id'].to_numpy()
+    starts = np.flatnonzero(np.r_[True, shape_ids[1:] != shape_ids[:-1]]) if len(points) else np.zeros(0, int)
+    paths = np.split(points[['shape_pt_lon', 'shape_pt_lat']].to_numpy(), starts[1:])
+    labels = [shape_to_route[s] for s in shape_ids[starts]]
+    return ShapeStore.from_paths(labels, [get_color(r) for r in labels], paths if len(starts) else [])
+
+
+def _read(zf: zipfile.ZipFile, name: str, columns: list | None, dtype: dict = None, **kwargs):
+    # Everything is read as strings apart from what's in dtype, and missing values are left as ''. Files that aren't
+    # in the feed come back as None, and optional columns that aren't in the file are filled with ''.
+    if name not in zf.namelist():
+        return None
+    with zf.open(name) as f:
+        header = pd.read_csv(f, nrows=0, encoding='utf-8-sig').columns
+    usecols = [c for c in columns if c in header] if columns is not None else None
+    dtype = {c: (dtype or {}).get(c, str) for c in (usecols if usecols is not None else header)}
+    df = pd.read_csv(zf.open(name), usecols=usecols, dtype=dtype, keep_default_na=False, encoding='utf-8-sig',
+                     **kwargs)
+    if 'chunksize' not in kwargs:
+        for c in columns or ():
+            if c not in df:
+                df[c] = ''
+    return df
+
+
+def _read_chunked(zf: zipfile.ZipFile, name: str, columns: list, key: str, keep, chunksize: int,
+                  dtype: dict = None) -> pd.DataFrame:
+    # Reads only the rows whose key is in keep, a chunk at a time so the whole file is never in memory at once
+    keep = pd.Index(pd.unique(np.asarray(keep, dtype=object)))
+    parts = [chunk[chunk[key].isin(keep)] for chunk in _read(zf, name, columns, dtype, chunksize=chunksize)]
+    if not parts:
+        return pd.DataFrame({c: pd.Series(dtype=(dtype or {}).get(c, object)) for c in columns})
+    return pd.concat(parts, ignore_index=True)
@@ -0,0 +1,8 @@
+"""gunicorn's settings, which it reads from the working directory. App Engine serves main.py with gunicorn unless
+app.yaml gives an entrypoint, see there."""
+
+
+def post_worker_init(worker):
+    # once per worker, after it's imported the app and before it serves anything, see datamanager.tune_gc
+    from datamanager import tune_gc
+    tune_gc()
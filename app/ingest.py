@@ -0,0 +1,122 @@
+"""Builds DataFrames (and ShapeStores) straight from pages of V3 API responses.
+
+Big collections like every bus stop and shape on the network are fetched a page at a time (see
+datamanager._iter_pages), and the functions here read each page's values into plain column lists as it arrives rather
+than building an object per resource, so a page can be dropped as soon as it's been read.
+"""
+from __future__ import annotations
+
+from lazy import lazy_import
+from mbta import STOP_LABEL, get_color, get_priority, silver_line_route_names, update_color
+from shapestore import ShapeStore
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+polyline = lazy_import('polyline')
+
+
+def route_ids(pages) -> list:
+    ids = []
+    for page in pages:
+        ids.extend(r['id'] for r in page['data'])
+    return ids
+
+
+def representative_trips(pages, typicality: int = 1) -> (dict, dict):
+    """Reads pages of /route_patterns?include=representative_trip
+
+    :param pages: Iterable of decoded pages
+    :param typicality: Only route patterns with this typicality are used, 1 being the typical ones, or None for all
+    :return: tuple of dicts of representative trip ID to route ID and trip ID to shape ID
+    """
+    trip_to_route, trip_to_shape = {}, {}
+    for page in pages:
+        shapes = {i['id']: i['relationships']['shape']['data'] for i in page.get('included', ()) if i['type'] == 'trip'}
+        for p in page['data']:
+            trip = p['relationships']['representative_trip']['data']
+            if trip is None or (typicality is not None and p['attributes'].get('typicality') != typicality):
+                continue
+            trip_to_route[trip['id']] = p['relationships']['route']['data']['id']
+            if shapes.get(trip['id']) is not None:
+                trip_to_shape[trip['id']] = shapes[trip['id']]['id']
+    return trip_to_route, trip_to_shape
+
+
+def shape_store(pages, shape_to_route: dict) -> ShapeStore:
+    """Reads pages of /shapes into a ShapeStore like datamanager.build_shape_store, keeping only the shapes in
+    shape_to_route"""
+    labels, paths, colors = [], [], []
+    seen = set()
+    for page in pages:
+        for s in page['data']:
+            route = shape_to_route.get(s['id'])
+            # chunks of routes can overlap in the shapes they return
+            if route is None or s['id'] in seen:
+                continue
+            seen.add(s['id'])
+            labels.append(route)
+            # decoded as [lat, lng]
+            points = np.array(polyline.decode(s['attributes']['polyline']), dtype=np.float64).reshape(-1, 2)
+            paths.append(points[:, ::-1])
+            colors.append(get_color(route))
+
+    return ShapeStore.from_paths(labels, colors, paths)
+
+
+def stop_names(pages) -> dict:
+    """Reads pages of /stops into a dict of stop ID to name"""
+    names = {}
+    for page in pages:
+        names.update((s['id'], s['attributes']['name']) for s in page['data'])
+    return names
+
+
+def stop_df(pages, trip_to_route: dict) -> (pd.DataFrame, dict):
+    """Reads pages of /schedules?include=stop for the representative trips in trip_to_route
+
+    :return: tuple of a DataFrame with the same columns as datamanager.build_stop_df, and a dict of route ID to the
+        IDs of the stops it serves in the order they're served
+    """
+    route_to_stops = {}
+    names, locations = {}, {}
+    for page in pages:
+        for i in page.get('included', ()):
+            if i['type'] == 'stop':
+                names[i['id']] = i['attributes']['name']
+                locations[i['id']] = [i['attributes']['longitude'], i['attributes']['latitude']]
+        for s in page['data']:
+            route = trip_to_route.get(s['relationships']['trip']['data']['id'])
+            if route is not None:
+                # dict rather than set to keep the order
+                route_to_stops.setdefault(route, {})[s['relationships']['stop']['data']['id']] = None
+
+    return stop_frame({r: list(stops) for r, stops in route_to_stops.items()}, names, locations)
+
+
+def stop_frame(route_to_stops: dict, names: dict, locations: dict) -> (pd.DataFrame, dict):
+    """Builds the stops DataFrame from the stops each route serves, leaving out stops without a name or location
+
+    :param route_to_stops: dict of route ID to the IDs of the stops it serves in order
+    :param names: dict of stop ID to name
+    :param locations: dict of stop ID to [lng, lat]
+    :return: tuple of the DataFrame, with the same columns as datamanager.build_stop_df, and route_to_stops
+    """
+    routes_served = {}
+    for route, stops in route_to_stops.items():
+        for stop in stops:
+            routes_served.setdefault(stop, []).append(route)
+    # highest priority first since that's the route a stop is colored for, like Stop.add_route
+    for stop, routes in routes_served.items():
+        routes.sort(key=get_priority, reverse=True)
+        routes_served[stop] = [silver_line_route_names.get(r, r) for r in routes]
+
+    ids = [s for s in routes_served if s in names and s in locations]
+    df = pd.DataFrame({
+        'name': [names[s] for s in ids],
+        'label': [STOP_LABEL.format(names[s]) for s in ids],
+        'id': ids,
+        'location': [locations[s] for s in ids],
+        'routes_served': [routes_served[s] for s in ids],
+        'color': [update_color(routes_served[s]) for s in ids],
+    })
+    return df, route_to_stops
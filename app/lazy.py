@@ -0,0 +1,27 @@
+"""Deferred imports of the heavy libraries (pandas, numpy, pydeck and the HTTP clients), so starting an instance only
+costs importing Flask and the app's own modules, and the rest is paid by whatever first needs it. On App Engine that's
+the warmup request (see main.warmup) rather than the first visitor. bench/bench_startup.py measures all of it.
+
+    pd = lazy_import('pandas')
+
+binds a stand-in that imports pandas the first time any attribute of it is used, then takes on all of the real
+module's attributes so later uses cost the same as with a plain import. Modules using this need
+`from __future__ import annotations`, otherwise their annotations (pd.DataFrame, ...) use it on import.
+"""
+import importlib
+import types
+
+
+class LazyModule(types.ModuleType):
+    def __getattr__(self, attr: str):
+        # only called for attributes that aren't there yet, i.e. until the module's been imported. The import system
+        # has its own locks, so threads getting here at once all wait on the one import.
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """A stand-in for module name that imports it when it's first used, see the module docstring. Only the module
+    importing it sees the stand-in, everything else still gets the real one from sys.modules."""
+    return LazyModule(name)
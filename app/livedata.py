@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+
+from lazy import lazy_import
+from metrics import cache_requests
+from spatial import PointSet
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+logger = logging.getLogger(__name__)
+
+
+_generations = itertools.count(1)
+# generations only mean something within one process, so anything handed to clients is prefixed with this
+INSTANCE_ID = uuid.uuid4().hex[:8]
+
+
+class VehicleSnapshot:
+    """Every vehicle (with its prediction labels) on every route at one point in time, indexed by route ID.
+
+    One snapshot covers all the routes the app knows about, so each map type is just a filter over it rather than
+    its own upstream query. Snapshots are shared between requests and shouldn't be modified.
+
+    :param df: Vehicles DataFrame, see datamanager.build_vehicle_df
+    :param previous: The snapshot this one replaces. If nothing has changed since then the generation is kept, so
+        clients holding the previous one can be told nothing's changed.
+    """
+    def __init__(self, df: pd.DataFrame, previous: 'VehicleSnapshot' = None):
+        self.df = df.reset_index(drop=True)
+        self.rows_by_route = dict(self.df.groupby('route_id').indices)
+        self.index = PointSet(self.df['location'])
+
+        content = self.df[['vehicle_id', 'location', 'bearing', 'color', 'label']].values.tolist()
+        self.digest = hashlib.blake2b(json.dumps(content).encode(), digest_size=16).hexdigest()
+
+        if previous is not None and previous.digest == self.digest:
+            self.generation = previous.generation
+        else:
+            # increases every time the vehicles change
+            self.generation = next(_generations)
+        self.etag = f'{INSTANCE_ID}.{self.generation}'
+
+    def rows(self, route_ids) -> np.ndarray:
+        """Positions in df of the vehicles on route_ids"""
+        rows = [self.rows_by_route[r] for r in route_ids if r in self.rows_by_route]
+        if len(rows) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.sort(np.concatenate(rows))
+
+    def for_routes(self, route_ids) -> pd.DataFrame:
+        return self.df.iloc[self.rows(route_ids)]
+
+    def in_view(self, route_ids, bbox) -> pd.DataFrame:
+        """The vehicles on route_ids inside bbox, see spatial.PointSet.query"""
+        rows = np.intersect1d(self.index.query(bbox), self.rows(route_ids), assume_unique=True)
+        return self.df.iloc[rows]
+
+
+class _Entry:
+    __slots__ = ('value', 'fetched_at')
+
+    def __init__(self, value, fetched_at: float):
+        self.value = value
+        self.fetched_at = fetched_at
+
+
+class SnapshotCache:
+    """Keyed cache of live data snapshots, shared by every request in the process.
+
+    Fetches are single-flight: while a key is being fetched, other requests for it wait on that fetch instead of
+    starting their own. Values younger than ttl are served as-is. Values older than ttl but younger than max_stale
+    are still served straight away while one background fetch refreshes them (stale-while-revalidate). Anything
+    older, or a key that was never fetched, blocks until a fetch completes.
+
+    The same cache can also be read from a coroutine with aget, which shares entries and in-flight fetches with
+    get, so sync and async callers never fetch the same key twice.
+
+    :param fetch: Callable taking a key and returning the value to cache for it
+    :param ttl: Seconds a value is considered fresh
+    :param max_stale: Seconds a value may still be served while it's being refreshed
+    :param fetch_async: Optional coroutine function used instead of fetch by aget. Without one, aget runs fetch in a
+        thread.
+    :param name: What the cache's lookups are labelled with in metrics.cache_requests
+    """
+    def __init__(self, fetch, ttl: float = 10, max_stale: float = 60, fetch_async=None, name: str = 'snapshot'):
+        self._fetch = fetch
+        self.name = name
+        self._fetch_async = fetch_async
+        self.ttl = ttl
+        self.max_stale = max(max_stale, ttl)
+
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._inflight = {}
+        # fetches started by aget, referenced so they aren't garbage collected while running
+        self._tasks = set()
+
+    def _claim(self, key) -> (_Entry | None, Future | None, bool, bool):
+        # Returns the current entry, and if it isn't fresh, the future of the fetch to wait on, whether the caller
+        # is the one who has to run that fetch, and whether the entry may be served in the meantime
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry.fetched_at < self.ttl:
+                cache_requests.inc(self.name, 'fresh')
+                return entry, None, False, True
+
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                # marked running so it can't be cancelled, e.g. by asyncio.wrap_future when a waiter is
+                future.set_running_or_notify_cancel()
+                self._inflight[key] = future
+
+        servable = entry is not None and now - entry.fetched_at < self.max_stale
+        cache_requests.inc(self.name, 'stale' if servable else 'miss')
+        return entry, future, leader, servable
+
+    def get(self, key):
+        entry, future, leader, servable = self._claim(key)
+        if future is None:
+            return entry.value
+
+        if servable:
+            if leader:
+                threading.Thread(target=self._refresh, args=(key, future), name='snapshot-refresh',
+                                 daemon=True).start()
+            return entry.value
+
+        if leader:
+            self._refresh(key, future)
+        return future.result()
+
+    async def aget(self, key):
+        entry, future, leader, servable = self._claim(key)
+        if future is None:
+            return entry.value
+
+        if leader:
+            # run as its own task so a request going away (and being cancelled) doesn't cancel the fetch for
+            # everyone else waiting on it
+            task = asyncio.create_task(self._arefresh(key, future))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        if servable:
+            return entry.value
+        # the fetch may be running in another thread (from get) so wait on it without blocking the loop
+        return await asyncio.wrap_future(future)
+
+    def peek(self, key):
+        """Returns the cached value for key however old it is, or None, without fetching"""
+        entry = self._entries.get(key)
+        return entry.value if entry is not None else None
+
+    def _refresh(self, key, future: Future):
+        try:
+            value = self._fetch(key)
+        except BaseException as err:
+            logger.warning('Failed to refresh snapshot for %s: %s', key, err)
+            future.set_exception(err)
+        else:
+            with self._lock:
+                self._entries[key] = _Entry(value, time.monotonic())
+            future.set_result(value)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    async def _arefresh(self, key, future: Future):
+        try:
+            if self._fetch_async is not None:
+                value = await self._fetch_async(key)
+            else:
+                value = await asyncio.to_thread(self._fetch, key)
+        except BaseException as err:
+            logger.warning('Failed to refresh snapshot for %s: %s', key, err)
+            future.set_exception(err)
+        else:
+            with self._lock:
+                self._entries[key] = _Entry(value, time.monotonic())
+            future.set_result(value)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
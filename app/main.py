@@ -1,23 +1,19 @@
 import sys
+import time
 import flask
 from flask import Flask, render_template, request
 from markupsafe import escape
-from mapping import generate_map
-from mbta import rapid_routes, commuter_routes, silver_line_routes, bus_routes
+from mapping import (INITIAL_ZOOM, generate_map, generate_positions_json, generate_shapes_json, generate_vehicles_json,
+                     generate_view_json, get_vehicles_etag, warm_up)
+from simplify import SHAPE_ZOOMS
+from datamanager import VEHICLE_POSITION_SECONDS, VEHICLE_TTL_SECONDS, get_vehicle_snapshot, static_data, tune_gc
+from maptypes import get_routes, map_types, parse_view_args
+from mbta import ICON_URL
+from metrics import CONTENT_TYPE, exposition, profiler, request_seconds
 
 app = Flask(__name__)
 
 
-map_types = {
-    'rapid',
-    'commuter',
-    'silver',
-    'busses',
-    'trains',
-    'all',
-}
-
-
 @app.route('/')
 def index():
     return render_template('index.html', base_url=request.root_url)
@@ -28,25 +24,155 @@ def map_page(map_type: str):
     map_type = escape(map_type).lower()
     if map_type not in map_types:
         # invalid type, redirect home
-        flask.redirect(flask.url_for('index'), base_url=request.root_url)
+        return flask.redirect(flask.url_for('index'))
+
+    routes = get_routes(map_type)
+    # one snapshot for both the ETag and the page, since the generation the page polls from with ?since= has to be
+    # the one its vehicles came from
+    snapshot = get_vehicle_snapshot()
+
+    # The page only changes when the static data or the vehicles do, so browsers can revalidate it cheaply
+    generation = get_vehicles_etag(routes, snapshot)
+    etag = f'{map_type}.{static_data.get().version}.{generation}'
+    if request.if_none_match.contains(etag):
+        return _not_modified(etag)
+
+    response = flask.make_response(render_template('map.html', iframe=generate_map(routes, snapshot),
+                                                   base_url=request.root_url, map_type=map_type,
+                                                   generation=generation, refresh_ms=int(VEHICLE_TTL_SECONDS * 1000),
+                                                   positions_ms=int(VEHICLE_POSITION_SECONDS * 1000),
+                                                   icon_url=ICON_URL, shape_zooms=list(SHAPE_ZOOMS),
+                                                   initial_zoom=INITIAL_ZOOM))
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/api/vehicles/<map_type>')
+def vehicles_api(map_type: str):
+    """Current vehicles for a map type as JSON. Pass ?since=<generation> to only get what's changed since then,
+    the response is a 304 if nothing has."""
+    map_type = escape(map_type).lower()
+    if map_type not in map_types:
+        flask.abort(404)
+
+    routes = get_routes(map_type)
+    since = request.args.get('since')
+
+    etag = get_vehicles_etag(routes)
+    if since == etag or request.if_none_match.contains(etag):
+        return _not_modified(etag)
+
+    generation, feed = generate_vehicles_json(routes, since=since)
+    response = flask.Response(feed, mimetype='application/json')
+    response.set_etag(generation)
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/api/positions/<map_type>')
+def positions_api(map_type: str):
+    """Where the vehicles for a map type are now, moved along their routes since the last snapshot. Only vehicles
+    that were moved are included."""
+    map_type = escape(map_type).lower()
+    if map_type not in map_types or VEHICLE_POSITION_SECONDS <= 0:
+        flask.abort(404)
+
+    response = flask.Response(generate_positions_json(get_routes(map_type)), mimetype='application/json')
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/api/shapes/<map_type>')
+def shapes_api(map_type: str):
+    """The route shapes for a map type simplified for ?zoom= as JSON, for the map page to swap in more (or less)
+    detailed lines as it's zoomed"""
+    map_type = escape(map_type).lower()
+    if map_type not in map_types:
+        flask.abort(404)
+    try:
+        zoom = float(request.args.get('zoom', INITIAL_ZOOM))
+    except ValueError:
+        flask.abort(400)
+
+    etag, feed = generate_shapes_json(get_routes(map_type), zoom)
+    if request.if_none_match.contains(etag):
+        return _not_modified(etag)
+
+    response = flask.Response(feed, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/api/view/<map_type>')
+def view_api(map_type: str):
+    """The stops and vehicles for a map type inside ?bbox=west,south,east,north as JSON, with stops thinned out for
+    ?zoom= if it's given"""
+    map_type = escape(map_type).lower()
+    if map_type not in map_types:
+        flask.abort(404)
+    try:
+        bbox, zoom = parse_view_args(request.args)
+    except ValueError:
+        flask.abort(400)
+
+    response = flask.Response(generate_view_json(get_routes(map_type), bbox, zoom), mimetype='application/json')
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/_ah/warmup')
+def warmup():
+    """App Engine sends this to new instances before routing traffic to them (see inbound_services in app.yaml), so
+    the static data, pages and vehicles are ready by the time the first visitor gets there"""
+    return flask.jsonify(warm_up([get_routes(m) for m in sorted(map_types)]))
+
+
+@app.before_request
+def start_request_timer():
+    flask.g.started = time.perf_counter()
+    # see metrics.Profiler, off unless MBTA_PROFILE_RATE is set
+    flask.g.profiled = profiler.sample()
+    if flask.g.profiled:
+        profiler.start()
+
+
+@app.after_request
+def record_request_time(response: flask.Response) -> flask.Response:
+    if 'started' in flask.g:
+        request_seconds.observe(time.perf_counter() - flask.g.started, request.endpoint or 'none',
+                                str(response.status_code))
+    return response
+
+
+@app.teardown_request
+def stop_profiler(_err=None):
+    if flask.g.get('profiled'):
+        profiler.stop()
+        flask.g.profiled = False
+
+
+@app.route('/metrics')
+def metrics_page():
+    """Timings and counters of the app's stages, upstream requests and caches for Prometheus to scrape, see
+    metrics.py"""
+    return flask.Response(exposition(), content_type=CONTENT_TYPE)
+
 
-    match map_type:
-        case 'rapid':
-            routes = silver_line_routes + rapid_routes
-        case 'commuter':
-            routes = commuter_routes
-        case 'silver':
-            routes = silver_line_routes
-        case 'busses':
-            routes = bus_routes
-        case 'trains':
-            routes = commuter_routes + rapid_routes
-        case 'all':
-            routes = commuter_routes + silver_line_routes + rapid_routes
+@app.route('/metrics/profile')
+def profile_page():
+    """Collapsed stacks sampled from profiled requests so far, for flamegraph.pl or speedscope"""
+    if not profiler.enabled:
+        flask.abort(404)
+    return flask.Response(profiler.collapsed(), mimetype='text/plain')
 
-        # no default since this should be unreachable
 
-    return render_template('map.html', iframe=generate_map(routes), base_url=request.root_url)
+def _not_modified(etag: str) -> flask.Response:
+    response = flask.Response(status=304)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
 
 
 if __name__ == '__main__':
@@ -54,4 +180,5 @@ if __name__ == '__main__':
         debug = True
     else:
         debug = False
+    tune_gc()
     app.run(host='127.0.0.1', port=8080, debug=debug)
@@ -1,14 +1,77 @@
-import pydeck as pdk
+from __future__ import annotations
+
+import json
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
 
 from datamanager import *
+from deadreckoning import Motion, Tracks, stop_locations
+from lazy import lazy_import
+from metrics import cache_requests, timed
+from simplify import level_for_zoom
+from spatial import PointSet
+
+np = lazy_import('numpy')
+polyline = lazy_import('polyline')
+pdk = lazy_import('pydeck')
+_json_tools = lazy_import('pydeck.bindings.json_tools')
+_pdk_html = lazy_import('pydeck.io.html')
+
+logger = logging.getLogger(__name__)
+
+# Zoom the maps open at
+INITIAL_ZOOM = 10
+
+# Stands in for the vehicle layer in the cached page, see _get_base_page
+_VEHICLE_LAYER_MARKER = '@@vehicles@@'
+# Columns of the vehicles DataFrame only used for moving vehicles (see deadreckoning.py), left out of the layer since
+# the page doesn't use them and a null speed would be sent as NaN
+_MOTION_COLUMNS = ['speed', 'current_status', 'updated_at']
+
+# (route IDs, static data version) -> (html before the vehicle layer, html after it)
+_base_pages = {}
+_base_pages_lock = threading.Lock()
+
+# (route IDs, static data version, simplified level) -> (etag, JSON of the shapes as encoded polylines)
+_shape_feeds = {}
+
+# (route IDs, static data version) -> _StopView
+_stop_views = {}
+_stop_views_lock = threading.Lock()
+
+# route IDs -> OrderedDict of snapshot etag -> _VehicleFeed, oldest first
+_vehicle_feeds = {}
+_vehicle_feeds_lock = threading.Lock()
+# how many past snapshots to keep per set of routes so clients can be sent just what's changed
+_FEED_HISTORY = 12
+
+# (snapshot etag, static data version) -> deadreckoning.Motion of the latest snapshots, oldest first
+_motions = OrderedDict()
+_motions_lock = threading.Lock()
+# static data version -> deadreckoning.Tracks
+_tracks = {}
+# route IDs -> (snapshot etag, tick, JSON of where its vehicles are at that tick), see generate_positions_json
+_position_feeds = {}
 
 
-def build_lines_layer(route_ids: list) -> pdk.Layer:
-    routes_df = fetch_shapes(route_ids)
+def _round_path(path: np.ndarray) -> list:
+    # 5 decimal places is about a meter, and serializes a lot shorter than the full float
+    return np.round(path.astype(np.float64), 5).tolist()
+
+
+def build_lines_layer(route_ids: list, zoom: float = INITIAL_ZOOM) -> pdk.Layer:
+    # Shapes are drawn at the level simplified for the zoom rather than at full resolution, see simplify.py. The
+    # page swaps in more detailed levels from generate_shapes_json as it's zoomed in.
+    data = [{'label': l, 'color': c, 'path': _round_path(p)}
+            for l, c, p in fetch_shapes(route_ids, level_for_zoom(zoom))]
 
     path_layer = pdk.Layer(
         type='PathLayer',
-        data=routes_df,
+        id='lines',
+        data=data,
         pickable=True,
         get_color='color',
         width_scale=20,
@@ -30,6 +93,7 @@ def build_stops_layer(route_ids: list) -> pdk.Layer:
     stops_layer = pdk.Layer(
         'ScatterplotLayer',
         stops_df,
+        id='stops',
         pickable=True,
         opacity=1,
         stroked=True,
@@ -46,12 +110,15 @@ def build_stops_layer(route_ids: list) -> pdk.Layer:
     return stops_layer
 
 
-def build_vehicles_layer(route_ids: list) -> pdk.Layer:
-    vehicles_df = get_predictions(build_vehicle_df(route_ids))
+@timed('build_vehicles_layer')
+def build_vehicles_layer(route_ids: list, snapshot: VehicleSnapshot = None) -> pdk.Layer:
+    vehicles_df = fetch_vehicles(route_ids) if snapshot is None else snapshot.for_routes(route_ids)
+    vehicles_df = vehicles_df.drop(columns=_MOTION_COLUMNS)
 
     vehicles_layer = pdk.Layer(
         'IconLayer',
         vehicles_df,
+        id='vehicles',
         get_position='location',
         get_icon='icon',
         size_min_pixels=10,
@@ -115,14 +182,298 @@ def build_vehicles_layer(route_ids: list) -> pdk.Layer:
 #     return text_layer
 
 
-def generate_map(routes: list):
-    layers = [build_lines_layer(routes), build_stops_layer(routes), build_vehicles_layer(routes)]
-
+def _build_deck(layers: list) -> pdk.Deck:
     view = pdk.View(type="MapView", controller='true', height="80%", width="100%")
 
-    initial_view_state = pdk.ViewState(latitude=42.34946811943323, longitude=-71.06381901438351, zoom=10, bearing=0,
-                                       pitch=0)
+    initial_view_state = pdk.ViewState(latitude=42.34946811943323, longitude=-71.06381901438351, zoom=INITIAL_ZOOM,
+                                       bearing=0, pitch=0)
 
-    deck = pdk.Deck(layers=layers, views=[view], initial_view_state=initial_view_state, tooltip={"html": "{label}"},
+    return pdk.Deck(layers=layers, views=[view], initial_view_state=initial_view_state, tooltip={"html": "{label}"},
                     height=400)
-    return deck.to_html(as_string=True)
+
+
+def _to_json(o) -> str:
+    # Same as pydeck's to_json but without the indentation, which is more than half of what it outputs
+    return json.dumps(o, sort_keys=True, default=_json_tools.default_serialize, separators=(',', ':'))
+
+
+@timed('render_deck')
+def _render_deck(deck: pdk.Deck) -> str:
+    # same as deck.to_html(as_string=True)
+    return _pdk_html.render_json_to_html(_to_json(deck), mapbox_key=deck.mapbox_key,
+                                         google_maps_key=deck.google_maps_key, tooltip=deck._tooltip,
+                                         custom_libraries=pdk.settings.custom_libraries,
+                                         configuration=pdk.settings.configuration)
+
+
+def _get_base_page(routes: list) -> (str, str):
+    # The lines and stops only change with the static data, and serializing their thousands of coordinates is most of
+    # the work of rendering a map, so the page is rendered once per set of routes with a placeholder where the
+    # vehicle layer goes. Requests then only have to serialize the vehicles and splice them in.
+    key = (tuple(routes), static_data.get().version)
+    page = _base_pages.get(key)
+    if page is not None:
+        cache_requests.inc('base_page', 'hit')
+        return page
+    cache_requests.inc('base_page', 'miss')
+
+    with _base_pages_lock:
+        page = _base_pages.get(key)
+        if page is None:
+            deck = _build_deck([build_lines_layer(routes), build_stops_layer(routes), _VEHICLE_LAYER_MARKER])
+            prefix, suffix = _render_deck(deck).split(f'"{_VEHICLE_LAYER_MARKER}"')
+            page = (prefix, suffix)
+
+            # drop pages built from older static data
+            for k in [k for k in _base_pages if k[0] == key[0]]:
+                del _base_pages[k]
+            _base_pages[key] = page
+
+    return page
+
+
+@timed('generate_map')
+def generate_map(routes: list, snapshot: VehicleSnapshot = None):
+    # Callers that already have a snapshot (the ASGI app, which fetches it without blocking, and the Flask app, which
+    # takes its ETag from the same one) can pass it in. Building the layer is cheap once the snapshot's fetched, so it's
+    # done inline rather than handing it to another thread.
+    prefix, suffix = _get_base_page(routes)
+    return f'{prefix}{_to_json(build_vehicles_layer(routes, snapshot))}{suffix}'
+
+
+class _VehicleFeed:
+    __slots__ = ('etag', 'records', 'json')
+
+    def __init__(self, etag: str, records: dict):
+        self.etag = etag
+        # vehicle ID -> record sent to clients
+        self.records = records
+        self.json = _dumps({'generation': etag, 'vehicles': list(records.values())})
+
+
+def _dumps(o) -> str:
+    return json.dumps(o, separators=(',', ':'))
+
+
+def _get_vehicle_feed(routes: list, snapshot: VehicleSnapshot = None) -> (_VehicleFeed, OrderedDict):
+    if snapshot is None:
+        snapshot = get_vehicle_snapshot()
+    key = tuple(routes)
+
+    history = _vehicle_feeds.get(key)
+    if history is not None and snapshot.etag in history:
+        cache_requests.inc('vehicle_feed', 'hit')
+        return history[snapshot.etag], history
+    cache_requests.inc('vehicle_feed', 'miss')
+
+    df = snapshot.for_routes(routes)
+    records = {
+        v: {'id': v, 'location': [round(loc[0], 6), round(loc[1], 6)], 'bearing': b, 'icon': get_icon_name(c),
+            'label': l}
+        for v, loc, b, c, l in zip(df['vehicle_id'], df['location'], df['bearing'], df['color'], df['label'])
+    }
+    feed = _VehicleFeed(snapshot.etag, records)
+
+    with _vehicle_feeds_lock:
+        history = _vehicle_feeds.setdefault(key, OrderedDict())
+        history[feed.etag] = feed
+        while len(history) > _FEED_HISTORY:
+            history.popitem(last=False)
+
+    return feed, history
+
+
+def get_vehicles_etag(routes: list, snapshot: VehicleSnapshot = None) -> str:
+    return _get_vehicle_feed(routes, snapshot)[0].etag
+
+
+@timed('generate_vehicles_json')
+def generate_vehicles_json(routes: list, since: str = None, snapshot: VehicleSnapshot = None) -> (str, str):
+    """Returns just the vehicles for a set of routes as compact JSON, for the map page to refresh its vehicle layer
+    from without reloading everything else. Icons are sent as the name of their color rather than the full icon
+    definition the IconLayer uses, see mbta.get_icon_name.
+
+    :param routes: Route IDs to include vehicles for
+    :param since: Optionally the generation the client already has. If it's recent enough, only the vehicles that
+        were added, updated or removed since then are returned.
+    :param snapshot: Optionally the VehicleSnapshot to use rather than the current one
+    :return: tuple of the current generation and the JSON
+    """
+    feed, history = _get_vehicle_feed(routes, snapshot)
+
+    old = history.get(since) if since is not None else None
+    if old is None or old is feed:
+        return feed.etag, feed.json
+
+    added = [r for k, r in feed.records.items() if k not in old.records]
+    updated = [r for k, r in feed.records.items() if k in old.records and old.records[k] != r]
+    removed = [k for k in old.records if k not in feed.records]
+    return feed.etag, _dumps({'generation': feed.etag, 'since': since, 'added': added, 'updated': updated,
+                              'removed': removed})
+
+
+def _get_motion(snapshot: VehicleSnapshot) -> Motion:
+    # Vehicles are projected onto their routes once per snapshot, requests only move them along from there
+    data = static_data.get()
+    key = (snapshot.etag, data.version)
+    motion = _motions.get(key)
+    if motion is not None:
+        return motion
+
+    with _motions_lock:
+        motion = _motions.get(key)
+        if motion is None:
+            tracks = _tracks.get(data.version)
+            if tracks is None:
+                tracks = Tracks(data.shapes, stops=stop_locations(data.stops, data.route_to_stops))
+                _tracks.clear()
+                _tracks[data.version] = tracks
+            # the one before is kept for the speeds it can be used to estimate
+            previous = next(reversed(_motions.values()), None)
+            motion = Motion(snapshot.df, tracks, previous=previous, now=time.time())
+            _motions[key] = motion
+            while len(_motions) > 2:
+                _motions.popitem(last=False)
+
+    return motion
+
+
+@timed('generate_positions_json')
+def generate_positions_json(routes: list, now: float = None, snapshot: VehicleSnapshot = None) -> str:
+    """Returns where the moving vehicles on a set of routes are now as JSON, having been moved along their routes
+    since they were last seen (see deadreckoning.py), for the map page to move them with between refreshes. Times
+    are rounded down to VEHICLE_POSITION_SECONDS so every request in the same tick gets the same JSON.
+
+    :param routes: Route IDs to include vehicles for
+    :param now: Time as float seconds since the epoch, defaults to the current time
+    :param snapshot: Optionally the VehicleSnapshot to use rather than the current one
+    :return: JSON with the generation of the snapshot the vehicles were moved on from and [id, lng, lat, bearing] of
+        each one that was moved
+    """
+    if snapshot is None:
+        snapshot = get_vehicle_snapshot()
+    key = tuple(routes)
+    tick = math.floor((now if now is not None else time.time()) / VEHICLE_POSITION_SECONDS)
+
+    feed = _position_feeds.get(key)
+    if feed is not None and feed[0] == snapshot.etag and feed[1] == tick:
+        return feed[2]
+
+    rows = snapshot.rows(routes)
+    at = tick * VEHICLE_POSITION_SECONDS
+    locations, bearings, moving = _get_motion(snapshot).positions(at, rows)
+    ids = snapshot.df['vehicle_id'].to_numpy()[rows[moving]]
+    positions = [[v, round(lng, 6), round(lat, 6), round(b)]
+                 for v, (lng, lat), b in zip(ids, locations[moving].tolist(), bearings[moving].tolist())]
+    feed = (snapshot.etag, tick, _dumps({'generation': snapshot.etag, 'at': at, 'vehicles': positions}))
+    _position_feeds[key] = feed
+    return feed[2]
+
+
+class _StopView:
+    __slots__ = ('records', 'index')
+
+    def __init__(self, df: pd.DataFrame):
+        # the records sent to clients, in the same order as the index's points
+        self.records = [{'id': i, 'name': n, 'location': loc, 'color': list(c), 'routes': r}
+                        for i, n, loc, c, r in zip(df['id'], df['name'], df['location'], df['color'],
+                                                   df['routes_served'])]
+        # stops on more important (and more) routes are kept when thinning, e.g. subway stations over bus stops
+        priority = [get_priority(r[0]) * 1000 + len(r) for r in df['routes_served']]
+        self.index = PointSet(df['location'], priority=priority)
+
+
+def _get_stop_view(routes: list) -> _StopView:
+    # Same idea as _get_base_page, the stops for a set of routes are indexed once per static data version
+    key = (tuple(routes), static_data.get().version)
+    view = _stop_views.get(key)
+    if view is not None:
+        return view
+
+    with _stop_views_lock:
+        view = _stop_views.get(key)
+        if view is None:
+            view = _StopView(fetch_stops(routes))
+            for k in [k for k in _stop_views if k[0] == key[0]]:
+                del _stop_views[k]
+            _stop_views[key] = view
+
+    return view
+
+
+@timed('generate_view_json')
+def generate_view_json(routes: list, bbox, zoom: float = None, snapshot: VehicleSnapshot = None) -> str:
+    """Returns just the stops and vehicles for a set of routes inside a bounding box as JSON, with stops thinned
+    out for the zoom (see spatial.PointSet), so clients zoomed in on one area don't get sent the whole network.
+    Vehicles are in the same format as in generate_vehicles_json.
+
+    :param routes: Route IDs to include stops and vehicles for
+    :param bbox: (west, south, east, north) in degrees
+    :param zoom: Optionally the map's zoom, otherwise every stop in bbox is returned
+    :param snapshot: Optionally the VehicleSnapshot to use rather than the current one
+    """
+    if snapshot is None:
+        snapshot = get_vehicle_snapshot()
+    view = _get_stop_view(routes)
+    feed, _ = _get_vehicle_feed(routes, snapshot)
+
+    stops = [view.records[i] for i in view.index.query(bbox, zoom)]
+    vehicles = [feed.records[v] for v in snapshot.in_view(routes, bbox)['vehicle_id'] if v in feed.records]
+    return _dumps({'generation': feed.etag, 'bbox': list(bbox), 'zoom': zoom, 'stops': stops, 'vehicles': vehicles})
+
+
+def generate_shapes_json(routes: list, zoom: float) -> (str, str):
+    """Returns the shapes for a set of routes simplified for a zoom as JSON, with each path as an encoded polyline
+    (https://developers.google.com/maps/documentation/utilities/polylinealgorithm) to keep it small
+
+    :param routes: Route IDs to include shapes for
+    :param zoom: Map zoom, the level used is the one from simplify.level_for_zoom
+    :return: tuple of an ETag, which only changes with the static data, and the JSON
+    """
+    level = level_for_zoom(zoom)
+    version = static_data.get().version
+    key = (tuple(routes), version, level)
+    feed = _shape_feeds.get(key)
+    if feed is not None:
+        return feed
+
+    shapes = [{'label': l, 'color': c, 'path': polyline.encode(p[:, ::-1].tolist())}
+              for l, c, p in fetch_shapes(routes, level)]
+    feed = (f'{version}.{level}', _dumps({'zoom': level, 'shapes': shapes}))
+
+    # drop levels built from older static data
+    for k in [k for k in _shape_feeds if k[0] == key[0] and k[1] != version]:
+        _shape_feeds.pop(k, None)
+    _shape_feeds[key] = feed
+    return feed
+
+
+def warm_up(route_sets: list) -> dict:
+    """Does what the first requests for each set of routes would otherwise have to, for warming up an instance before
+    it gets any traffic (see main.warmup): imports the heavy libraries (see lazy.py), loads the static data, builds
+    the base pages and fetches a vehicle snapshot. Failing to fetch the
+    vehicles, e.g. with the API down, is logged and skipped since the rest is still worth having.
+
+    :param route_sets: Route IDs of each map, see maptypes.get_routes
+    :return: dict of each step to the seconds it took
+    """
+    timings = {}
+
+    def step(name: str, f):
+        start = time.perf_counter()
+        result = f()
+        timings[name] = time.perf_counter() - start
+        return result
+
+    step('static_data', static_data.get)
+    step('base_pages', lambda: [_get_base_page(routes) for routes in route_sets if routes])
+    try:
+        snapshot = step('vehicles', get_vehicle_snapshot)
+    except (requests.exceptions.RequestException, KeyError, ValueError) as err:
+        logger.warning('Failed to fetch vehicles while warming up: %s', err)
+        return timings
+
+    step('vehicle_feeds', lambda: [_get_vehicle_feed(routes, snapshot) for routes in route_sets])
+    if VEHICLE_POSITION_SECONDS > 0:
+        step('motion', lambda: _get_motion(snapshot))
+    return timings
@@ -0,0 +1,46 @@
+"""The map types the app serves and the routes each one shows, plus reading the args the view API takes. Shared by
+the Flask app in main.py and the ASGI one in asgi.py."""
+from datamanager import static_data, want_bus_vehicles
+from mbta import commuter_routes, rapid_routes, silver_line_routes
+
+map_types = {
+    'rapid',
+    'commuter',
+    'silver',
+    'busses',
+    'trains',
+    'all',
+}
+
+
+def get_routes(map_type: str) -> list | None:
+    match map_type:
+        case 'rapid':
+            return silver_line_routes + rapid_routes
+        case 'commuter':
+            return commuter_routes
+        case 'silver':
+            return silver_line_routes
+        case 'busses':
+            # bus routes are loaded from the API in the background, so this is empty until that's happened, and their
+            # vehicles are only fetched once a bus map's been asked for
+            want_bus_vehicles()
+            return list(static_data.get().bus_routes)
+        case 'trains':
+            return commuter_routes + rapid_routes
+        case 'all':
+            return commuter_routes + silver_line_routes + rapid_routes
+        case _:
+            return None
+
+
+def parse_view_args(args) -> (tuple, float | None):
+    """Reads bbox=west,south,east,north and an optional zoom from request args
+
+    :raises ValueError: if either is missing or malformed
+    """
+    bbox = tuple(float(x) for x in args.get('bbox', '').split(','))
+    if len(bbox) != 4:
+        raise ValueError('bbox should be west,south,east,north')
+    zoom = args.get('zoom')
+    return bbox, float(zoom) if zoom is not None else None
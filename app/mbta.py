@@ -1,7 +1,21 @@
+from __future__ import annotations
+
 import collections
 import datetime
+import json
 from collections import deque
 
+from lazy import lazy_import
+
+np = lazy_import('numpy')
+
+try:
+    # decodes straight from the response bytes, several times faster than json on big /vehicles and /predictions
+    # responses
+    import orjson
+except ImportError:
+    orjson = None
+
 silver_line_route_names = {
     '741': 'SL1',
     '742': 'SL2',
@@ -36,7 +50,7 @@ commuter_routes = ['CR-Fairmount', 'CR-Fitchburg', 'CR-Worcester', 'CR-Franklin'
                    'CR-Kingston', 'CR-Lowell', 'CR-Middleborough', 'CR-Needham', 'CR-Newburyport', 'CR-Providence',
                    'CR-Foxboro', 'CR-NewBedford']
 silver_line_routes = ['741', '742', '743', '746', '749', '751']
-bus_routes = []  # Includes SL TODO NYI
+# Bus routes (which include the SL) are loaded from the API at runtime, see StaticData.bus_routes
 
 
 def get_color(route: str) -> (int, int, int):
@@ -58,6 +72,31 @@ def get_color(route: str) -> (int, int, int):
                 return (255, 199, 44)
 
 
+ICON_URL = 'https://raw.githubusercontent.com/cdfisher/mbta-map/refs/heads/master/app/static/arrow_{}.png'
+# A stop's tooltip, filled in with its name. Used wherever the stops DataFrame is built, see Stop.row.
+STOP_LABEL = '<h3 style="margin:0;padding:0;">{}</h3>'
+
+
+def get_icon_name(color: tuple) -> str:
+    # TODO this approach is a bit messy, clean up
+    match color:
+        # There appear to be two different possible values for color for the Red Line
+        case (255, 0, 0) | (218, 41, 28):
+            return 'red'
+        case (237, 139, 0):
+            return 'orange'
+        case (0, 61, 165):
+            return 'blue'
+        case (0, 132, 61):
+            return 'green'
+        case (128, 39, 108):
+            return 'purple'
+        case (124, 135, 142):
+            return 'silver'
+        case _:
+            return 'yellow'
+
+
 def parse_color(_hex: str) -> tuple:
     """Parse a hex string representation of a color inta an (r: int, g: int, b: int) tuple
 
@@ -104,25 +143,105 @@ def parse_time(t: str) -> datetime.datetime:
     if t is None:
         return None
     # sample time format: 2017-08-14T15:38:58-04:00
-    #  %Y-%B-%dT%H:%M%S%:z
-    # The above isn't supported on all platforms so strip the last colon
-    return datetime.datetime.strptime(f'{t[:22]}{t[23:]}', '%Y-%m-%dT%H:%M:%S%z')
+    # fromisoformat handles this directly and is much faster than strptime, which matters with thousands of
+    # predictions per response
+    return datetime.datetime.fromisoformat(t)
+
+
+def get_countdown_strings(arrival: np.ndarray, departure: np.ndarray, status: np.ndarray, boarding: np.ndarray,
+                          now: float = None) -> np.ndarray:
+    """Vectorized version of Prediction.get_countdown_string, for many predictions at once
+
+    :param arrival: Arrival times as float seconds since the epoch, NaN where there isn't one
+    :param departure: Departure times as float seconds since the epoch, NaN where there isn't one
+    :param status: Prediction status strings, None where there isn't one
+    :param boarding: Whether the vehicle is stopped at the predicted stop
+    :param now: Current time as float seconds since the epoch, defaults to the actual current time
+    :return: Array of countdown strings
+    """
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc).timestamp()
+
+    status = np.asarray(status, dtype=object)
+    t = np.where(np.isnan(arrival), departure, arrival)
+    s = t - now
+
+    m = np.where(s % 60 < 30, s // 60, (s // 60) + 1)
+    m = np.nan_to_num(m).astype(np.int64)
+    minutes = np.char.add(m.astype(str), ' minutes').astype(object)
+
+    # conditions are checked in the same order as in get_countdown_string, first match wins
+    with np.errstate(invalid='ignore'):
+        conditions = [
+            status != None,  # noqa: E711
+            np.isnan(departure),
+            s < 0,
+            (s <= 90) & boarding,
+            s <= 30,
+            s <= 60,
+            m >= 20,
+            m == 1,
+        ]
+    choices = [status, '', '', 'Boarding', 'Arriving', 'Approaching', '20+ minutes', '1 minute']
+    return np.select(conditions, choices, default=minutes)
+
+
+def loads(content: bytes | str) -> dict:
+    """Decode a JSON response body, with orjson if it's installed
+
+    :param content: The raw body, e.g. Response.content
+    :return: The decoded JSON
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def index_included(inc: list) -> dict:
+    """Index the included array of a JSON:API response by (type, id), so related resources can be looked up
+    without scanning it
 
+    :param inc: The 'included' list from a response, may be None
+    :return: dict of (type, id) tuples to resources
+    """
+    if inc is None:
+        return {}
+    return {(i['type'], i['id']): i for i in inc}
+
+
+def get_included(rel: dict, name: str, included: dict) -> dict | None:
+    """Resolve a relationship of a resource through an index built with index_included
+
+    :param rel: The 'relationships' dict of the resource
+    :param name: Name of the relationship, e.g. 'trip'
+    :param included: Index of included resources
+    :return: The related resource, or None if there isn't one or it wasn't included
+    """
+    try:
+        data = rel[name]['data']
+    except KeyError:
+        return None
+    if data is None:
+        return None
+    return included.get((data['type'], data['id']))
 
-def get_vehicle_status_and_stop(vehicle_id: str, d: dict, inc: dict) -> (str | None, str | None):
-    for v in inc:
-        if v['id'] == vehicle_id:
-            _status = v['attributes']['current_status']
-            _stop_data = v['relationships']['stop']['data']
-            status = None if _status is None else _status
-            stop_id = None if _stop_data is None else _stop_data['id']
 
-            return status, stop_id
+def get_vehicle_status_and_stop(vehicle_id: str, d: dict, included: dict) -> (str | None, str | None):
+    v = included.get(('vehicle', vehicle_id))
+    if v is None:
+        return None, None
 
-    return None, None
+    _status = v['attributes']['current_status']
+    _stop_data = v['relationships']['stop']['data']
+    status = None if _status is None else _status
+    stop_id = None if _stop_data is None else _stop_data['id']
+
+    return status, stop_id
 
 
 class Carriage:
+    __slots__ = ('label', 'occupancy_status', 'occupancy_percentage')
+
     def __init__(self, c: dict):
         self.label = c['label']
         self.occupancy_status = c['occupancy_status']
@@ -130,17 +249,31 @@ class Carriage:
 
 
 class Vehicle:
-    def __init__(self, r: dict, headsign='', color=(255, 199, 44)):
+    # there's one of these per vehicle on every refresh, so no per-instance __dict__
+    __slots__ = ('color', 'vehicle_id', 'route_id', 'route', 'trip_id', 'stop', 'bearing', 'carriages',
+                 'carriage_list', 'current_status', 'direction_id', 'location', 'revenue', 'speed', 'updated_at',
+                 'headsign')
+
+    def __init__(self, r: dict, headsign='', color=(255, 199, 44), included: dict = None):
         rel = r['relationships']
         attr = r['attributes']
 
+        if included is not None:
+            # resolve the headsign and color from the included trip and route, see index_included
+            trip = get_included(rel, 'trip', included)
+            route = get_included(rel, 'route', included)
+            headsign = trip['attributes'].get('headsign') if trip is not None else None
+            color = parse_color(route['attributes']['color']) if route is not None and 'color' in route['attributes'] \
+                else None
+
         # This will be set later for all rapid transit and CR vehicles, so defaults to the color for busses
         self.color = color
 
         self.vehicle_id = r['id']
 
         # under relationships
-        self.route = rel['route']['data']['id']  # for instance 'Green-B'
+        self.route_id = rel['route']['data']['id']  # for instance 'Green-B'
+        self.route = self.route_id
         # Handle SL route IDs just being numerical values since the short names are more helpful for those
         if self.route in silver_line_route_names.keys():
             self.route = silver_line_route_names[self.route]
@@ -164,6 +297,9 @@ class Vehicle:
             self.revenue = None
 
         self.speed = attr['speed']  # in m/s, often null
+        # when the location was last updated, which is what vehicles are moved on from between polls, see
+        # deadreckoning.py
+        self.updated_at = parse_time(attr.get('updated_at'))
 
         self.headsign = headsign
 
@@ -171,39 +307,19 @@ class Vehicle:
         # direction_id,revenue_status,speed,updated_at&include=trip.headsign&filter[route]=Red
 
     def carriages_str(self):
-        s = ''
-        for v in range(len(self.carriage_list)):
-            s = f'{s},{self.carriage_list[v]}'
-        return s[1:]
+        return ','.join(map(str, self.carriage_list))
 
     def build_label(self) -> str:
+        carriages = self.carriages_str()
         return f"<h3 style=\"margin:0;padding:0;\">{self.headsign} {'train' if self.route[:2] in ('Re', 'Or', 'Bl', 'Gr', 'CR') else 'bus'}</h3>" \
                f"<h4 style=\"margin:0;padding:0;\">" \
                f"{f'Green Line {self.route[-1]}' if self.route[0:5] == 'Green' else f'{self.route} Line'}</h4><br>" \
-               f"{f'<b>Carriages: </b>{self.carriages_str()}<br>' if len(self.carriages_str()) > 0 else ''}" \
+               f"{f'<b>Carriages: </b>{carriages}<br>' if len(carriages) > 0 else ''}" \
                f"{f'<b>Speed (m/s) : </b>{self.speed}<br>' if self.speed is not None else ''}"
 
     def get_icon(self) -> dict:
-        # TODO this approach is a bit messy, clean up
-        match self.color:
-            # There appear to be two different possible values for color for the Red Line
-            case (255, 0, 0) | (218, 41, 28):
-                color_string = 'red'
-            case (237, 139, 0):
-                color_string = 'orange'
-            case (0, 61, 165):
-                color_string = 'blue'
-            case (0, 132, 61):
-                color_string = 'green'
-            case (128, 39, 108):
-                color_string = 'purple'
-            case (124, 135, 142):
-                color_string = 'silver'
-            case _:
-                color_string = 'yellow'
-
         return {
-            "url": f'https://raw.githubusercontent.com/cdfisher/mbta-map/refs/heads/master/app/static/arrow_{color_string}.png',
+            "url": ICON_URL.format(get_icon_name(self.color)),
             "width": 150,
             "height": 150,
             "anchorY": 75,
@@ -212,10 +328,13 @@ class Vehicle:
     # TODO this may need additional values added
     def row(self) -> list:
         return [self.build_label(), self.location, self.color, self.bearing, self.get_icon(), self.trip_id,
-                self.vehicle_id]
+                self.vehicle_id, self.route_id, self.speed, self.current_status,
+                self.updated_at.timestamp() if self.updated_at is not None else float('nan')]
 
 
 class Stop:
+    __slots__ = ('stop_id', 'routes_served', 'name', 'location')
+
     def __init__(self, s: dict, route=None):
         attr = s['attributes']
 
@@ -257,7 +376,7 @@ class Stop:
             return (255, 199, 44)
 
     def row(self) -> list:
-        return [self.name, f"<h3 style=\"margin:0;padding:0;\">{self.name}</h3>",
+        return [self.name, STOP_LABEL.format(self.name),
                 self.stop_id, self.location, list(self.routes_served), self._get_color()]
 
 
@@ -267,7 +386,10 @@ class Station:
 
 
 class Prediction:
-    def __init__(self, d: dict, inc: dict):
+    __slots__ = ('arrival_time', 'arrival_uncertainty', 'departure_time', 'departure_uncertainty', 'stop_sequence',
+                 'direction_id', 'status', 'stop_id', 'vehicle', 'trip_id', 'vehicle_status', 'vehicle_stop')
+
+    def __init__(self, d: dict, included: dict):
         _attr = d['attributes']
         _rel = d['relationships']
 
@@ -285,7 +407,7 @@ class Prediction:
         self.vehicle = _rel['vehicle']['data']['id']
         self.trip_id = _rel['trip']['data']['id']
 
-        self.vehicle_status, self.vehicle_stop = get_vehicle_status_and_stop(self.vehicle, d, inc)
+        self.vehicle_status, self.vehicle_stop = get_vehicle_status_and_stop(self.vehicle, d, included)
 
     def get_countdown_string(self) -> str:
         # Mostly follows the "Countdown Display Rules" (exceptions noted) here:
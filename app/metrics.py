@@ -0,0 +1,249 @@
+"""Timers and counters for finding which stage of a request is slow under real traffic, served in the Prometheus text
+format at /metrics, plus an opt-in sampling profiler.
+
+Everything is kept in process, so with several workers each one has its own numbers (Prometheus adds them up fine
+when it scrapes each one). Timing a call takes a few microseconds, so it's cheap enough for anything that happens once
+per upstream request or page.
+
+The profiler samples the stack of the thread serving a share of requests (PROFILE_RATE) every PROFILE_INTERVAL
+seconds, and adds them up as collapsed stacks ("outer;inner;innermost count" lines), which is what flamegraph.pl and
+speedscope read. It's served at /metrics/profile. For the ASGI app the thread is the event loop's, so samples taken
+while a profiled request is awaiting something are of whatever else the loop is doing.
+"""
+import bisect
+import functools
+import inspect
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter as _Counter
+from urllib.parse import urlsplit
+
+PREFIX = 'mbta_map_'
+# Share of requests to profile, 0 turns the profiler off, and seconds between samples of a profiled request
+PROFILE_RATE = float(os.getenv('MBTA_PROFILE_RATE', 0))
+PROFILE_INTERVAL = float(os.getenv('MBTA_PROFILE_INTERVAL', 0.005))
+# Most distinct stacks kept, samples of new stacks past this are counted under one catch-all
+PROFILE_MAX_STACKS = 20000
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# 1 KB to 64 MB
+BYTES_BUCKETS = tuple(2 ** i for i in range(10, 27, 2))
+
+_registry = []
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if len(names) == 0:
+        return ''
+    escaped = (str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for v in values)
+    return '{' + ','.join(f'{n}="{v}"' for n, v in zip(names, escaped)) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def expose(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = list(self._values.items())
+        lines += [f'{self.name}{_labels(self.labelnames, k)} {v}' for k, v in sorted(values)]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = SECONDS_BUCKETS):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [count in each bucket (not cumulative, the last is past the biggest bucket), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            v = self._values.get(labels)
+            if v is None:
+                v = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            v[0][i] += 1
+            v[1] += value
+
+    def count(self, *labels) -> int:
+        v = self._values.get(labels)
+        return sum(v[0]) if v is not None else 0
+
+    def expose(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            values = [(k, list(counts), total) for k, (counts, total) in self._values.items()]
+        names = self.labelnames + ('le',)
+        for k, counts, total in sorted(values):
+            cumulative = 0
+            for bound, c in zip(self.buckets + (float('inf'),), counts):
+                cumulative += c
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append(f'{self.name}_bucket{_labels(names, k + (le,))} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, k)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, k)} {cumulative}')
+        return lines
+
+
+stage_seconds = Histogram('stage_seconds', 'Wall time of each stage of building a page or snapshot', ('stage',))
+stage_cpu_seconds = Counter('stage_cpu_seconds_total', 'CPU time of the thread running each stage', ('stage',))
+request_seconds = Histogram('request_seconds', 'Time to serve each request', ('endpoint', 'status'))
+upstream_seconds = Histogram('upstream_seconds', 'Time for each request to the API, retries included', ('path',))
+upstream_requests = Counter('upstream_requests_total', 'Requests to the API by response status', ('path', 'status'))
+upstream_bytes = Histogram('upstream_response_bytes', 'Size of each response body from the API', ('path',),
+                           buckets=BYTES_BUCKETS)
+conditional_requests = Counter('conditional_requests_total',
+                               'Conditional requests to the API, by whether they were 304 Not Modified',
+                               ('path', 'result'))
+cache_requests = Counter('cache_requests_total', 'Lookups in the in-process caches and how they were served',
+                         ('cache', 'result'))
+
+
+def upstream_path(route: str) -> str:
+    """The path of an API route without its query, which is what upstream metrics are labelled with"""
+    return urlsplit(route).path or '/'
+
+
+def observe_upstream(route: str, status, seconds: float, size: int = None):
+    path = upstream_path(route)
+    upstream_seconds.observe(seconds, path)
+    upstream_requests.inc(path, str(status))
+    if size is not None:
+        upstream_bytes.observe(size, path)
+
+
+def timed(stage: str):
+    """Decorator recording the wall time of every call of a function to stage_seconds, and for plain functions the
+    CPU time of its thread to stage_cpu_seconds. Calls that raise are recorded too."""
+    def decorator(f):
+        if inspect.iscoroutinefunction(f):
+            @functools.wraps(f)
+            async def timed_async(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await f(*args, **kwargs)
+                finally:
+                    stage_seconds.observe(time.perf_counter() - start, stage)
+            return timed_async
+
+        @functools.wraps(f)
+        def timed_sync(*args, **kwargs):
+            start, cpu = time.perf_counter(), time.thread_time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                stage_seconds.observe(time.perf_counter() - start, stage)
+                stage_cpu_seconds.inc(stage, amount=time.thread_time() - cpu)
+        return timed_sync
+    return decorator
+
+
+def exposition() -> str:
+    """Every metric in the Prometheus text format"""
+    return '\n'.join(line for metric in _registry for line in metric.expose()) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Profiler:
+    """Samples the stacks of the threads it's been told to profile from a background thread, see the module
+    docstring. The thread is only started once something is profiled.
+
+    :param rate: Share of requests sample picks
+    :param interval: Seconds between samples
+    """
+    def __init__(self, rate: float = PROFILE_RATE, interval: float = PROFILE_INTERVAL):
+        self.rate = rate
+        self.interval = interval
+        self.stacks = _Counter()
+        self.samples = 0
+
+        self._lock = threading.Lock()
+        # thread ID -> how many requests being profiled are on it
+        self._threads = _Counter()
+        self._thread = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def sample(self) -> bool:
+        """Whether to profile a request"""
+        return self.rate > 0 and random.random() < self.rate
+
+    def start(self, thread_id: int = None):
+        with self._lock:
+            self._threads[thread_id or threading.get_ident()] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+                self._thread.start()
+
+    def stop(self, thread_id: int = None):
+        thread_id = thread_id or threading.get_ident()
+        with self._lock:
+            self._threads[thread_id] -= 1
+            if self._threads[thread_id] <= 0:
+                del self._threads[thread_id]
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                threads = [t for t in self._threads if t != me]
+            if len(threads) == 0:
+                continue
+            frames = sys._current_frames()
+            for t in threads:
+                frame = frames.get(t)
+                if frame is not None:
+                    self._add(frame)
+
+    def _add(self, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f'{code.co_name} ({os.path.basename(code.co_filename)})')
+            frame = frame.f_back
+        stack = ';'.join(reversed(names))
+        with self._lock:
+            if stack not in self.stacks and len(self.stacks) >= PROFILE_MAX_STACKS:
+                stack = '(other)'
+            self.stacks[stack] += 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        """Every stack sampled so far and how many times, hottest first"""
+        with self._lock:
+            stacks = self.stacks.most_common()
+        return ''.join(f'{stack} {n}\n' for stack, n in stacks)
+
+    def clear(self):
+        with self._lock:
+            self.stacks.clear()
+            self.samples = 0
+
+
+profiler = Profiler()
@@ -0,0 +1,327 @@
+"""Records the vehicles and predictions responses the app polls from the API, and plays them back in place of the API,
+so what production saw can be run again offline: for load tests, regression benchmarks and chasing bugs that only
+show up with real data. See datamanager.RECORD_DIR and REPLAY_DIR.
+
+A recording is a directory of numbered segment files, each a run of frames:
+
+    [4 byte length][4 byte CRC-32][zlib compressed frame]
+
+and each frame is one snapshot, i.e. every response fetched for one refresh of the vehicles: a JSON header line with
+when it was fetched and each response's route, status and length, then the response bodies end to end. Frames are
+only ever appended to the newest segment, a new one is started once it reaches segment_bytes, and the oldest are
+deleted once the recording is over max_bytes, so it's a ring of the latest snapshots. A frame left half written (by a
+crash, say) is skipped when reading.
+"""
+import bisect
+import contextvars
+import datetime
+import json
+import logging
+import os
+import queue
+import re
+import struct
+import threading
+import time
+import zlib
+from urllib.parse import parse_qs, urlsplit
+
+from mbta import loads
+
+logger = logging.getLogger(__name__)
+
+# Routes that are recorded and replayed, everything else (the static data) still goes to the API
+RECORDED_ROUTES = ('/vehicles', '/predictions')
+
+_FRAME_HEADER = struct.Struct('<II')
+_SEGMENT_SUFFIX = '.seg'
+# ISO 8601 times in response bodies, e.g. "2025-03-27T08:00:00-04:00", see Replay.shift_times
+_TIME = re.compile(rb'"(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(?:[+-]\d\d:\d\d|Z))"')
+
+
+def covers(route: str) -> bool:
+    return route.startswith(RECORDED_ROUTES)
+
+
+def _segments(directory: str) -> list:
+    # Paths of the segments oldest first
+    names = sorted(n for n in os.listdir(directory) if n.endswith(_SEGMENT_SUFFIX))
+    return [os.path.join(directory, n) for n in names]
+
+
+class Snapshot:
+    """One recorded refresh of the vehicles
+
+    :param at: When it was fetched, as float seconds since the epoch
+    :param responses: dict of route to (status, body bytes), in the order they were fetched
+    """
+    __slots__ = ('at', 'responses')
+
+    def __init__(self, at: float, responses: dict):
+        self.at = at
+        self.responses = responses
+
+    def encode(self) -> bytes:
+        header = {'at': self.at, 'routes': list(self.responses),
+                  'statuses': [s for s, _ in self.responses.values()],
+                  'lengths': [len(b) for _, b in self.responses.values()]}
+        return b''.join([json.dumps(header).encode(), b'\n', *(b for _, b in self.responses.values())])
+
+    @classmethod
+    def decode(cls, frame: bytes) -> 'Snapshot':
+        end = frame.index(b'\n')
+        header = json.loads(frame[:end])
+        responses, offset = {}, end + 1
+        for route, status, length in zip(header['routes'], header['statuses'], header['lengths']):
+            responses[route] = (status, frame[offset:offset + length])
+            offset += length
+        return cls(header['at'], responses)
+
+
+def read_frames(directory: str):
+    """Yields (segment path, offset, at) of every intact frame in a recording, oldest first, without decompressing
+    any more than the start of each"""
+    for path in _segments(directory):
+        with open(path, 'rb') as inf:
+            data = inf.read()
+        offset = 0
+        while offset + _FRAME_HEADER.size <= len(data):
+            length, crc = _FRAME_HEADER.unpack_from(data, offset)
+            body = data[offset + _FRAME_HEADER.size:offset + _FRAME_HEADER.size + length]
+            if len(body) < length or zlib.crc32(body) != crc:
+                logger.warning('Skipping the rest of %s from a damaged frame at %s', path, offset)
+                break
+            # the header line is at the start, so only a little of the frame needs inflating to read it
+            start = zlib.decompressobj().decompress(body, 4096)
+            at = json.loads(start[:start.index(b'\n')])['at'] if b'\n' in start else \
+                Snapshot.decode(zlib.decompress(body)).at
+            yield path, offset, at
+            offset += _FRAME_HEADER.size + length
+
+
+def read_snapshot(path: str, offset: int) -> Snapshot:
+    with open(path, 'rb') as inf:
+        inf.seek(offset)
+        length, crc = _FRAME_HEADER.unpack(inf.read(_FRAME_HEADER.size))
+        return Snapshot.decode(zlib.decompress(inf.read(length)))
+
+
+class Recorder:
+    """Appends snapshots to a recording, see the module docstring. Responses are collected between begin and commit
+    and written by a background thread, so recording never holds up a refresh. What's collected is kept per thread
+    or asyncio task (in a ContextVar), so refreshes running at the same time each get a snapshot of their own.
+
+    :param directory: Where the recording is, created if it doesn't exist. Recording carries on after any segments
+        already there.
+    :param max_bytes: Most the recording may take up on disk before the oldest segments are deleted
+    :param segment_bytes: Size each segment is grown to before starting another
+    :param level: zlib compression level
+    """
+    def __init__(self, directory: str, max_bytes: int = 256 * 2 ** 20, segment_bytes: int = 16 * 2 ** 20,
+                 level: int = 6):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = min(segment_bytes, max_bytes)
+        self.level = level
+        os.makedirs(directory, exist_ok=True)
+
+        # route -> (status, body) of the responses collected since begin, or None outside of begin and commit
+        self._pending = contextvars.ContextVar(f'recorder_pending_{id(self)}', default=None)
+        # a few snapshots' worth, so a slow disk drops snapshots rather than piling them up in memory
+        self._queue = queue.Queue(maxsize=4)
+        self._thread = threading.Thread(target=self._run, name='recorder', daemon=True)
+        self._thread.start()
+
+    def begin(self):
+        self._pending.set({})
+
+    def add(self, route: str, status: int, content: bytes):
+        """Adds a response to the snapshot being collected, if it's one that's recorded and one is being collected"""
+        pending = self._pending.get()
+        if pending is not None and covers(route):
+            pending[route] = (status, bytes(content))
+
+    def commit(self, at: float = None):
+        """Queues the responses collected since begin to be written as one snapshot"""
+        responses = self._pending.get()
+        self._pending.set(None)
+        if not responses:
+            return
+        try:
+            self._queue.put_nowait(Snapshot(at if at is not None else time.time(), responses))
+        except queue.Full:
+            logger.warning('Recorder is behind, dropping a snapshot')
+
+    def discard(self):
+        self._pending.set(None)
+
+    def close(self, timeout: float = 10):
+        """Writes out any queued snapshots and stops the writer thread"""
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            snapshot = self._queue.get()
+            if snapshot is None:
+                return
+            try:
+                self._write(snapshot)
+            except OSError:
+                logger.exception('Failed to record snapshot')
+
+    def _write(self, snapshot: Snapshot):
+        body = zlib.compress(snapshot.encode(), self.level)
+        segments = _segments(self.directory)
+        path = segments[-1] if segments else None
+        if path is None or os.path.getsize(path) + len(body) > self.segment_bytes:
+            number = int(os.path.basename(path)[:-len(_SEGMENT_SUFFIX)]) + 1 if path is not None else 1
+            path = os.path.join(self.directory, f'{number:08d}{_SEGMENT_SUFFIX}')
+            segments.append(path)
+        with open(path, 'ab') as outf:
+            outf.write(_FRAME_HEADER.pack(len(body), zlib.crc32(body)) + body)
+
+        # the ring: drop the oldest segments, never the one just written to
+        sizes = [os.path.getsize(p) for p in segments]
+        while len(segments) > 1 and sum(sizes) > self.max_bytes:
+            os.remove(segments.pop(0))
+            sizes.pop(0)
+
+
+class Replay:
+    """Serves the snapshots of a recording in place of the API
+
+    Snapshots are picked at begin, which is called at the start of each refresh so every response of a refresh comes
+    from the same one. With a speed, the one picked is the last recorded before the recording's own clock, which runs
+    that many times faster than real time from when the replay started. With a speed of 0 each refresh gets the next
+    snapshot, so a replay always goes the same way however long refreshes take.
+
+    Routes are looked up as they were recorded. Any that weren't (say the routes are chunked differently than when
+    recording) are answered from all of the snapshot's responses for the same path, filtered and paged the way the API
+    would.
+
+    :param directory: The recording, see Recorder
+    :param speed: How many times faster than real time to play it, or 0 to step through it
+    :param loop: Start over once the end is reached, otherwise the last snapshot keeps being served
+    :param shift_times: Move every time in the responses forward by how long ago the snapshot was recorded, so
+        predictions count down and vehicles move (see deadreckoning.py) like they did live
+    """
+    def __init__(self, directory: str, speed: float = 1, loop: bool = True, shift_times: bool = True):
+        self.frames = list(read_frames(directory))
+        if len(self.frames) == 0:
+            raise ValueError(f'No snapshots recorded in {directory}')
+        self.times = [at for _, _, at in self.frames]
+        self.speed = speed
+        self.loop = loop
+        self.shift_times = shift_times
+
+        self._lock = threading.Lock()
+        self._started = None
+        self._next = 0
+        self._index = None
+        self._snapshot = None
+        self._shift = 0
+        # route -> (status, body) with times shifted, and path -> merged payload, for the current snapshot
+        self._bodies = {}
+        self._merged = {}
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def begin(self, now: float = None):
+        """Moves on to the snapshot for the next refresh"""
+        with self._lock:
+            self._begin(now if now is not None else time.time())
+
+    def _begin(self, now: float):
+        if self.speed > 0:
+            if self._started is None:
+                self._started = now
+            at = self.times[0] + (now - self._started) * self.speed
+            span = self.times[-1] - self.times[0]
+            if self.loop and span > 0:
+                at = self.times[0] + (at - self.times[0]) % span
+            index = max(bisect.bisect_right(self.times, at) - 1, 0)
+        else:
+            index = self._next % len(self.frames) if self.loop else min(self._next, len(self.frames) - 1)
+            self._next += 1
+
+        if index != self._index:
+            path, offset, _ = self.frames[index]
+            self._snapshot = read_snapshot(path, offset)
+            self._index = index
+            self._bodies, self._merged = {}, {}
+        shift = round(now - self._snapshot.at) if self.shift_times else 0
+        if shift != self._shift:
+            self._shift = shift
+            self._bodies, self._merged = {}, {}
+
+    @property
+    def index(self) -> int | None:
+        """Position of the snapshot being served"""
+        return self._index
+
+    def response(self, route: str) -> (dict, int):
+        """The decoded response and status for a route, like datamanager._query_api"""
+        with self._lock:
+            if self._snapshot is None:
+                self._begin(time.time())
+
+            recorded = self._body(route)
+            if recorded is not None:
+                status, body = recorded
+                return (loads(body) if len(body) > 0 else {}), status
+            return self._filtered(route), 200
+
+    def _body(self, route: str) -> tuple | None:
+        recorded = self._bodies.get(route)
+        if recorded is None and route in self._snapshot.responses:
+            status, body = self._snapshot.responses[route]
+            recorded = (status, self._shifted(body))
+            self._bodies[route] = recorded
+        return recorded
+
+    def _shifted(self, body: bytes) -> bytes:
+        if self._shift == 0:
+            return body
+        delta = datetime.timedelta(seconds=self._shift)
+        memo = {}
+
+        def shift(m):
+            t = m.group(1)
+            if t not in memo:
+                memo[t] = b'"' + (datetime.datetime.fromisoformat(t.decode()) + delta).isoformat().encode() + b'"'
+            return memo[t]
+
+        return _TIME.sub(shift, body)
+
+    def _filtered(self, route: str) -> dict:
+        # Answers a route that wasn't recorded from every response for its path, see the class docstring
+        parts = urlsplit(route)
+        merged = self._merged.get(parts.path)
+        if merged is None:
+            data, included = {}, {}
+            for r in self._snapshot.responses:
+                if urlsplit(r).path == parts.path:
+                    j = loads(self._body(r)[1] or b'{}')
+                    data.update(((d['type'], d['id']), d) for d in j.get('data', ()))
+                    included.update(((i['type'], i['id']), i) for i in j.get('included', ()))
+            merged = (list(data.values()), list(included.values()))
+            self._merged[parts.path] = merged
+
+        data, included = merged
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        for k, v in query.items():
+            if k.startswith('filter['):
+                rel, values = k[7:-1], set(v.split(','))
+                data = [d for d in data if (d.get('relationships', {}).get(rel, {}).get('data') or {}).get('id')
+                        in values]
+
+        j = {'data': data, 'included': included, 'jsonapi': {'version': '1.0'}}
+        if 'page[limit]' in query:
+            limit, offset = int(query['page[limit]']), int(query.get('page[offset]', 0))
+            j['data'] = data[offset:offset + limit]
+            j['links'] = {'first': route}
+            if offset + limit < len(data):
+                j['links']['next'] = route
+        return j
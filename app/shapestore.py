@@ -0,0 +1,142 @@
+"""Columnar storage for route shapes.
+
+Shapes used to be a DataFrame with a column of nested [lng, lat] lists, which is slow to pickle, copy and filter, and
+every worker process ended up with its own copy. Here every shape's coordinates are instead laid end to end in one
+float32 array, with an offsets array marking where each shape starts, and the route label and color of each shape are
+kept in small side arrays alongside. Each array is saved as its own .npy file so that they can be opened with
+np.load(mmap_mode='r'), and worker processes then share the same pages of the OS's file cache.
+
+Every level of detail from simplify.py is stored the same way, with FULL being the shapes as the API has them.
+"""
+from __future__ import annotations
+
+import os
+
+import simplify
+from lazy import lazy_import
+from mbta import df_color_sort_order
+
+np = lazy_import('numpy')
+
+# Level holding the shapes at full resolution, the others are the zooms in simplify.SHAPE_ZOOMS
+FULL = 'full'
+
+
+class ShapeStore:
+    """Route shapes in draw order, with each route's shapes next to each other.
+
+    For each level, coords is an (n, 2) float32 array of [lng, lat] pairs and offsets an array of len(self) + 1
+    positions in it, so that shape i is coords[offsets[i]:offsets[i + 1]]. Since a route's shapes are consecutive
+    rows, route_slices gives the rows of any one route as a slice.
+
+    :param labels: Route ID of each shape
+    :param colors: (len(labels), 3) array of each shape's color
+    :param levels: dict of level (FULL or a zoom) to a tuple of (coords, offsets)
+    """
+    def __init__(self, labels: np.ndarray, colors: np.ndarray, levels: dict):
+        self.labels = labels
+        self.colors = colors
+        self.levels = levels
+
+        # first row of each run of labels, and the end of the last one
+        bounds = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1], True]) if len(labels) else np.zeros(1, int)
+        self.route_slices = {str(labels[a]): slice(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:])}
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    @classmethod
+    def from_paths(cls, labels: list, colors: list, paths: list, zooms=simplify.SHAPE_ZOOMS) -> 'ShapeStore':
+        """Builds a store from one path per shape, sorting the shapes into draw order and simplifying them for each
+        zoom in zooms
+
+        :param labels: Route ID of each shape
+        :param colors: RGB tuple of each shape
+        :param paths: Sequence of [lng, lat] pairs for each shape
+        """
+        paths = [np.asarray(p, dtype=np.float64).reshape(-1, 2) for p in paths]
+        order = _draw_order(labels, colors)
+
+        simplified = [simplify.simplify_levels(paths[i], zooms) for i in order]
+        levels = {FULL: _pack([paths[i] for i in order])}
+        for z in zooms:
+            levels[z] = _pack([s[z] for s in simplified])
+
+        return cls(np.array([labels[i] for i in order], dtype=str).reshape(-1),
+                   np.array([colors[i] for i in order], dtype=np.uint8).reshape(-1, 3), levels)
+
+    @classmethod
+    def concat(cls, stores: list) -> 'ShapeStore':
+        """Merges stores with the same levels into one, in draw order"""
+        labels = np.concatenate([s.labels for s in stores])
+        colors = np.concatenate([s.colors for s in stores])
+        order = _draw_order(labels, [tuple(c) for c in colors.tolist()])
+
+        levels = {}
+        for level in stores[0].levels:
+            paths = [p for s in stores for p in s.paths(range(len(s)), level)]
+            levels[level] = _pack([paths[i] for i in order])
+        return cls(labels[order], colors[order], levels)
+
+    def rows(self, route_ids) -> np.ndarray:
+        """Row positions of the shapes of route_ids, in draw order"""
+        # each route's rows are consecutive, so putting the routes in row order keeps the draw order
+        slices = sorted({self.route_slices[r].start: self.route_slices[r] for r in route_ids
+                         if r in self.route_slices}.values(), key=lambda s: s.start)
+        return np.r_[tuple(slices)] if len(slices) else np.zeros(0, dtype=np.int64)
+
+    def path(self, row: int, level=FULL) -> np.ndarray:
+        coords, offsets = self.levels[level]
+        return coords[offsets[row]:offsets[row + 1]]
+
+    def paths(self, rows, level=FULL) -> list:
+        """The coordinates of each shape in rows, as views into the store rather than copies"""
+        coords, offsets = self.levels[level]
+        rows = np.asarray(rows, dtype=np.int64)
+        return [coords[a:b] for a, b in zip(offsets[rows].tolist(), offsets[rows + 1].tolist())]
+
+    def records(self, route_ids, level=FULL) -> list:
+        """(label, color, path) of each shape of route_ids in draw order, with the path at the given level"""
+        rows = self.rows(route_ids)
+        return list(zip(self.labels[rows].tolist(), self.colors[rows].tolist(), self.paths(rows, level)))
+
+    def save(self, directory: str):
+        """Writes each array to its own .npy file in directory, see load"""
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'labels.npy'), self.labels)
+        np.save(os.path.join(directory, 'colors.npy'), self.colors)
+        for level, (coords, offsets) in self.levels.items():
+            np.save(os.path.join(directory, f'coords_{level}.npy'), coords)
+            np.save(os.path.join(directory, f'offsets_{level}.npy'), offsets)
+
+    @classmethod
+    def load(cls, directory: str, mmap_mode: str | None = 'r') -> 'ShapeStore':
+        """Opens a store written by save. By default the arrays are memory-mapped read-only rather than read in."""
+        def load(name):
+            # as a plain ndarray over the same memory, since slicing a np.memmap is a lot slower
+            return np.asarray(np.load(os.path.join(directory, f'{name}.npy'), mmap_mode=mmap_mode))
+
+        levels = {}
+        for f in sorted(os.listdir(directory)):
+            if f.startswith('coords_') and f.endswith('.npy'):
+                name = f[len('coords_'):-len('.npy')]
+                level = name if name == FULL else int(name)
+                levels[level] = (load(f'coords_{name}'), load(f'offsets_{name}'))
+        return cls(load('labels'), load('colors'), levels)
+
+
+def _draw_order(labels, colors) -> np.ndarray:
+    # By color following mbta.df_color_sort_order, with colors it doesn't have drawn last, then by route so each
+    # route's shapes are consecutive
+    rank = {c: i for i, c in enumerate(df_color_sort_order)}
+    keys = [(rank.get(tuple(c), len(rank)), str(l)) for l, c in zip(labels, colors)]
+    return np.array(sorted(range(len(keys)), key=keys.__getitem__), dtype=np.int64)
+
+
+def _pack(paths: list) -> (np.ndarray, np.ndarray):
+    # Lays paths end to end as (coords, offsets)
+    offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+    np.cumsum([len(p) for p in paths], out=offsets[1:])
+    if len(paths) == 0:
+        return np.zeros((0, 2), dtype=np.float32), offsets
+    return np.concatenate(paths).astype(np.float32).reshape(-1, 2), offsets
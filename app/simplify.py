@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import math
+
+from lazy import lazy_import
+from spatial import degrees_per_pixel
+
+np = lazy_import('numpy')
+
+# Zoom levels shapes are simplified for. Each is simplified to within SHAPE_TOLERANCE_PX pixels at its zoom, and used
+# from that zoom until the next one in.
+SHAPE_ZOOMS = (10, 12, 14, 16)
+SHAPE_TOLERANCE_PX = 0.5
+
+
+def significance(points: np.ndarray) -> np.ndarray:
+    """Runs Douglas-Peucker over points down to no tolerance at all, recording for each point the largest tolerance
+    it would still be kept at. Simplifying to any tolerance is then just points[significance(points) > tolerance],
+    and the result at one tolerance always contains the result at a bigger one, so zooming in only adds detail.
+
+    Distances are in the units of points, so scale longitude by cos(latitude) first for distances on the ground.
+
+    :param points: (n, 2) array of coordinates
+    :return: Array of n tolerances, infinite for the endpoints
+    """
+    n = len(points)
+    sig = np.zeros(n)
+    if n == 0:
+        return sig
+    sig[0] = sig[-1] = np.inf
+
+    stack = [(0, n - 1, np.inf)]
+    while stack:
+        a, b, parent = stack.pop()
+        if b <= a + 1:
+            continue
+        seg = points[b] - points[a]
+        rel = points[a + 1:b] - points[a]
+        length2 = seg @ seg
+        if length2 > 0:
+            # distance from each point to the segment, clamped to its ends
+            t = np.clip(rel @ seg / length2, 0, 1)
+            rel = rel - t[:, None] * seg
+        d = np.hypot(rel[:, 0], rel[:, 1])
+
+        i = int(np.argmax(d))
+        if d[i] == 0:
+            # everything in between is on the segment
+            continue
+        m = a + 1 + i
+        # a point can't outlast the point its segment was split at, which keeps the levels nested
+        sig[m] = min(d[i], parent)
+        stack.append((a, m, sig[m]))
+        stack.append((m, b, sig[m]))
+
+    return sig
+
+
+def simplify_levels(path, zooms=SHAPE_ZOOMS) -> dict:
+    """Simplifies one shape for each zoom in zooms
+
+    :param path: Sequence of [lng, lat] pairs
+    :return: dict of zoom to (n, 2) float32 array of [lng, lat] pairs
+    """
+    points = np.asarray(path, dtype=np.float64).reshape(-1, 2)
+    if len(points) == 0:
+        return {z: points.astype(np.float32) for z in zooms}
+
+    # measure in (roughly) equal units east-west and north-south
+    scaled = points * [math.cos(math.radians(points[:, 1].mean())), 1]
+    sig = significance(scaled)
+    return {z: points[sig > degrees_per_pixel(z) * SHAPE_TOLERANCE_PX].astype(np.float32) for z in zooms}
+
+
+def level_for_zoom(zoom: float, zooms=SHAPE_ZOOMS) -> int:
+    """The zoom of the simplified level to draw at zoom, the most detailed one that's still coarse enough"""
+    fitting = [z for z in zooms if z <= zoom]
+    return fitting[-1] if fitting else zooms[0]
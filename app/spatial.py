@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import math
+
+from lazy import lazy_import
+
+np = lazy_import('numpy')
+
+# Zoom levels thinning is worked out for. Everything is shown from MAX_ZOOM in.
+MIN_ZOOM = 8
+MAX_ZOOM = 16
+# Roughly how far apart, in pixels, points kept by thinning are
+THIN_SPACING_PX = 24
+
+
+def degrees_per_pixel(zoom: float) -> float:
+    # web mercator tiles are 256px and cover 360 degrees of longitude at zoom 0
+    return 360 / (256 * 2 ** zoom)
+
+
+class PointSet:
+    """A set of [lng, lat] points for looking up the ones inside a bounding box, which is just a NumPy comparison over
+    the points' coordinates. A grid index was tried here too but even at the size of the whole bus network (~8k stops)
+    it was no faster than the comparison, see bench/bench_spatial.py.
+
+    The points can also be thinned out for low zooms. Each point gets the lowest zoom it's shown at: going from
+    MIN_ZOOM up, a point is added at the first zoom where no higher priority point already shown is within about
+    THIN_SPACING_PX of it, so at any zoom the points shown are roughly evenly spread with the important ones kept.
+    Points are kept in order of the zoom they're shown from, so a query zoomed out over the whole network only
+    compares the few hundred points shown at that zoom.
+
+    :param locations: Sequence of [lng, lat] pairs, e.g. the location column of a stops or vehicles DataFrame
+    :param priority: Optional priority of each point for thinning, higher is kept first. Without it points
+        aren't thinned.
+    """
+    def __init__(self, locations, priority=None):
+        xy = np.asarray(list(locations), dtype=np.float64).reshape(-1, 2)
+        self.size = len(xy)
+        self.lng, self.lat = xy[:, 0], xy[:, 1]
+
+        if priority is None:
+            self.min_zoom = np.full(self.size, MIN_ZOOM, dtype=np.int8)
+        else:
+            self.min_zoom = self._thin(np.asarray(priority))
+
+        # positions of the points ordered by the zoom they're shown from, and the coordinates in that order
+        self._order = np.argsort(self.min_zoom, kind='stable')
+        self._lng, self._lat = self.lng[self._order], self.lat[self._order]
+        # zoom -> how many points (from the start of _order) are shown at it
+        self._shown = {z: int(np.searchsorted(self.min_zoom[self._order], z, side='right'))
+                       for z in range(MIN_ZOOM, MAX_ZOOM + 1)}
+
+    def _thin(self, priority: np.ndarray) -> np.ndarray:
+        min_zoom = np.full(self.size, MAX_ZOOM, dtype=np.int8)
+        # highest priority first, and otherwise in the order given
+        remaining = np.argsort(-priority, kind='stable')
+
+        for z in range(MIN_ZOOM, MAX_ZOOM):
+            if len(remaining) == 0:
+                break
+            size = degrees_per_pixel(z) * THIN_SPACING_PX
+            shown = min_zoom < z
+
+            def cells(i):
+                return np.floor(self.lng[i] / size).astype(np.int64), np.floor(self.lat[i] / size).astype(np.int64)
+
+            # cells already taken by points shown at lower zooms
+            taken = set(zip(*cells(np.flatnonzero(shown)))) if shown.any() else set()
+            cx, cy = cells(remaining)
+            free = np.fromiter(((x, y) not in taken for x, y in zip(cx, cy)), dtype=bool, count=len(remaining))
+
+            # the first (highest priority) remaining point in each free cell is shown from this zoom
+            key = cy[free] * (2 ** 31) + cx[free]
+            _, first = np.unique(key, return_index=True)
+            min_zoom[remaining[free][first]] = z
+            remaining = remaining[min_zoom[remaining] == MAX_ZOOM]
+
+        return min_zoom
+
+    def query(self, bbox, zoom: float = None) -> np.ndarray:
+        """Positions of the points inside bbox
+
+        :param bbox: (west, south, east, north) in degrees
+        :param zoom: Optionally the map's zoom, to leave out points thinned at that zoom. Anything below MIN_ZOOM is
+            treated as MIN_ZOOM.
+        :return: Sorted array of point positions
+        """
+        west, south, east, north = (float(x) for x in bbox)
+        level = MAX_ZOOM if zoom is None else min(max(math.floor(zoom), MIN_ZOOM), MAX_ZOOM)
+        n = self._shown[level]
+        lng, lat = self._lng[:n], self._lat[:n]
+        inside = (lng >= west) & (lng <= east) & (lat >= south) & (lat <= north)
+        return np.sort(self._order[:n][inside])
+
+    def scan(self, bbox, zoom: float = None) -> np.ndarray:
+        """Same as query but compares every point, for comparison"""
+        west, south, east, north = bbox
+        inside = (self.lng >= west) & (self.lng <= east) & (self.lat >= south) & (self.lat <= north)
+        if zoom is not None:
+            inside &= self.min_zoom <= max(zoom, MIN_ZOOM)
+        return np.flatnonzero(inside)
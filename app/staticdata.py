@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import logging
+import threading
+from types import MappingProxyType
+
+from lazy import lazy_import
+from shapestore import FULL, ShapeStore
+from stoproutes import StopRouteIndex
+
+pd = lazy_import('pandas')
+
+logger = logging.getLogger(__name__)
+
+
+class BusData:
+    """Static data for the bus network. It's in the bundle like the rail data (see tools/build_static.py), and only
+    fetched from the API in the background if the bundle doesn't have it, see datamanager._load_bus_data."""
+    def __init__(self, routes: list, shapes: ShapeStore, stops: pd.DataFrame, route_to_stops: dict,
+                 shape_to_route: dict, stop_names: dict):
+        self.routes = tuple(routes)
+        self.shapes = shapes
+        self.stops = stops
+        self.route_to_stops = route_to_stops
+        self.shape_to_route = shape_to_route
+        self.stop_names = stop_names
+
+
+class StaticData:
+    """Immutable snapshot of the static (GTFS-derived) data used to draw the maps.
+
+    Everything in here is loaded once and shared between requests, so none of it should be mutated in place;
+    filtering always produces new DataFrames.
+    """
+    def __init__(self, shapes: ShapeStore, stops: pd.DataFrame, route_to_stops: dict, shape_to_route: dict,
+                 stop_names: dict, validators: dict, version: int = 0, bus: BusData = None):
+        self.version = version
+        # what this snapshot was built from, so replace can swap out one part without unpicking the merged data
+        self._fields = {'shapes': shapes, 'stops': stops, 'route_to_stops': route_to_stops,
+                        'shape_to_route': shape_to_route, 'stop_names': stop_names, 'bus': bus}
+
+        self.bus_routes = bus.routes if bus is not None else ()
+        if bus is not None:
+            # stops already known from the rail data keep their rail rows
+            shapes = ShapeStore.concat([bus.shapes, shapes])
+            stops = pd.concat([stops, bus.stops[~bus.stops['id'].isin(stops['id'])]])
+            route_to_stops = {**bus.route_to_stops, **route_to_stops}
+            shape_to_route = {**bus.shape_to_route, **shape_to_route}
+            stop_names = {**bus.stop_names, **stop_names}
+
+        # shapes are kept in draw order so filtered subsets don't need sorting again, see ShapeStore
+        self.shapes = shapes
+        self.stops = stops.reset_index(drop=True)
+        # which routes serve each row of stops, for filtering them by route
+        self.stop_routes = StopRouteIndex(self.stops['routes_served'])
+
+        self.route_to_stops = MappingProxyType({k: frozenset(v) for k, v in route_to_stops.items()})
+        self.shape_to_route = MappingProxyType(dict(shape_to_route))
+        self.stop_names = MappingProxyType(dict(stop_names))
+        # same as stop_names, for vectorized lookups with Series.map
+        self.stop_name_index = pd.Series(self.stop_names, dtype=object)
+
+        # HTTP validators (Last-Modified/ETag) for each upstream resource the data was built from
+        self.validators = MappingProxyType({k: MappingProxyType(dict(v)) for k, v in validators.items()})
+
+    @property
+    def parts(self) -> MappingProxyType:
+        """What this snapshot was built from: the rail (and Silver Line) data as passed in, and the BusData if
+        there is any, which the attributes have merged together"""
+        return MappingProxyType(self._fields)
+
+    def replace(self, **changes) -> 'StaticData':
+        """Returns a copy of this snapshot with some fields swapped out and the version bumped. Fields other than
+        bus refer to the rail data, see parts."""
+        fields = dict(self._fields)
+        fields['validators'] = {**self.validators, **changes.pop('validators', {})}
+        fields.update(changes)
+        return StaticData(**fields, version=self.version + 1)
+
+    def shapes_for_routes(self, route_ids, level=FULL) -> list:
+        """(label, color, path) of each shape of route_ids in draw order, see ShapeStore.records"""
+        return self.shapes.records(route_ids, level)
+
+
+class StaticDataCache:
+    """Process-wide holder for the current StaticData snapshot.
+
+    The snapshot is loaded on first use and then revalidated against the API by a daemon thread, so requests
+    only ever read memory. When revalidation finds newer data a new snapshot is built and swapped in whole.
+
+    :param loader: Callable returning the initial StaticData
+    :param revalidator: Callable taking the current StaticData and returning an updated one, or None if
+        nothing changed
+    :param interval: Seconds between revalidations
+    """
+    def __init__(self, loader, revalidator, interval: float = 3600):
+        self._loader = loader
+        self._revalidator = revalidator
+        self.interval = interval
+
+        self._data = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def get(self) -> StaticData:
+        data = self._data
+        if data is None:
+            with self._lock:
+                if self._data is None:
+                    self._data = self._loader()
+                    self._start()
+                data = self._data
+        return data
+
+    def revalidate(self):
+        current = self.get()
+        updated = self._revalidator(current)
+        if updated is not None:
+            with self._lock:
+                self._data = updated
+            logger.info('Static data updated to version %s', updated.version)
+
+    def _start(self):
+        if self._thread is not None or self.interval <= 0:
+            return
+        self._thread = threading.Thread(target=self._run, name='static-data-revalidator', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        # Revalidate once right away since the data on disk may well be stale, then every interval
+        while not self._stop.is_set():
+            try:
+                self.revalidate()
+            except Exception:
+                logger.exception('Static data revalidation failed, keeping current data')
+            self._stop.wait(self.interval)
+
+    def stop(self):
+        self._stop.set()
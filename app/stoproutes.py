@@ -0,0 +1,84 @@
+"""Index of which routes serve each stop, for picking out the stops of any set of routes without going through every
+stop's routes_served list.
+
+Every route gets a bit, and each stop a bitmask of the routes serving it (as uint64 words, since there are a few
+hundred routes with the buses), so the stops of a set of routes are the rows whose mask ANDed with the set's is
+non-zero. Each stop's routes are also kept in its routes_served order, highest priority first, as one flat array of
+route positions with offsets, so the route a stop is drawn for is the first of its routes in the set and its color
+comes straight from a per-route lookup.
+"""
+from __future__ import annotations
+
+from lazy import lazy_import
+from mbta import silver_line_route_names, update_color
+
+np = lazy_import('numpy')
+
+
+class StopRouteIndex:
+    """
+    :param routes_served: Each stop's list of routes, highest priority first, e.g. StaticData.stops['routes_served']
+    """
+    def __init__(self, routes_served):
+        # every route, in the order first seen
+        self.routes = np.array(list(dict.fromkeys(r for routes in routes_served for r in routes)), dtype=object)
+        self._positions = {r: i for i, r in enumerate(self.routes)}
+        # color of a stop drawn for each route, see mbta.update_color
+        self.route_colors = np.array([update_color(r) for r in self.routes], dtype=np.uint8).reshape(-1, 3)
+
+        lengths = np.fromiter((len(routes) for routes in routes_served), dtype=np.int64)
+        self.offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        # position in self.routes of each stop's routes end to end, and which stop each one is for
+        self.members = np.fromiter((self._positions[r] for routes in routes_served for r in routes), dtype=np.int64,
+                                   count=int(self.offsets[-1]))
+        self.owners = np.repeat(np.arange(len(lengths)), lengths)
+
+        self.words = max((len(self.routes) + 63) // 64, 1)
+        self.masks = np.zeros((len(lengths), self.words), dtype=np.uint64)
+        np.bitwise_or.at(self.masks, (self.owners, self.members // 64),
+                         np.left_shift(np.uint64(1), (self.members % 64).astype(np.uint64)))
+
+    def __len__(self) -> int:
+        return len(self.masks)
+
+    def route_positions(self, route_ids) -> np.ndarray:
+        """Positions in self.routes of route_ids that serve any stop. The Silver Line's route IDs are also matched by
+        the names stops list them under, e.g. 741 and SL1."""
+        names = set(route_ids) | {silver_line_route_names[r] for r in route_ids if r in silver_line_route_names}
+        return np.array(sorted(self._positions[r] for r in names if r in self._positions), dtype=np.int64)
+
+    def mask(self, route_ids) -> np.ndarray:
+        """Bitmask of route_ids, to AND with self.masks"""
+        positions = self.route_positions(route_ids)
+        mask = np.zeros(self.words, dtype=np.uint64)
+        np.bitwise_or.at(mask, positions // 64, np.left_shift(np.uint64(1), (positions % 64).astype(np.uint64)))
+        return mask
+
+    def rows(self, route_ids) -> np.ndarray:
+        """Positions of the stops served by any of route_ids"""
+        return np.flatnonzero((self.masks & self.mask(route_ids)).any(axis=1))
+
+    def select(self, route_ids) -> (np.ndarray, np.ndarray, list):
+        """The stops served by any of route_ids, with what they're drawn for when only route_ids are shown
+
+        :return: tuple of the stops' positions, the position in self.routes of the first of route_ids serving each
+            one (i.e. its highest priority route of those), and each one's routes_served narrowed down to route_ids
+        """
+        rows = self.rows(route_ids)
+        wanted = np.zeros(len(self.routes), dtype=bool)
+        wanted[self.route_positions(route_ids)] = True
+
+        # the memberships for wanted routes, which are still grouped by stop in stop order, and every selected stop
+        # has at least one of them so the first of each group is the stop's highest priority wanted route
+        memberships = np.flatnonzero(wanted[self.members])
+        owners = self.owners[memberships]
+        firsts = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]]) if len(owners) else owners
+        primary = self.members[memberships[firsts]]
+        names = self.routes[self.members[memberships]].tolist()
+        bounds = firsts.tolist() + [len(names)]
+        return rows, primary, [names[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+    def colors(self, primary: np.ndarray) -> np.ndarray:
+        """(n, 3) array of the color of stops drawn for the routes at primary, see select"""
+        return self.route_colors[primary]
@@ -0,0 +1,282 @@
+from __future__ import annotations
+
+import collections
+import copy
+import logging
+import random
+import socket
+import threading
+
+from lazy import lazy_import
+from mbta import Vehicle, Prediction, loads
+
+requests = lazy_import('requests')
+
+logger = logging.getLogger(__name__)
+
+
+def iter_sse(lines):
+    """Parses an iterable of decoded lines from a text/event-stream response into (event, data) tuples
+
+    See https://html.spec.whatwg.org/multipage/server-sent-events.html#event-stream-interpretation
+    """
+    event, data = 'message', []
+    for line in lines:
+        if line == '':
+            if data:
+                yield event, '\n'.join(data)
+            event, data = 'message', []
+            continue
+        if line.startswith(':'):
+            # comment, used as a keep-alive
+            continue
+
+        field, _, value = line.partition(':')
+        if value.startswith(' '):
+            value = value[1:]
+        if field == 'event':
+            event = value
+        elif field == 'data':
+            data.append(value)
+
+    if data:
+        yield event, '\n'.join(data)
+
+
+class LiveStore:
+    """In-memory state built from the V3 API's streaming vehicles and predictions feeds.
+
+    Every resource seen on a stream is kept in raw form keyed by (type, id), the same way mbta.index_included
+    indexes a response, since vehicles need the trips and routes included alongside them to build their labels. The
+    Vehicle and Prediction objects built from those are kept current as events arrive, so reading from the store never
+    touches the network.
+
+    Several streams can feed one store, e.g. when the routes are split over several URLs. Each resource is owned by the
+    stream it last came from, and a reset only replaces the resources of the stream it came from.
+
+    Included resources (trips and routes) are only kept while a vehicle or prediction refers to them, since the stream
+    doesn't send remove events for them when the vehicles they came with go away.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.resources = {}
+        # (type, id) -> source of the stream the resource last came from
+        self._sources = {}
+        self.vehicles = {}
+        self.predictions = {}
+        # (type, id) -> how many vehicles and predictions refer to the resource
+        self._refs = collections.Counter()
+
+    def _build_prediction(self, r: dict) -> Prediction | None:
+        if r['relationships']['vehicle']['data'] is None:
+            return None
+        return Prediction(r, self.resources)
+
+    def _upsert(self, r: dict, source):
+        _type, _id = r['type'], r['id']
+        built = None
+        if _type in ('vehicle', 'prediction'):
+            try:
+                built = Vehicle(r, included=self.resources) if _type == 'vehicle' else self._build_prediction(r)
+            except (KeyError, TypeError, ValueError, AttributeError) as err:
+                # e.g. a vehicle without a trip or a prediction without a stop. Skipped so the rest of the stream
+                # still gets applied, keeping the last good version of it if there was one.
+                logger.warning('Skipping malformed %s %s: %r', _type, _id, err)
+                return
+        previous = self.resources.get((_type, _id))
+        self.resources[(_type, _id)] = r
+        self._sources[(_type, _id)] = source
+        if _type in ('vehicle', 'prediction'):
+            # take the new references before letting go of the old ones, so ones in both are kept
+            self._refs.update(_related(r))
+            if previous is not None:
+                self._release(previous)
+
+        if _type == 'vehicle':
+            self.vehicles[_id] = built
+        elif _type == 'prediction':
+            if built is not None:
+                self.predictions[_id] = built
+            else:
+                self.predictions.pop(_id, None)
+
+    def _remove(self, _type: str, _id: str):
+        r = self.resources.pop((_type, _id), None)
+        self._sources.pop((_type, _id), None)
+        if _type == 'vehicle':
+            self.vehicles.pop(_id, None)
+        elif _type == 'prediction':
+            self.predictions.pop(_id, None)
+        if r is not None and _type in ('vehicle', 'prediction'):
+            self._release(r)
+
+    def _release(self, r: dict):
+        # drops the references a vehicle or prediction held, and the included resources nothing refers to any more
+        for k in _related(r):
+            self._refs[k] -= 1
+            if self._refs[k] <= 0:
+                del self._refs[k]
+                if k[0] not in ('vehicle', 'prediction'):
+                    self.resources.pop(k, None)
+                    self._sources.pop(k, None)
+
+    def apply(self, event: str, payload, types: set, source=None):
+        """Applies one decoded stream event
+
+        :param event: One of reset, add, update or remove
+        :param payload: Decoded event data, a list of resources for reset and a single resource otherwise
+        :param types: Resource types the stream the event came from returns, a reset replaces the ones of these
+            that came from it
+        :param source: Identifies the stream the event came from, e.g. its URL
+        """
+        with self._lock:
+            if event == 'reset':
+                # add the included resources before the vehicles that refer to them
+                ordered = sorted(payload, key=lambda x: x['type'] in ('vehicle', 'prediction'))
+                for k in [k for k, s in self._sources.items() if s == source and k[0] in types]:
+                    self._remove(*k)
+                for r in ordered:
+                    self._upsert(r, source)
+            elif event in ('add', 'update'):
+                self._upsert(payload, source)
+            elif event == 'remove':
+                self._remove(payload['type'], payload['id'])
+
+    def snapshot(self, route_ids=None) -> (list, dict):
+        """Returns the current vehicles and, for each of them, the prediction for the next stop of its trip
+
+        :param route_ids: Optionally only include vehicles on these routes
+        :return: tuple of a list of Vehicles and a dict of vehicle ID to Prediction
+        """
+        routes = set(route_ids) if route_ids is not None else None
+        with self._lock:
+            vehicles = [v for v in self.vehicles.values() if routes is None or v.route_id in routes]
+            predictions = list(self.predictions.values())
+
+        current = {v.vehicle_id: v for v in vehicles}
+        next_stop = {}
+        for p in predictions:
+            v = current.get(p.vehicle)
+            if v is None or p.trip_id != v.trip_id:
+                continue
+            # predictions without a stop_sequence are only used if there's nothing better
+            if p.vehicle not in next_stop or _sequence(p) < _sequence(next_stop[p.vehicle]):
+                next_stop[p.vehicle] = p
+
+        # Vehicle status changes more often than predictions do, so take it from the vehicle itself. The predictions
+        # are the store's own (which the ingester thread may be reading), so copies get it.
+        for k, p in next_stop.items():
+            p = next_stop[k] = copy.copy(p)
+            p.vehicle_status, p.vehicle_stop = current[k].current_status, current[k].stop
+
+        return vehicles, next_stop
+
+
+def _related(r: dict) -> list:
+    # (type, id) of every resource r's relationships refer to
+    keys = []
+    for rel in (r.get('relationships') or {}).values():
+        data = rel.get('data') if isinstance(rel, dict) else None
+        for d in data if isinstance(data, list) else [data]:
+            if isinstance(d, dict) and 'type' in d and 'id' in d:
+                keys.append((d['type'], d['id']))
+    return keys
+
+
+def _sequence(p: Prediction) -> (bool, int):
+    # sorts predictions by stop_sequence, with the ones that don't have one last
+    return p.stop_sequence is None, p.stop_sequence or 0
+
+
+class StreamIngester:
+    """Background thread that keeps a LiveStore current from one V3 API streaming endpoint.
+
+    Reconnects with jittered exponential backoff whenever the stream drops. The API starts every connection with a
+    reset event, so the store is resynced from scratch each time that happens.
+
+    :param url: Full URL of the endpoint to stream
+    :param store: LiveStore to apply events to
+    :param types: Resource types the endpoint returns, including ones pulled in with include=
+    :param headers: Headers to send, Accept is set to text/event-stream
+    """
+    def __init__(self, url: str, store: LiveStore, types: set, headers: dict = None, min_backoff: float = 1,
+                 max_backoff: float = 60, read_timeout: float = 90):
+        self.url = url
+        self.store = store
+        self.types = set(types)
+        self.headers = {**(headers or {}), 'Accept': 'text/event-stream'}
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.read_timeout = read_timeout
+
+        self.connected = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        # the open streaming response, shut down by stop so the thread isn't left waiting on it
+        self._response = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f'stream {self.url}', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        r = self._response
+        if r is None:
+            return
+        # Closing the response would wait for the thread reading from it to get the next line, which can be a
+        # keep-alive a while off. Shutting the socket down wakes it up straight away, and it closes the response.
+        sock = getattr(getattr(r.raw, 'connection', None), 'sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _run(self):
+        backoff = self.min_backoff
+        while not self._stop.is_set():
+            try:
+                for event, data in self._events():
+                    if self._stop.is_set():
+                        return
+                    try:
+                        self.store.apply(event, loads(data), self.types, source=self.url)
+                    except Exception:
+                        if event == 'reset':
+                            # nothing to carry on from, so start over
+                            raise
+                        logger.exception('Skipping bad %s event from %s', event, self.url)
+                        continue
+                    if event == 'reset':
+                        backoff = self.min_backoff
+                        self.connected.set()
+                logger.info('Stream %s closed, reconnecting', self.url)
+            except (requests.exceptions.RequestException, ValueError) as err:
+                if self._stop.is_set():
+                    return
+                logger.warning('Stream %s failed: %s', self.url, err)
+            except Exception:
+                if self._stop.is_set():
+                    # reading from the response stop closed
+                    return
+                # anything else would end the thread silently, leaving it marked connected with the store frozen
+                logger.exception('Stream %s failed', self.url)
+
+            self.connected.clear()
+            self._stop.wait(random.uniform(0, backoff))
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def _events(self):
+        with requests.get(self.url, headers=self.headers, stream=True, timeout=(10, self.read_timeout)) as r:
+            self._response = r
+            try:
+                # stop may have been called while connecting
+                if self._stop.is_set():
+                    return
+                r.raise_for_status()
+                yield from iter_sse(r.iter_lines(decode_unicode=True))
+            finally:
+                self._response = None
+
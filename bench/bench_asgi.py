@@ -0,0 +1,138 @@
+"""Load tests the sync Flask app (main.py, on werkzeug's threaded server) against the ASGI app (asgi.py, on uvicorn)
+with the stub server standing in for the API, at increasing numbers of concurrent clients.
+
+The snapshot TTL is kept short and the stub slow so a good share of requests have to wait on the upstream, which is
+where the two differ: the sync app holds a thread per waiting request, the ASGI app just parks a coroutine.
+
+    python bench/bench_asgi.py [--concurrency 10 50 200] [--delay 0.25] [--duration 10]
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCH_DIR, '..', 'app')
+
+SERVERS = {
+    'flask': [sys.executable, '-c', 'import sys; from main import app, tune_gc; tune_gc(); '
+              'app.run(host="127.0.0.1", port=int(sys.argv[1]), threaded=True)'],
+    'asgi': [sys.executable, '-m', 'uvicorn', 'asgi:app', '--log-level', 'warning', '--port'],
+}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.2)
+    raise RuntimeError(f'{url} never came up')
+
+
+class _Connection:
+    """Bare-bones HTTP/1.1 client for the load generator, reusing the connection when the server allows it.
+    (httpx's connection pool becomes the bottleneck well before either server does at a hundred or so clients.)"""
+    def __init__(self, port: int):
+        self.port = port
+        self.reader = self.writer = None
+
+    async def get(self, path: str) -> int:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+        self.writer.write(f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n'.encode())
+        await self.writer.drain()
+
+        head = (await self.reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+        status = int(head[0].split()[1])
+        headers = {k.lower(): v.strip() for k, _, v in (h.partition(':') for h in head[1:] if h)}
+        await self.reader.readexactly(int(headers.get('content-length', 0)))
+
+        if head[0].startswith('HTTP/1.0') or headers.get('connection', '').lower() == 'close':
+            self.close()
+        return status
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+async def load(port: int, path: str, concurrency: int, duration: float) -> (list, int):
+    latencies, errors = [], 0
+    deadline = time.monotonic() + duration
+
+    async def worker():
+        nonlocal errors
+        conn = _Connection(port)
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                ok = await conn.get(path) == 200
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                conn.close()
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+        conn.close()
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 50, 200])
+    parser.add_argument('--delay', type=float, default=0.25, help='seconds of latency on /vehicles and /predictions')
+    parser.add_argument('--vehicles', type=int, default=300)
+    parser.add_argument('--duration', type=float, default=10, help='seconds to run each level for')
+    parser.add_argument('--path', default='/api/vehicles/all')
+    parser.add_argument('--ttl', default='0.5', help='VEHICLE_TTL_SECONDS for the app')
+    args = parser.parse_args()
+
+    stub_port = free_port()
+    stub = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'stub_server.py'), '--port', str(stub_port),
+                             '--vehicles', str(args.vehicles), '--delay', f'/vehicles={args.delay}',
+                             '--delay', f'/predictions={args.delay}'], stdout=subprocess.DEVNULL)
+    env = {**os.environ, 'MBTA_BASE_URL': f'http://127.0.0.1:{stub_port}/', 'STATIC_REVALIDATE_SECONDS': '0',
+           'VEHICLE_TTL_SECONDS': args.ttl, 'VEHICLE_MAX_STALE_SECONDS': args.ttl}
+
+    print(f'{args.path}, {args.delay}s upstream latency, snapshot TTL {args.ttl}s')
+    print(f'{"server":>6} {"clients":>8} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"errors":>7}')
+    try:
+        for name, cmd in SERVERS.items():
+            port = free_port()
+            server = subprocess.Popen(cmd + [str(port)], cwd=APP_DIR, env=env, stdout=subprocess.DEVNULL,
+                                      stderr=subprocess.DEVNULL)
+            try:
+                wait_for(f'http://127.0.0.1:{port}{args.path}')
+                for c in args.concurrency:
+                    latencies, errors = asyncio.run(load(port, args.path, c, args.duration))
+                    ms = np.percentile(latencies, [50, 95, 99]) * 1000 if latencies else [float('nan')] * 3
+                    print(f'{name:>6} {c:>8} {len(latencies) / args.duration:>8.1f} {ms[0]:>8.1f} {ms[1]:>8.1f} '
+                          f'{ms[2]:>8.1f} {errors:>7}')
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        stub.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""Benchmarks how far off the positions moved along routes between polls (see deadreckoning.py) are, against leaving
+vehicles where they were last seen and against moving them without holding them at their next stop, for a few poll
+intervals. Also times building a Motion per snapshot and moving every vehicle, which is what each tick of the
+positions feed costs.
+
+A trace is a run of /vehicles responses a second or so apart. Every poll interval's worth of it is taken as a
+snapshot, and each fix in the responses in between is where the vehicle actually was at its updated_at, which is
+compared with where it's put at that time. Without a recorded trace a synthetic one is used (see
+fixtures.vehicle_trace), of vehicles stopping at the stops along the rail shapes in the static data bundle:
+
+    python bench/bench_deadreckoning.py [--vehicles 300] [--seconds 600] [--trace trace.jsonl] [--check]
+
+where trace.jsonl (or .jsonl.gz) has one /vehicles?fields[vehicle]=...,updated_at&include=route response per line, and
+--save writes the synthetic trace out in the same format. With --check it exits non-zero if, at any poll interval, the
+moved positions aren't within_bounds. tests/test_deadreckoning.py checks the same bounds against the short trace in
+tests/data.
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+sys.path.insert(0, APP_DIR)
+os.chdir(APP_DIR)
+# don't revalidate static data against the API while benchmarking
+os.environ.setdefault('STATIC_REVALIDATE_SECONDS', '0')
+
+import numpy as np  # noqa: E402
+
+import datamanager  # noqa: E402
+import fixtures  # noqa: E402
+from deadreckoning import Motion, Tracks, stop_locations  # noqa: E402
+
+POLL_INTERVALS = (10, 20, 30)
+# Bounds on the median and 90th percentile errors of the moved positions, as shares of the errors of leaving vehicles
+# where they were last seen. Those grow with the poll interval and don't depend on how big the trace is, where the
+# moved ones' 90th percentile is higher on short traces. Synthetic ones come in at under 0.1 for the median and
+# between 0.25 (300 vehicles for 10 minutes) and 0.65 (50 vehicles for 2 minutes) for the 90th percentile.
+CHECK_SHARES = (0.15, 0.75)
+# and on the median in metres, which is mostly the noise in the fixes
+CHECK_MEDIAN_METRES = 25
+
+
+def percentiles(errors: np.ndarray) -> np.ndarray:
+    # median and 90th percentile
+    return np.array([np.median(errors), np.percentile(errors, 90)])
+
+
+def within_bounds(moved: np.ndarray, held: np.ndarray, not_held: np.ndarray) -> bool:
+    """Whether the errors of the moved positions are within CHECK_SHARES of the last seen ones' and
+    CHECK_MEDIAN_METRES, and no worse than those of moving vehicles without holding them at their next stop
+
+    :param moved: Errors in metres as dead reckoned, see evaluate
+    :param held: The same fixes' errors as last seen
+    :param not_held: Errors as dead reckoned without stops
+    """
+    errors = percentiles(moved)
+    return bool(errors[0] <= CHECK_MEDIAN_METRES and (errors <= percentiles(held) * CHECK_SHARES).all() and
+                (errors <= percentiles(not_held)).all())
+
+
+def load_trace(path: str) -> list:
+    with (gzip.open if path.endswith('.gz') else open)(path, 'rb') as inf:
+        return [json.loads(line) for line in inf if line.strip()]
+
+
+def save_trace(path: str, trace: list):
+    with (gzip.open if path.endswith('.gz') else open)(path, 'wt') as outf:
+        for response in trace:
+            outf.write(json.dumps(response, separators=(',', ':')) + '\n')
+
+
+def fixes(response: dict) -> dict:
+    # vehicle ID -> (updated_at, [lng, lat]) of every vehicle in a response
+    df = datamanager.parse_vehicles([response])
+    return {v: (t, loc) for v, t, loc in zip(df['vehicle_id'], df['updated_at'], df['location'])}
+
+
+def evaluate(trace: list, tracks: Tracks, interval: int) -> (np.ndarray, np.ndarray, float):
+    """Errors in metres of every fix newer than the latest snapshot, as dead reckoned and as last seen
+
+    :param interval: Seconds between polls, taking the trace as a response a second
+    :return: tuple of both arrays of errors, and the share of fixes that were moved
+    """
+    moved_errors, held_errors, moved = [], [], 0
+    motion, index = None, {}
+    for i, response in enumerate(trace):
+        if i % interval == 0:
+            df = datamanager.parse_vehicles([response])
+            motion = Motion(df, tracks, previous=motion)
+            index = {v: j for j, v in enumerate(df['vehicle_id'])}
+            continue
+
+        for v, (t, actual) in fixes(response).items():
+            j = index.get(v)
+            if j is None or not t > motion.fixed_at[j]:
+                continue
+            locations, _, was_moved = motion.positions(t, np.array([j]))
+            points = tracks.to_xy([actual, locations[0], motion.locations[j]])
+            moved_errors.append(np.hypot(*(points[1] - points[0])))
+            held_errors.append(np.hypot(*(points[2] - points[0])))
+            moved += int(was_moved[0])
+    return np.array(moved_errors), np.array(held_errors), moved / max(len(moved_errors), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--vehicles', type=int, default=300, help='vehicles in the synthetic trace')
+    parser.add_argument('--seconds', type=int, default=600, help='length of the synthetic trace')
+    parser.add_argument('--trace', help='recorded trace to use instead, a response per line')
+    parser.add_argument('--save', help='write the synthetic trace to this file, a response per line')
+    parser.add_argument('--check', action='store_true', help='exit non-zero if the errors are over the bounds')
+    args = parser.parse_args()
+
+    data = datamanager.static_data.get()
+    stops = stop_locations(data.stops, data.route_to_stops)
+    start = time.perf_counter()
+    tracks = Tracks(data.shapes, stops=stops)
+    print(f'tracks for {len(data.shapes)} shapes, {len(tracks.seg_starts)} segments, built in '
+          f'{(time.perf_counter() - start) * 1000:.0f} ms')
+    # the same without the stops, so nothing's held at them
+    unheld = Tracks(data.shapes)
+
+    if args.trace:
+        trace = load_trace(args.trace)
+    else:
+        paths = [(label, path) for label, _, path in data.shapes_for_routes(datamanager.all_routes)]
+        trace = fixtures.vehicle_trace(paths, args.vehicles, args.seconds, stops=stops)
+        if args.save:
+            save_trace(args.save, trace)
+    print(f'{len(trace)} responses of {len(trace[0]["data"])} vehicles\n')
+
+    print(f'{"":>24} {"last seen":>13} {"moved":>20} {"not held":>13}')
+    print(f'{"poll (s)":>9} {"fixes":>7} {"moved":>6} {"median":>6} {"p90":>6} {"median":>6} {"p90":>6} {"p99":>6}'
+          f' {"median":>6} {"p90":>6}')
+    ok = True
+    for interval in POLL_INTERVALS:
+        moved, held, share = evaluate(trace, tracks, interval)
+        not_held, _, _ = evaluate(trace, unheld, interval)
+        print(f'{interval:>9} {len(moved):>7} {share:>6.0%} {np.median(held):>6.0f} {np.percentile(held, 90):>6.0f}'
+              f' {np.median(moved):>6.0f} {np.percentile(moved, 90):>6.0f} {np.percentile(moved, 99):>6.0f}'
+              f' {np.median(not_held):>6.0f} {np.percentile(not_held, 90):>6.0f}')
+        ok &= within_bounds(moved, held, not_held)
+
+    df = datamanager.parse_vehicles([trace[0]])
+    previous = Motion(df, tracks)
+    df = datamanager.parse_vehicles([trace[min(20, len(trace) - 1)]])
+    start = time.perf_counter()
+    motion = Motion(df, tracks, previous=previous)
+    built = time.perf_counter() - start
+    now = float(np.nanmax(motion.fixed_at)) + 5
+    start = time.perf_counter()
+    for _ in range(100):
+        motion.positions(now)
+    print(f'\nfor {len(df)} vehicles: Motion built in {built * 1000:.1f} ms, positions in '
+          f'{(time.perf_counter() - start) * 10:.2f} ms')
+
+    if args.check and not ok:
+        print(f'FAIL: moved positions over {CHECK_SHARES} of the last seen ones\' errors or '
+              f'{CHECK_MEDIAN_METRES} m, or worse than the not held ones')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
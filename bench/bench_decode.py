@@ -0,0 +1,114 @@
+"""Benchmarks decoding and parsing big /vehicles and /predictions responses: json against orjson for decoding the raw
+bytes, with the garbage collector as it starts out and then once the app has tuned it (see datamanager.tune_gc), and
+parse_vehicles and parse_predictions with the model classes with and without __slots__, for time and for the memory
+the parsed objects take.
+
+The responses are synthetic ones for scale times the full network (see fixtures.py) unless recorded ones are given,
+e.g. saved with curl 'https://api-v3.mbta.com/vehicles?include=trip,route' > vehicles.json:
+
+    python bench/bench_decode.py [--scale 4] [--vehicles vehicles.json] [--predictions predictions.json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+sys.path.insert(0, APP_DIR)
+os.chdir(APP_DIR)
+# don't revalidate static data against the API while benchmarking
+os.environ.setdefault('STATIC_REVALIDATE_SECONDS', '0')
+
+import orjson  # noqa: E402
+
+import datamanager  # noqa: E402
+import fixtures  # noqa: E402
+import mbta  # noqa: E402
+
+
+def best_of(f, repeat: int = 5) -> float:
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t)
+    return min(times)
+
+
+def without_slots(cls: type) -> type:
+    # The same class with a __dict__ per instance, i.e. as it would be without __slots__
+    skip = {'__slots__', '__dict__', '__weakref__', *cls.__slots__}
+    return type(cls.__name__, cls.__bases__, {k: v for k, v in vars(cls).items() if k not in skip})
+
+
+def traced(f) -> (object, int):
+    # What f returns and the bytes still allocated for it afterwards
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = f()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=int, default=4, help='synthetic responses are this many full networks')
+    parser.add_argument('--vehicles', help='recorded /vehicles response to use instead')
+    parser.add_argument('--predictions', help='recorded /predictions response to use instead')
+    args = parser.parse_args()
+
+    vehicles = fixtures.vehicles_payload(fixtures.FULL_NETWORK_VEHICLES * args.scale)
+    bodies = {
+        'vehicles': orjson.dumps(vehicles),
+        'predictions': orjson.dumps(fixtures.predictions_payload(vehicles)),
+    }
+    for name in bodies:
+        if getattr(args, name):
+            with open(getattr(args, name), 'rb') as inf:
+                bodies[name] = inf.read()
+
+    # the static data is loaded first so the collector has as much to go through as it would in the app
+    datamanager.static_data.get()
+    decoders = {'json': lambda b: json.loads(b.decode()), 'orjson': orjson.loads}
+    timings = {name: [best_of(lambda: decode(body)) for decode in decoders.values()] for name, body in bodies.items()}
+    # tuning the collector can't be undone, so it's measured last
+    datamanager.tune_gc()
+    for name, body in bodies.items():
+        timings[name].append(best_of(lambda: mbta.loads(body)))
+
+    print(f'{"response":>12} {"MB":>6} {"records":>8}' +
+          ''.join(f' {d + " ms":>13} {"MB/s":>5}' for d in (*decoders, 'tuned gc')))
+    for name, body in bodies.items():
+        mb = len(body) / 2 ** 20
+        line = f'{name:>12} {mb:>6.1f} {len(orjson.loads(body)["data"]):>8}'
+        for elapsed in timings[name]:
+            line += f' {elapsed * 1000:>13.0f} {mb / elapsed:>5.0f}'
+        print(line)
+
+    # parsing, from already decoded responses so it's only the model classes
+    pages = {name: [mbta.loads(body)] for name, body in bodies.items()}
+    parsers = {'vehicles': lambda: datamanager.parse_vehicles(pages['vehicles']),
+               'predictions': lambda: datamanager.parse_predictions(pages['predictions'])}
+    # parse_vehicles returns a DataFrame, so its objects are measured by building them directly
+    included = mbta.index_included(pages['vehicles'][0]['included'])
+    objects = {'vehicles': lambda: [mbta.Vehicle(v, included=included) for v in pages['vehicles'][0]['data']],
+               'predictions': parsers['predictions']}
+
+    print(f'\n{"response":>12} {"classes":>10} {"parse ms":>9} {"records/s":>10} {"objects KB":>11}')
+    slotted = {'Vehicle': mbta.Vehicle, 'Carriage': mbta.Carriage, 'Prediction': mbta.Prediction}
+    for label, classes in (('__dict__', {k: without_slots(c) for k, c in slotted.items()}), ('__slots__', slotted)):
+        for module in (mbta, datamanager):
+            for k, c in classes.items():
+                setattr(module, k, c)
+        for name, parse in parsers.items():
+            elapsed = best_of(parse)
+            made, size = traced(objects[name])
+            records = len(pages[name][0]['data'])
+            print(f'{name:>12} {label:>10} {elapsed * 1000:>9.0f} {records / elapsed:>10.0f} {size / 1024:>11.0f}')
+
+
+if __name__ == '__main__':
+    main()
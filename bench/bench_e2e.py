@@ -0,0 +1,223 @@
+"""End to end benchmark of the Flask app (main.py): loads /map/<map_type> for every map type at increasing numbers of
+concurrent clients, with the stub server (see stub_server.py) standing in for the API, and reports latency
+percentiles, throughput, the app's peak RSS and the CPU time each stage of a request takes.
+
+The fixtures are synthetic and scale with the network: at a scale of 1 there are as many vehicles as the whole MBTA
+network at rush hour and as many bus routes as the real one, on top of the rail routes in the static data bundle.
+The app runs in its own process with its stages timed the way it times them for /metrics (see metrics.timed: CPU time
+of the thread doing them, including any stages they call), so the stub and the load generator don't count towards any
+of it.
+
+    python bench/bench_e2e.py [--scales 0.25 1] [--concurrency 1 8 32] [--duration 5] [--delay /vehicles=0.1]
+
+Results can be saved with --save and compared against on later runs with --baseline, which exits non-zero when any
+p95 or stage got more than --tolerance slower, e.g. in CI.
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCH_DIR, '..', 'app')
+sys.path.insert(0, APP_DIR)
+os.chdir(APP_DIR)
+# don't revalidate static data against the API while benchmarking
+os.environ.setdefault('STATIC_REVALIDATE_SECONDS', '0')
+
+import httpx  # noqa: E402
+import numpy as np  # noqa: E402
+
+import fixtures  # noqa: E402
+import stub_server  # noqa: E402
+from bench_asgi import free_port, load, wait_for  # noqa: E402
+
+# about how many bus routes the MBTA runs
+FULL_NETWORK_BUS_ROUTES = 170
+STATS_PATH = '/_bench/stats'
+
+# stage -> (module, attribute) of what the benchmark times on top of the stages the app times itself, wrapped with
+# metrics.timed like those are (see serve_app)
+EXTRA_STAGES = {
+    'http': ('datamanager', '_request'),
+    'decode': ('datamanager', 'loads'),
+    'base_page': ('mapping', '_get_base_page'),
+    'serialize': ('mapping', '_to_json'),
+    'template': ('main', 'render_template'),
+    'view': ('main.app.view_functions', 'map_page'),
+}
+# Every stage reported, in the order they're printed. Each includes the stages it calls, so e.g. parse_vehicles
+# includes the requests and decoding done while it reads the pages, and view is the whole request.
+STAGES = ['fetch_vehicle_snapshot', 'http', 'decode', 'parse_vehicles', 'parse_predictions', 'label_predictions',
+          'build_vehicles_layer', 'base_page', 'serialize', 'generate_map', 'template', 'view']
+
+
+def serve_app(port: int):
+    """Runs the app with the EXTRA_STAGES timed, plus a route the benchmark reads the timings from"""
+    import flask
+    import datamanager
+    import main
+    import metrics
+
+    for stage, (path, attribute) in EXTRA_STAGES.items():
+        owner = sys.modules[path] if path in sys.modules else \
+            functools.reduce(getattr, path.split('.')[1:], sys.modules[path.split('.')[0]])
+        if isinstance(owner, dict):
+            owner[attribute] = metrics.timed(stage)(owner[attribute])
+        else:
+            setattr(owner, attribute, metrics.timed(stage)(getattr(owner, attribute)))
+
+    @main.app.route(STATS_PATH)
+    def stats():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        # (calls, CPU seconds) of each stage since the app started
+        stages = {s: (metrics.stage_seconds.count(s), metrics.stage_cpu_seconds.value(s)) for s in STAGES}
+        return flask.jsonify(stages=stages, cpu=usage.ru_utime + usage.ru_stime,
+                             # kilobytes on Linux, bytes on macOS
+                             max_rss=usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+                             bus_routes=len(datamanager.static_data.get().bus_routes))
+
+    datamanager.tune_gc()
+    main.app.run(host='127.0.0.1', port=port, threaded=True)
+
+
+def start_stub(scale: float, delays: dict) -> (object, int, int):
+    # Serves scale times the full network, returns the server and its numbers of vehicles and bus routes
+    import datamanager
+    n_vehicles = max(int(fixtures.FULL_NETWORK_VEHICLES * scale), 1)
+    bus_routes = int(FULL_NETWORK_BUS_ROUTES * scale)
+    route_ids = datamanager.all_routes + [str(i) for i in range(1, bus_routes + 1)]
+    state = stub_server.fixture_state(n_vehicles, route_ids=route_ids, bus_routes=bus_routes, delays=delays,
+                                      stop_ids=list(datamanager.static_data.get().stop_names))
+    return stub_server.serve(state), n_vehicles, bus_routes
+
+
+def start_app(stub_port: int, ttl: str, bus_routes: int) -> (subprocess.Popen, int):
+    port = free_port()
+    env = {**os.environ, 'MBTA_BASE_URL': f'http://127.0.0.1:{stub_port}/', 'VEHICLE_TTL_SECONDS': ttl,
+           # the bus data is only loaded by revalidating, so revalidate once at startup when there are bus routes
+           'STATIC_REVALIDATE_SECONDS': '3600' if bus_routes > 0 else '0'}
+    app = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', str(port)], cwd=APP_DIR, env=env,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}{STATS_PATH}'
+    wait_for(url)
+    deadline = time.monotonic() + 120
+    while bus_routes > 0 and httpx.get(url).json()['bus_routes'] == 0:
+        if time.monotonic() > deadline:
+            raise RuntimeError('The app never loaded the bus routes')
+        time.sleep(0.5)
+    if bus_routes > 0:
+        # the bus routes' vehicles are only fetched once a bus map's been asked for, and every map should be timed with
+        # the whole network's worth of them
+        httpx.get(f'http://127.0.0.1:{port}/map/busses', timeout=120)
+    return app, port
+
+
+def run_scale(scale: float, map_types: list, args) -> dict:
+    stub, n_vehicles, bus_routes = start_stub(scale, stub_server._parse_pairs(args.delay, float))
+    app, port = start_app(stub.server_address[1], args.ttl, bus_routes)
+    print(f'\nscale {scale}: {n_vehicles} vehicles, {bus_routes} bus routes')
+    print(f'{"map":>9} {"clients":>8} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"errors":>7} '
+          f'{"peak RSS MB":>12}')
+
+    results = {'vehicles': n_vehicles, 'bus_routes': bus_routes, 'maps': {}}
+    try:
+        for map_type in map_types:
+            path = f'/map/{map_type}'
+            # build the base page and fetch a snapshot first, so that's not in the first level's latencies
+            httpx.get(f'http://127.0.0.1:{port}{path}', timeout=120)
+
+            levels, stages, requests, cpu = {}, defaultdict(float), 0, 0.0
+            for c in args.concurrency:
+                before = httpx.get(f'http://127.0.0.1:{port}{STATS_PATH}').json()
+                latencies, errors = asyncio.run(load(port, path, c, args.duration))
+                stats = httpx.get(f'http://127.0.0.1:{port}{STATS_PATH}').json()
+                ms = np.percentile(latencies, [50, 95, 99]) * 1000 if latencies else [float('nan')] * 3
+                levels[c] = {'rps': len(latencies) / args.duration, 'p50': ms[0], 'p95': ms[1], 'p99': ms[2],
+                             'errors': errors}
+                print(f'{map_type:>9} {c:>8} {levels[c]["rps"]:>8.1f} {ms[0]:>8.1f} {ms[1]:>8.1f} {ms[2]:>8.1f} '
+                      f'{errors:>7} {stats["max_rss"] / 2 ** 20:>12.0f}')
+
+                requests += len(latencies) + errors
+                cpu += stats['cpu'] - before['cpu']
+                for stage, (_, seconds) in stats['stages'].items():
+                    stages[stage] += seconds - before['stages'][stage][1]
+            # per request, over every level
+            results['maps'][map_type] = {
+                'levels': levels, 'max_rss': stats['max_rss'], 'cpu_ms': cpu * 1000 / max(requests, 1),
+                'stages_ms': {s: stages[s] * 1000 / max(requests, 1) for s in stages},
+            }
+    finally:
+        app.terminate()
+        app.wait()
+        stub.shutdown()
+
+    maps = results['maps']
+    print(f'\nCPU ms per request\n{"stage":>22}' + ''.join(f' {m:>9}' for m in maps))
+    for stage in STAGES:
+        print(f'{stage:>22}' + ''.join(f' {r["stages_ms"].get(stage, 0):>9.2f}' for r in maps.values()))
+    print(f'{"process total":>22}' + ''.join(f' {r["cpu_ms"]:>9.2f}' for r in maps.values()))
+    return results
+
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    """Every p95 and stage CPU time in results more than tolerance worse than in baseline, as printable lines. Small
+    absolute differences are ignored since they're mostly noise."""
+    found = []
+    for scale, r in results.items():
+        for map_type, m in r['maps'].items():
+            b = baseline.get(scale, {}).get('maps', {}).get(map_type)
+            if b is None:
+                continue
+            pairs = [(f'p95 ms at {c} clients', level['p95'], b['levels'].get(c, {}).get('p95'))
+                     for c, level in m['levels'].items()]
+            pairs += [(f'{stage} CPU ms', ms, b['stages_ms'].get(stage)) for stage, ms in m['stages_ms'].items()]
+            for name, new, old in pairs:
+                if old is not None and new > old * (1 + tolerance) and new - old > 1:
+                    found.append(f'scale {scale} {map_type}: {name} {old:.2f} -> {new:.2f}')
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scales', type=float, nargs='+', default=[0.25, 1],
+                        help='sizes of the fixtures as fractions of the full network')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--duration', type=float, default=5, help='seconds to run each level for')
+    parser.add_argument('--maps', nargs='+', help='map types to load, defaults to all of them')
+    parser.add_argument('--delay', action='append', metavar='PATH=SECONDS', help='delay stub responses for a path')
+    parser.add_argument('--ttl', default='2', help='VEHICLE_TTL_SECONDS for the app')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON file of earlier results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='slowdown allowed against the baseline')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve_app(args.serve)
+        return
+
+    from maptypes import map_types
+    results = {str(scale): run_scale(scale, args.maps or sorted(map_types), args) for scale in args.scales}
+    if args.save:
+        with open(args.save, 'w') as outf:
+            json.dump(results, outf, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as inf:
+            # levels are keyed by numbers of clients, which come back from JSON as strings
+            baseline = json.load(inf)
+        found = regressions(json.loads(json.dumps(results)), baseline, args.tolerance)
+        print(f'\n{len(found)} regressions against {args.baseline}' + ''.join(f'\n  {line}' for line in found))
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
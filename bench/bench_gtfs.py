@@ -0,0 +1,57 @@
+"""Benchmarks importing a GTFS feed with gtfs.read_feed, for a synthetic feed about the size of the MBTA's (see
+fixtures.gtfs_zip), at a few chunk sizes. Peak memory is what tracemalloc sees allocated at once while importing,
+which is what the chunk size bounds; reading stop_times.txt in one go is the last row.
+
+    python bench/bench_gtfs.py [--bus-routes 170] [--trips 150]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'app'))
+
+import fixtures  # noqa: E402
+import gtfs  # noqa: E402
+from mbta import commuter_routes, rapid_routes, silver_line_routes  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bus-routes', type=int, default=170)
+    parser.add_argument('--trips', type=int, default=150, help='trips per route and direction')
+    args = parser.parse_args()
+
+    rail_routes = commuter_routes + silver_line_routes + rapid_routes
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'feed.zip')
+        start = time.perf_counter()
+        fixtures.gtfs_zip(path, rail_routes, bus_routes=args.bus_routes, trips_per_shape=args.trips)
+        with zipfile.ZipFile(path) as zf:
+            rows = sum(1 for _ in zf.open('stop_times.txt')) - 1
+        print(f'{rows} stop times, {os.path.getsize(path) / 2 ** 20:.0f} MB zipped, '
+              f'written in {time.perf_counter() - start:.0f}s')
+
+        print(f'{"chunk rows":>11} {"seconds":>8} {"rows/s":>10} {"peak MB":>8}')
+        for chunksize in (100_000, gtfs.CHUNK_ROWS, 2_000_000, rows + 1):
+            start = time.perf_counter()
+            networks, _ = gtfs.read_feed(path, rail_routes, chunksize=chunksize)
+            elapsed = time.perf_counter() - start
+            # again for the memory, since tracing slows it down a lot
+            tracemalloc.start()
+            gtfs.read_feed(path, rail_routes, chunksize=chunksize)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f'{chunksize:>11} {elapsed:>8.2f} {rows / elapsed:>10.0f} {peak / 2 ** 20:>8.0f}')
+
+        for name, parts in networks.items():
+            print(f"{name}: {len(parts['route_to_stops'])} routes, {len(parts['shapes'])} shapes, "
+                  f"{len(parts['stops'])} stops")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Micro-benchmark for resolving JSON:API relationships while parsing large /vehicles and /predictions payloads.
+
+Compares scanning the included array for every prediction (how get_vehicle_status_and_stop used to work) against
+looking resources up in the index built by mbta.index_included, over synthetic payloads up to full-network size.
+Pass a recorded response to time that instead:
+
+    python bench/bench_included.py [predictions.json]
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+import fixtures  # noqa: E402
+from mbta import Prediction, Vehicle, index_included  # noqa: E402
+
+
+def parse_scan(j: dict) -> int:
+    class _Scan(dict):
+        # dict-like view that finds vehicles by scanning the included list, like the old lookup did
+        def __init__(self, inc):
+            super().__init__()
+            self.inc = inc
+
+        def get(self, key, default=None):
+            for i in self.inc:
+                if i['id'] == key[1]:
+                    return i
+            return default
+
+    inc = _Scan(j['included'])
+    return len([Prediction(d, inc) for d in j['data'] if d['relationships']['vehicle']['data'] is not None])
+
+
+def parse_indexed(j: dict) -> int:
+    inc = index_included(j['included'])
+    return len([Prediction(d, inc) for d in j['data'] if d['relationships']['vehicle']['data'] is not None])
+
+
+def timed(f, *args) -> float:
+    t = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - t
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'r') as inf:
+            payload = json.load(inf)
+        print(f'{len(payload["data"])} predictions: scan {timed(parse_scan, payload) * 1000:.1f} ms, '
+              f'indexed {timed(parse_indexed, payload) * 1000:.1f} ms')
+        sys.exit()
+
+    print(f'{"vehicles":>9} {"predictions":>12} {"scan (ms)":>10} {"indexed (ms)":>13} {"vehicles (ms)":>14}')
+    for n in (100, 300, 1000, fixtures.FULL_NETWORK_VEHICLES):
+        v = fixtures.vehicles_payload(n)
+        p = fixtures.predictions_payload(v)
+        scan = timed(parse_scan, p)
+        indexed = timed(parse_indexed, p)
+        vehicles = timed(lambda inc: [Vehicle(d, included=inc) for d in v['data']], index_included(v['included']))
+        print(f'{n:>9} {len(p["data"]):>12} {scan * 1000:>10.1f} {indexed * 1000:>13.1f} {vehicles * 1000:>14.1f}')
@@ -0,0 +1,78 @@
+"""Measures the weight of each map page and of each layer in it, and how long the deck JSON embedded in it takes to
+parse (with node if it's installed, so it's the same JSON.parse a browser runs, otherwise with Python's json).
+
+    python bench/bench_page_weight.py [--vehicles 300]
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCH_DIR, '..', 'app')
+sys.path.insert(0, APP_DIR)
+os.chdir(APP_DIR)
+os.environ['STATIC_REVALIDATE_SECONDS'] = '0'
+
+import fixtures  # noqa: E402
+import datamanager  # noqa: E402
+import main  # noqa: E402
+
+_PARSE_JS = '''
+const s = require('fs').readFileSync(process.argv[1], 'utf8');
+let best = Infinity;
+for (let i = 0; i < 20; i++) {
+    const t = process.hrtime.bigint();
+    JSON.parse(s);
+    best = Math.min(best, Number(process.hrtime.bigint() - t) / 1e6);
+}
+console.log(best);
+'''
+
+
+def deck_json(html: str) -> str:
+    start = html.index('const jsonInput = ') + len('const jsonInput = ')
+    return html[start:html.index(';\n    const tooltip', start)]
+
+
+def parse_ms(j: str) -> float:
+    if shutil.which('node'):
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            f.write(j)
+        try:
+            return float(subprocess.check_output(['node', '-e', _PARSE_JS, f.name]))
+        finally:
+            os.unlink(f.name)
+
+    best = float('inf')
+    for _ in range(20):
+        start = time.perf_counter()
+        json.loads(j)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--vehicles', type=int, default=300)
+    args = parser.parse_args()
+
+    fixtures.install_offline(datamanager, args.vehicles)
+    client = main.app.test_client()
+
+    print(f'parsing with {"node" if shutil.which("node") else "python"}')
+    print(f'{"map":>10} {"page KB":>8} {"lines KB":>9} {"stops KB":>9} {"vehicles KB":>12} {"parse ms":>9}')
+    for map_type in ('rapid', 'commuter', 'trains', 'all'):
+        html = client.get(f'/map/{map_type}').get_data(as_text=True)
+        j = deck_json(html)
+        layers = {l['id']: len(json.dumps(l, separators=(',', ':'))) / 1024 for l in json.loads(j)['layers']}
+        print(f'{map_type:>10} {len(html) / 1024:>8.0f} {layers["lines"]:>9.0f} {layers["stops"]:>9.0f} '
+              f'{layers["vehicles"]:>12.0f} {parse_ms(j):>9.2f}')
+
+
+if __name__ == '__main__':
+    main_()
@@ -0,0 +1,65 @@
+"""Benchmarks the background revalidation of static data against the stub server with a delay injected on /shapes and
+/stops, comparing checking both at once on datamanager.executor with checking one after the other.
+
+Map page builds don't use the executor: static data isn't fetched by requests at all (StaticDataCache loads it from the
+bundle and revalidates it in the background), and the vehicles layer is built inline from one snapshot, so the
+revalidation is the only place upstream requests are overlapped.
+
+    python bench/bench_parallel.py [--delay 0.25]
+"""
+import argparse
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCH_DIR, '..', 'app')
+sys.path.insert(0, APP_DIR)
+os.chdir(APP_DIR)
+
+import stub_server  # noqa: E402
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--delay', type=float, default=0.25, help='seconds of latency on /shapes and /stops')
+parser.add_argument('--runs', type=int, default=5)
+args = parser.parse_args()
+
+stub = stub_server.fixture_state(10, delays={p: args.delay for p in ('/shapes', '/stops')})
+server = stub_server.serve(stub)
+os.environ['MBTA_BASE_URL'] = f'http://127.0.0.1:{server.server_address[1]}/'
+os.environ['STATIC_REVALIDATE_SECONDS'] = '0'
+
+import datamanager  # noqa: E402
+
+
+def revalidate_serial():
+    data = datamanager.static_data.get()
+    datamanager._revalidate_shapes(data)
+    datamanager._revalidate_stops(data)
+
+
+def revalidate_concurrent():
+    data = datamanager.static_data.get()
+    for f in [datamanager.executor.submit(f, data) for f in (datamanager._revalidate_shapes,
+                                                             datamanager._revalidate_stops)]:
+        f.result()
+
+
+def best_of(f) -> float:
+    times = []
+    for _ in range(args.runs):
+        t = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t)
+    return min(times)
+
+
+def report(name: str, serial: float, concurrent: float):
+    print(f'{name:>22} {serial * 1000:>10.0f} {concurrent * 1000:>14.0f} {serial / concurrent:>8.2f}x')
+
+
+if __name__ == '__main__':
+    datamanager.static_data.get()
+    print(f'{args.delay:.2f}s on /shapes and /stops')
+    print(f'{"":>22} {"serial ms":>10} {"concurrent ms":>14} {"speedup":>9}')
+    report('revalidation', best_of(revalidate_serial), best_of(revalidate_concurrent))
@@ -0,0 +1,71 @@
+"""Benchmarks labelling vehicles with their next-stop predictions as the number of vehicles grows.
+
+Compares datamanager.label_predictions against the previous approach of looking up each vehicle's row with a boolean
+mask and formatting one countdown at a time. Runs offline on synthetic data:
+
+    python bench/bench_predictions.py
+"""
+import datetime
+import os
+import sys
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+sys.path.insert(0, APP_DIR)
+os.chdir(APP_DIR)
+# don't revalidate static data against the API while benchmarking
+os.environ.setdefault('STATIC_REVALIDATE_SECONDS', '0')
+
+import pandas as pd  # noqa: E402
+
+import datamanager  # noqa: E402
+from mbta import Prediction  # noqa: E402
+
+
+def make_inputs(n: int) -> (pd.DataFrame, dict):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    stop_ids = list(datamanager.static_data.get().stop_names.keys())
+
+    rows, predictions = [], {}
+    for i in range(n):
+        vid = f'v{i}'
+        rows.append([f'<h3>Vehicle {i}</h3>', [-71.0, 42.3], (255, 0, 0), 90, {}, f't{i}', vid, 'Red'])
+        p = Prediction.__new__(Prediction)
+        p.vehicle, p.trip_id, p.stop_id = vid, f't{i}', stop_ids[i % len(stop_ids)]
+        p.arrival_time = now + datetime.timedelta(seconds=(i * 7) % 1500)
+        p.departure_time = p.arrival_time + datetime.timedelta(seconds=30)
+        p.status = None
+        p.vehicle_status, p.vehicle_stop = 'IN_TRANSIT_TO', None
+        predictions[vid] = p
+
+    df = pd.DataFrame(rows, columns=['label', 'location', 'color', 'bearing', 'icon', 'trip_id', 'vehicle_id',
+                                     'route_id'])
+    return df, predictions
+
+
+def label_predictions_loop(df: pd.DataFrame, predictions_dict: dict) -> pd.DataFrame:
+    stop_lookup = datamanager.static_data.get().stop_names
+    for p in predictions_dict.values():
+        idx = df.index[df['vehicle_id'] == p.vehicle][0]
+        df.at[idx, 'label'] = f"{df.at[idx, 'label']}<br><b>Next stop: </b>{stop_lookup[p.stop_id]}: " \
+                              f"{p.get_countdown_string()}"
+    return df
+
+
+def best_of(f, *args, repeat=3) -> float:
+    times = []
+    for _ in range(repeat):
+        a = [x.copy() if isinstance(x, pd.DataFrame) else x for x in args]
+        t = time.perf_counter()
+        f(*a)
+        times.append(time.perf_counter() - t)
+    return min(times)
+
+
+if __name__ == '__main__':
+    print(f'{"vehicles":>10} {"loop (ms)":>12} {"vectorized (ms)":>16} {"speedup":>8}')
+    for n in (100, 300, 1000, 3000, 10000):
+        df, preds = make_inputs(n)
+        loop = best_of(label_predictions_loop, df, preds, repeat=1 if n > 3000 else 3)
+        vec = best_of(datamanager.label_predictions, df, preds)
+        print(f'{n:>10} {loop * 1000:>12.1f} {vec * 1000:>16.1f} {loop / vec:>7.1f}x')
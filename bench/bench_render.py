@@ -0,0 +1,49 @@
+"""Benchmarks building the map page for each set of routes, comparing serializing the whole deck on every request
+with splicing the vehicle layer into the cached base page (see mapping._get_base_page).
+
+    python bench/bench_render.py
+"""
+import os
+import sys
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+sys.path.insert(0, APP_DIR)
+os.chdir(APP_DIR)
+os.environ.setdefault('STATIC_REVALIDATE_SECONDS', '0')
+
+import datamanager  # noqa: E402
+import fixtures  # noqa: E402
+import mapping  # noqa: E402
+
+ROUTES = {
+    'rapid': datamanager.silver_line_routes + datamanager.rapid_routes,
+    'commuter': datamanager.commuter_routes,
+    'all': datamanager.all_routes,
+}
+
+
+def full_render(routes: list) -> str:
+    layers = [mapping.build_lines_layer(routes), mapping.build_stops_layer(routes),
+              mapping.build_vehicles_layer(routes)]
+    return mapping._build_deck(layers).to_html(as_string=True)
+
+
+def per_call(f, *args, n: int = 20) -> (float, float):
+    # returns wall and CPU milliseconds per call
+    wall, cpu = time.perf_counter(), time.process_time()
+    for _ in range(n):
+        f(*args)
+    return (time.perf_counter() - wall) * 1000 / n, (time.process_time() - cpu) * 1000 / n
+
+
+if __name__ == '__main__':
+    fixtures.install_offline(datamanager)
+    print(f'{"map":>10} {"full wall/cpu (ms)":>20} {"cached wall/cpu (ms)":>22} {"speedup":>8}')
+    for name, routes in ROUTES.items():
+        # warm the vehicle snapshot and base page so only the per-request work is timed
+        mapping.generate_map(routes)
+        full = per_call(full_render, routes)
+        cached = per_call(mapping.generate_map, routes)
+        print(f'{name:>10} {full[0]:>10.1f}/{full[1]:<9.1f} {cached[0]:>11.1f}/{cached[1]:<10.1f} '
+              f'{full[0] / cached[0]:>7.1f}x')
@@ -0,0 +1,80 @@
+"""Compares shapestore.ShapeStore with the DataFrame of nested lists it replaced: loading the shapes from the static
+data bundle, filtering them by route, and serializing the paths the way the lines layer does.
+
+The DataFrame is rebuilt from the store, so both hold the same shapes. Loading the store memory-maps it, so its
+number is only the cost of opening the files, and the pages are read in (and shared between processes) as they're used.
+
+    python bench/bench_shapes.py [--repeat 200]
+"""
+import argparse
+import json
+import os
+import pickle
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCH_DIR, '..', 'app')
+sys.path.insert(0, APP_DIR)
+
+from bundle import current_version  # noqa: E402
+from mbta import commuter_routes, rapid_routes  # noqa: E402
+from shapestore import FULL, ShapeStore  # noqa: E402
+
+
+def per_call(f, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        f()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    # the rail shapes of the current static data bundle, see bundle.py
+    static_dir = os.path.join(APP_DIR, 'data', 'static')
+    shapes_dir = os.path.join(static_dir, current_version(static_dir), 'rail', 'shapes')
+    store = ShapeStore.load(shapes_dir)
+    df = pd.DataFrame({'label': store.labels.tolist(), 'path': [p.tolist() for p in store.paths(range(len(store)))],
+                       'color': [tuple(c) for c in store.colors.tolist()]})
+    rows_by_route = dict(df.groupby('label').indices)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pickled = os.path.join(tmp, 'shapes.pkl')
+        df.to_pickle(pickled)
+        load_df = per_call(lambda: pd.read_pickle(pickled), args.repeat)
+        load_store = per_call(lambda: ShapeStore.load(shapes_dir), args.repeat)
+        df_bytes = len(pickle.dumps(df))
+
+    store_bytes = sum(a.nbytes for c, o in store.levels.values() for a in (c, o))
+    print(f'{len(store)} shapes, {len(store.levels[FULL][0])} points at full resolution')
+    print(f'{"":>22} {"DataFrame":>10} {"store":>10}')
+    print(f'{"size KB":>22} {df_bytes / 1024:>10.0f} {store_bytes / 1024:>10.0f}')
+    print(f'{"load ms":>22} {load_df * 1000:>10.3f} {load_store * 1000:>10.3f}')
+
+    for name, routes in (('rapid', rapid_routes), ('commuter', commuter_routes), ('Red', ['Red'])):
+        def filter_df():
+            rows = [rows_by_route[r] for r in routes if r in rows_by_route]
+            return df.iloc[np.sort(np.concatenate(rows))]
+
+        def serialize_df():
+            return json.dumps(filter_df()['path'].tolist())
+
+        def serialize_store():
+            return json.dumps([np.round(p.astype(np.float64), 5).tolist() for _, _, p in store.records(routes)])
+
+        print(f'{name + " filter us":>22} {per_call(filter_df, args.repeat) * 1e6:>10.1f} '
+              f'{per_call(lambda: store.records(routes), args.repeat) * 1e6:>10.1f}')
+        print(f'{name + " serialize ms":>22} {per_call(serialize_df, args.repeat // 10 or 1) * 1000:>10.2f} '
+              f'{per_call(serialize_store, args.repeat // 10 or 1) * 1000:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Benchmarks bounding box queries on spatial.PointSet against scanning every point, for synthetic stops spread over
+eastern Massachusetts.
+
+Viewports are sized like a ~1200x800px map at each zoom and centred on random stops. PointSet.query only compares the
+points shown at the zoom, the full scan is the same comparison over all the points (PointSet.scan), and the pandas
+scan is what filtering the stops DataFrame's location column directly would cost.
+
+A grid index was here before, sorting the points by cell and binary searching the rows of cells a box touches. At
+10k stops (more than the whole bus network) it was 0.8-1.7x the speed of the full scan, only pulling ahead from around
+50k points, so it was dropped for the plain comparison.
+
+    python bench/bench_spatial.py [--stops 10000]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'app'))
+
+import spatial  # noqa: E402
+
+VIEWPORT_PX = (1200, 800)
+
+
+def make_stops(n: int, seed: int = 0) -> pd.DataFrame:
+    # denser towards downtown, like the real network
+    rng = np.random.default_rng(seed)
+    centre = np.array([-71.06, 42.36])
+    xy = centre + rng.normal(0, 1, (n, 2)) * rng.choice([0.03, 0.1, 0.25], n)[:, None]
+    return pd.DataFrame({'location': xy.tolist(), 'priority': rng.choice([0, 0, 0, 0, 1, 2, 3], n)})
+
+
+def viewports(df: pd.DataFrame, zoom: float, n: int, seed: int = 1) -> list:
+    rng = np.random.default_rng(seed)
+    half = np.array(VIEWPORT_PX) / 2 * spatial.degrees_per_pixel(zoom)
+    centres = np.array(df['location'].tolist())[rng.integers(0, len(df), n)]
+    return [(x - half[0], y - half[1], x + half[0], y + half[1]) for x, y in centres]
+
+
+def per_query(f, boxes: list, zoom: float) -> float:
+    start = time.perf_counter()
+    for b in boxes:
+        f(b, zoom)
+    return (time.perf_counter() - start) / len(boxes)
+
+
+def pandas_scan(df: pd.DataFrame):
+    def scan(bbox, _zoom):
+        west, south, east, north = bbox
+        return df[df['location'].apply(lambda p: west <= p[0] <= east and south <= p[1] <= north)]
+    return scan
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stops', type=int, default=10000)
+    parser.add_argument('--queries', type=int, default=500)
+    args = parser.parse_args()
+
+    df = make_stops(args.stops)
+    start = time.perf_counter()
+    index = spatial.PointSet(df['location'], priority=df['priority'])
+    print(f'{args.stops} stops, index built in {(time.perf_counter() - start) * 1000:.1f} ms')
+
+    print(f'{"zoom":>5} {"in view":>8} {"shown":>7} {"query us":>9} {"scan us":>9} {"pandas us":>10} {"vs scan":>8}')
+    for zoom in (10, 12, 14, 16):
+        boxes = viewports(df, zoom, args.queries)
+        for b in boxes[:20]:
+            assert (index.query(b, zoom) == index.scan(b, zoom)).all()
+
+        in_view = np.mean([len(index.query(b)) for b in boxes])
+        shown = np.mean([len(index.query(b, zoom)) for b in boxes])
+        query = per_query(index.query, boxes, zoom)
+        scan = per_query(index.scan, boxes, zoom)
+        pandas = per_query(pandas_scan(df), boxes[:max(args.queries // 20, 1)], zoom)
+        print(f'{zoom:>5} {in_view:>8.0f} {shown:>7.0f} {query * 1e6:>9.1f} {scan * 1e6:>9.1f} {pandas * 1e6:>10.0f} '
+              f'{scan / query:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Benchmarks cold starts of the app, with the stub server (see stub_server.py) standing in for the API: how long
+importing it takes, how long until it's answering requests, and how long the first map then takes to load, with and
+without a warmup request first (see main.warmup). Each run starts fresh processes and the medians are reported.
+
+    python bench/bench_startup.py [--runs 5] [--servers flask asgi] [--map all] [--importtime]
+
+--importtime also lists the packages that take longest to import (from python -X importtime), which is the first place
+to look when the import time goes up.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCH_DIR, '..', 'app')
+sys.path.insert(0, APP_DIR)
+os.chdir(APP_DIR)
+# don't revalidate static data against the API while benchmarking
+os.environ.setdefault('STATIC_REVALIDATE_SECONDS', '0')
+
+import httpx  # noqa: E402
+
+import stub_server  # noqa: E402
+from bench_asgi import SERVERS, free_port, wait_for  # noqa: E402
+
+_TIME_IMPORT = 'import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)'
+
+
+def time_import() -> (float, float):
+    """Seconds importing main takes in a fresh interpreter, and for the whole process including the interpreter
+    starting up"""
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, '-c', _TIME_IMPORT], cwd=APP_DIR, check=True, capture_output=True, text=True)
+    return float(out.stdout.strip()), time.perf_counter() - start
+
+
+def time_server(server: str, env: dict, path: str, warmup: bool) -> dict:
+    """Starts the app and times it coming up, the warmup request if warmup and then the first request for path"""
+    port = free_port()
+    timings = {}
+    start = time.perf_counter()
+    app = subprocess.Popen(SERVERS[server] + [str(port)], cwd=APP_DIR, env=env, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+    try:
+        # /metrics doesn't need anything loaded, so it answers as soon as the server's listening
+        wait_for(f'http://127.0.0.1:{port}/metrics', timeout=60)
+        timings['listening'] = time.perf_counter() - start
+        if warmup:
+            start = time.perf_counter()
+            httpx.get(f'http://127.0.0.1:{port}/_ah/warmup', timeout=120).raise_for_status()
+            timings['warmup'] = time.perf_counter() - start
+        start = time.perf_counter()
+        httpx.get(f'http://127.0.0.1:{port}{path}', timeout=120).raise_for_status()
+        timings['first map'] = time.perf_counter() - start
+    finally:
+        app.terminate()
+        app.wait()
+    return timings
+
+
+def print_importtime(top: int):
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'], cwd=APP_DIR, check=True,
+                         capture_output=True, text=True)
+    # "import time: self [us] | cumulative | imported package", added up by top level package so e.g. all of
+    # pandas' submodules count towards pandas
+    packages = Counter()
+    for line in out.stderr.splitlines():
+        if line.startswith('import time:') and 'self [us]' not in line:
+            self_us, _, name = line[len('import time:'):].split('|')
+            packages[name.strip().split('.')[0]] += int(self_us)
+    print(f'\nslowest packages to import with main\n{"ms":>8}  package')
+    for name, us in packages.most_common(top):
+        print(f'{us / 1000:>8.1f}  {name}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--servers', nargs='+', default=['flask'], choices=sorted(SERVERS))
+    parser.add_argument('--map', default='all', help='map type to load first')
+    parser.add_argument('--vehicles', type=int, default=300, help='number of vehicles the stub serves')
+    parser.add_argument('--importtime', type=int, nargs='?', const=15, metavar='N',
+                        help='list the N packages that take longest to import')
+    args = parser.parse_args()
+
+    import datamanager
+    state = stub_server.fixture_state(args.vehicles, route_ids=datamanager.all_routes,
+                                      stop_ids=list(datamanager.static_data.get().stop_names))
+    stub = stub_server.serve(state)
+    env = {**os.environ, 'MBTA_BASE_URL': f'http://127.0.0.1:{stub.server_address[1]}/'}
+    path = f'/map/{args.map}'
+
+    imports = [time_import() for _ in range(args.runs)]
+    print(f'{"":>24} {"median ms":>10} {"min ms":>8}')
+    for name, values in (('import main', [i for i, _ in imports]),
+                         ('python -c "import main"', [p for _, p in imports])):
+        print(f'{name:>24} {statistics.median(values) * 1000:>10.1f} {min(values) * 1000:>8.1f}')
+
+    for server in args.servers:
+        for warmup in (False, True):
+            runs = [time_server(server, env, path, warmup) for _ in range(args.runs)]
+            for step in runs[0]:
+                values = [r[step] for r in runs]
+                name = f'{server} {"warm" if warmup else "cold"} {step}'
+                print(f'{name:>24} {statistics.median(values) * 1000:>10.1f} {min(values) * 1000:>8.1f}')
+    stub.shutdown()
+
+    if args.importtime:
+        print_importtime(args.importtime)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""Local stand-in for the V3 API serving synthetic fixtures (see fixtures.py), for exercising the app's HTTP client
+and benchmarking without touching the real API or its rate limit.
+
+Every endpoint can be given a delay, and can be made to fail its first few requests. Conditional requests for /shapes
+and /stops always answer 304 Not Modified so the app uses its bundled static data. Filters and paging parameters are
+applied the way the API would, see fixtures.paginate. Run it and point the app at it with
+MBTA_BASE_URL=http://127.0.0.1:8082/:
+
+    python bench/stub_server.py --vehicles 300 --delay /vehicles=0.2 --fail /predictions=503x2
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fixtures  # noqa: E402
+
+RATE_LIMIT = 1000
+
+
+class StubState:
+    def __init__(self, payloads: dict, delays: dict = None, failures: dict = None):
+        self.payloads = dict(payloads)
+        # path -> seconds
+        self.delays = delays or {}
+        # path -> [status, how many more requests should fail]
+        self.failures = {p: list(f) for p, f in (failures or {}).items()}
+
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.connections = 0
+
+    def set_payload(self, path: str, j: dict):
+        self.payloads[path] = j
+
+    def take_failure(self, path: str) -> int | None:
+        with self.lock:
+            f = self.failures.get(path)
+            if f is None or f[1] <= 0:
+                return None
+            f[1] -= 1
+            return f[0]
+
+
+def make_handler(state: StubState):
+    class Handler(BaseHTTPRequestHandler):
+        # keep-alive, so the client's connection pooling can be seen working
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            super().setup()
+            with state.lock:
+                state.connections += 1
+
+        def handle(self):
+            try:
+                super().handle()
+            except (BrokenPipeError, ConnectionResetError):
+                # the client gave up, e.g. after a read timeout
+                pass
+
+        def do_GET(self):
+            path = '/' + self.path.split('?')[0].lstrip('/')
+            with state.lock:
+                state.requests[path] += 1
+                remaining = max(RATE_LIMIT - sum(state.requests.values()), 0)
+
+            delay = state.delays.get(path, 0)
+            if delay > 0:
+                time.sleep(delay)
+
+            status = state.take_failure(path)
+            body = b''
+            if status is None:
+                conditional = 'If-Modified-Since' in self.headers or 'If-None-Match' in self.headers
+                if path in ('/shapes', '/stops') and conditional:
+                    status = 304
+                elif path in state.payloads:
+                    status, body = 200, json.dumps(fixtures.paginate(state.payloads[path], self.path)).encode()
+                else:
+                    status = 404
+
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/vnd.api+json')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('x-ratelimit-limit', str(RATE_LIMIT))
+            self.send_header('x-ratelimit-remaining', str(remaining))
+            if status == 429:
+                self.send_header('Retry-After', '0')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            pass
+
+    return Handler
+
+
+def serve(state: StubState, host: str = '127.0.0.1', port: int = 0) -> ThreadingHTTPServer:
+    """Starts serving in a daemon thread and returns the server, port 0 picks a free one
+    (see server.server_address)"""
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def fixture_state(n_vehicles: int, route_ids: list = None, stop_ids: list = None, bus_routes: int = 0,
+                  **kwargs) -> StubState:
+    """StubState serving /vehicles and /predictions fixtures for n_vehicles vehicles, and optionally the static data
+    for bus_routes made up bus routes"""
+    vehicles = fixtures.vehicles_payload(n_vehicles, n_routes=len(route_ids) if route_ids else None)
+    if route_ids:
+        fixtures.rename_routes(vehicles, route_ids)
+    predictions = fixtures.predictions_payload(vehicles, stop_ids=stop_ids)
+    payloads = {'/vehicles': vehicles, '/predictions': predictions}
+    if bus_routes > 0:
+        payloads.update(fixtures.bus_network_payloads(bus_routes))
+    return StubState(payloads, **kwargs)
+
+
+def _parse_pairs(values: list, cast) -> dict:
+    return {k: cast(v) for k, v in (x.split('=', 1) for x in values or [])}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8082)
+    parser.add_argument('--vehicles', type=int, default=300, help='number of vehicles to serve')
+    parser.add_argument('--bus-routes', type=int, default=0, help='number of made up bus routes to serve')
+    parser.add_argument('--delay', action='append', metavar='PATH=SECONDS', help='delay responses for a path')
+    parser.add_argument('--fail', action='append', metavar='PATH=STATUSxN',
+                        help='answer the first N requests for a path with STATUS')
+    args = parser.parse_args()
+
+    fails = _parse_pairs(args.fail, lambda v: tuple(int(x) for x in v.split('x')))
+    stub = fixture_state(args.vehicles, bus_routes=args.bus_routes, delays=_parse_pairs(args.delay, float),
+                         failures=fails)
+    srv = ThreadingHTTPServer((args.host, args.port), make_handler(stub))
+    srv.daemon_threads = True
+    print(f'Serving {args.vehicles} vehicles on http://{args.host}:{args.port}/')
+    srv.serve_forever()
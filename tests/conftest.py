@@ -0,0 +1,12 @@
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+# the app's modules are imported the way they are when it's run from app/, and the stub server and fixtures from bench/
+sys.path[:0] = [os.path.join(ROOT, 'app'), os.path.join(ROOT, 'bench'), os.path.join(ROOT, 'tools')]
+
+# nothing in the tests should reach the real API, each test that needs one points the app at a stub
+os.environ.setdefault('MBTA_BASE_URL', 'http://127.0.0.1:9/')
+os.environ.setdefault('MBTA_STATIC_DATA_DIR', os.path.join(ROOT, 'app', 'data', 'static'))
+os.environ.setdefault('STATIC_REVALIDATE_SECONDS', '0')
@@ -0,0 +1,12 @@
+import os
+import subprocess
+import sys
+
+from conftest import ROOT
+
+
+def test_asgi_app_does_not_import_flask_app():
+    # the ASGI app shares the map types with main.py through maptypes, rather than building the Flask app too
+    out = subprocess.run([sys.executable, '-c', 'import sys, asgi; print("main" in sys.modules)'],
+                         cwd=os.path.join(ROOT, 'app'), capture_output=True, text=True, check=True)
+    assert out.stdout.strip() == 'False'
@@ -0,0 +1,92 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+import requests
+
+import datamanager
+import stub_server
+
+RETRIES = 2
+READ_TIMEOUT = 0.5
+ROUTE = '/vehicles'
+
+
+def sync_request():
+    return datamanager._request(ROUTE)
+
+
+def async_request():
+    async def request():
+        try:
+            return await datamanager._request_async(ROUTE)
+        finally:
+            await datamanager.close_async_client()
+    return asyncio.run(request())
+
+
+CLIENTS = [pytest.param(sync_request, requests.exceptions.RequestException, id='sync'),
+           pytest.param(async_request, httpx.HTTPError, id='async')]
+
+
+@pytest.fixture(scope='module')
+def stub():
+    state = stub_server.fixture_state(10)
+    server = stub_server.serve(state)
+    yield state, f'http://127.0.0.1:{server.server_address[1]}/'
+    server.shutdown()
+
+
+@pytest.fixture
+def run(stub, monkeypatch):
+    state, base_url = stub
+    monkeypatch.setattr(datamanager, 'BASE_URL', base_url)
+    monkeypatch.setattr(datamanager, 'API_RETRIES', RETRIES)
+    monkeypatch.setattr(datamanager, 'API_READ_TIMEOUT', READ_TIMEOUT)
+    # the session's Retry is built from API_RETRIES when it's first used, so start from a fresh one and drop it after
+    monkeypatch.setattr(datamanager, '_session', None)
+
+    def run(request, failures: list = None, delay: float = 0) -> (object, int, float):
+        """Makes a request with the stub failing or delaying it as given, and returns what it returned (or raised),
+        how many requests the stub got and how long it took"""
+        with state.lock:
+            state.requests.clear()
+            state.failures = {ROUTE: list(failures)} if failures else {}
+            state.delays = {ROUTE: delay} if delay else {}
+        start = time.perf_counter()
+        try:
+            result = request()
+        except Exception as err:
+            result = err
+        elapsed = time.perf_counter() - start
+        # let the stub finish answering requests that were given up on, so they don't take the next test's failures
+        time.sleep(delay)
+        return result, state.requests[ROUTE], elapsed
+    return run
+
+
+@pytest.mark.parametrize('status', [429, 503])
+@pytest.mark.parametrize('request_, errors', CLIENTS)
+def test_retries_until_one_succeeds(run, request_, errors, status):
+    r, n, _ = run(request_, failures=[status, RETRIES])
+    assert r.status_code == 200
+    assert n == RETRIES + 1
+
+
+@pytest.mark.parametrize('request_, errors', CLIENTS)
+def test_gives_up_after_retries(run, request_, errors):
+    r, n, _ = run(request_, failures=[503, RETRIES + 5])
+    assert isinstance(r, errors)
+    assert n == RETRIES + 1
+
+
+@pytest.mark.parametrize('request_, errors', CLIENTS)
+def test_times_out_slow_responses(run, request_, errors):
+    # the stub only answers after twice the timeout, so every attempt times out
+    r, n, elapsed = run(request_, delay=READ_TIMEOUT * 2)
+    assert isinstance(r, errors)
+    assert n == RETRIES + 1
+    # each attempt waits out the timeout, plus backoff between them
+    budget = (RETRIES + 1) * READ_TIMEOUT + sum(min(0.5 * 2 ** a + 0.5, 10) for a in range(RETRIES))
+    assert (RETRIES + 1) * READ_TIMEOUT <= elapsed <= budget + 1
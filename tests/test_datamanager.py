@@ -0,0 +1,19 @@
+import types
+
+import datamanager
+
+
+def test_bus_vehicles_only_tracked_once_a_bus_map_is_asked_for(monkeypatch):
+    import maptypes
+
+    monkeypatch.setattr(datamanager, '_bus_wanted', type(datamanager._bus_wanted)())
+    loaded = types.SimpleNamespace(bus_routes=('1', '741', '77'))
+    monkeypatch.setattr(datamanager.static_data, 'get', lambda: loaded)
+
+    # the Silver Line's 741 is in all_routes already, the other bus routes wait for a bus map
+    assert datamanager.live_routes() == datamanager.all_routes
+    maptypes.get_routes('rapid')
+    assert datamanager.live_routes() == datamanager.all_routes
+
+    assert maptypes.get_routes('busses') == ['1', '741', '77']
+    assert datamanager.live_routes() == datamanager.all_routes + ['1', '77']
@@ -0,0 +1,34 @@
+import pytest
+
+import bench_deadreckoning
+import datamanager
+from conftest import DATA_DIR
+from deadreckoning import Tracks, stop_locations
+
+# 30 vehicles for two minutes on the bundle's rail shapes, written with
+#   python bench/bench_deadreckoning.py --vehicles 30 --seconds 120 --save tests/data/trace.jsonl.gz
+TRACE = f'{DATA_DIR}/trace.jsonl.gz'
+
+
+@pytest.fixture(scope='module')
+def trace():
+    return bench_deadreckoning.load_trace(TRACE)
+
+
+@pytest.fixture(scope='module')
+def tracks():
+    data = datamanager.static_data.get()
+    # with and without stops to hold vehicles at
+    return Tracks(data.shapes, stops=stop_locations(data.stops, data.route_to_stops)), Tracks(data.shapes)
+
+
+@pytest.mark.parametrize('interval', bench_deadreckoning.POLL_INTERVALS)
+def test_moved_positions_within_bounds(trace, tracks, interval):
+    moved, held, share = bench_deadreckoning.evaluate(trace, tracks[0], interval)
+    not_held, _, _ = bench_deadreckoning.evaluate(trace, tracks[1], interval)
+
+    # most fixes are of vehicles that had moved since the snapshot, and so were moved along their route
+    assert share > 0.5
+    assert bench_deadreckoning.within_bounds(moved, held, not_held), \
+        (bench_deadreckoning.percentiles(moved), bench_deadreckoning.percentiles(held),
+         bench_deadreckoning.percentiles(not_held))
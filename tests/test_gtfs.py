@@ -0,0 +1,95 @@
+import os
+import zipfile
+
+import pytest
+
+import gtfs
+from conftest import DATA_DIR
+
+RAIL_ROUTES = ['Red', 'CR-Fitchburg']
+
+# The feed in data/gtfs is small enough to know the output of by hand. Red's canonical patterns are t1's and t2's, with
+# t3's typical but not canonical so it isn't drawn. CR-Fitchburg has no canonical pattern, so its typical one is drawn.
+# Bus 1's atypical pattern isn't drawn, and bus 7 has no patterns so has nothing drawn. Red's trips stop at platforms
+# of place-a and place-b, and rows are out of sequence order.
+FEED_DIR = os.path.join(DATA_DIR, 'gtfs')
+
+EXPECTED = {
+    'rail': {
+        'route_to_stops': {'Red': ['place-a', 'place-b', 'c'], 'CR-Fitchburg': ['d', 'c']},
+        'shape_to_route': {'R0': 'Red', 'R1': 'Red', 'F0': 'CR-Fitchburg'},
+        'shapes': {'Red': [[(-71.14, 42.40), (-71.12, 42.39), (-71.11, 42.38)], [(-71.11, 42.38), (-71.14, 42.40)]],
+                   'CR-Fitchburg': [[(-71.23, 42.37), (-71.11, 42.38)]]},
+        'stops': {'place-a': 'Alewife', 'place-b': 'Davis', 'c': 'Porter', 'd': 'Waltham'},
+    },
+    'bus': {
+        'route_to_stops': {'1': ['s1', 's2', 's3']},
+        'shape_to_route': {'B0': '1'},
+        'shapes': {'1': [[(-71.10, 42.36), (-71.08, 42.33)]]},
+        'stops': {'s1': 'Mass Ave @ Main St', 's2': 'Mass Ave @ Sidney St', 's3': 'Dudley Sq'},
+    },
+}
+
+
+def write_feed(path: str, route_patterns: bool = True) -> str:
+    with zipfile.ZipFile(path, 'w') as zf:
+        for name in sorted(os.listdir(FEED_DIR)):
+            if route_patterns or name != 'route_patterns.txt':
+                zf.write(os.path.join(FEED_DIR, name), name)
+    return path
+
+
+def shapes_by_route(store) -> dict:
+    return {r: [[tuple(round(float(x), 4) for x in pt) for pt in path] for path in store.paths(range(s.start, s.stop))]
+            for r, s in store.route_slices.items()}
+
+
+@pytest.fixture(scope='module')
+def feed(tmp_path_factory):
+    return write_feed(str(tmp_path_factory.mktemp('gtfs') / 'feed.zip'))
+
+
+@pytest.fixture(scope='module')
+def networks(feed):
+    return gtfs.read_feed(feed, RAIL_ROUTES)[0]
+
+
+def test_feed_info(feed):
+    assert gtfs.read_feed(feed, RAIL_ROUTES)[1].get('feed_version') == 'Test feed'
+
+
+@pytest.mark.parametrize('network', EXPECTED)
+def test_drawn_routes_and_shapes(networks, network):
+    parts, expected = networks[network], EXPECTED[network]
+    assert parts['route_to_stops'] == expected['route_to_stops']
+    assert parts['shape_to_route'] == expected['shape_to_route']
+    assert shapes_by_route(parts['shapes']) == expected['shapes']
+
+
+@pytest.mark.parametrize('network', EXPECTED)
+def test_platforms_drawn_as_stations(networks, network):
+    stops = networks[network]['stops']
+    assert dict(zip(stops['id'], stops['name'])) == EXPECTED[network]['stops']
+
+
+def test_every_stop_named(networks):
+    # platforms included, for looking up vehicles' and predictions' stops
+    names = networks['rail']['stop_names']
+    assert names['a1'] == 'Alewife - Red Line'
+    assert len(names) == 10
+
+
+def test_chunked_read_matches(feed, networks):
+    # one row at a time, so every chunk boundary falls somewhere
+    chunked, _ = gtfs.read_feed(feed, RAIL_ROUTES, chunksize=1)
+    for n in networks:
+        assert chunked[n]['route_to_stops'] == networks[n]['route_to_stops']
+        assert shapes_by_route(chunked[n]['shapes']) == shapes_by_route(networks[n]['shapes'])
+
+
+def test_shapes_by_trip_counts_without_route_patterns(tmp_path):
+    # shapes run by at least gtfs.MIN_SHAPE_SHARE as many trips as the busiest one of their route and direction are
+    # drawn. Here that's Red's R0 (two trips) and R2 (one) in direction 0, and R1 in direction 1.
+    by_trips, _ = gtfs.read_feed(write_feed(str(tmp_path / 'feed.zip'), route_patterns=False), RAIL_ROUTES)
+    assert by_trips['rail']['shape_to_route'] == {'R0': 'Red', 'R2': 'Red', 'R1': 'Red', 'F0': 'CR-Fitchburg'}
+    assert by_trips['bus']['shape_to_route'] == {'B0': '1', 'B1': '1'}
@@ -0,0 +1,29 @@
+import fixtures
+
+
+def test_map_page_uses_one_snapshot(monkeypatch):
+    import datamanager
+    import main
+
+    # install_offline swaps _request out, so have monkeypatch put the real one back afterwards
+    monkeypatch.setattr(datamanager, '_request', datamanager._request)
+    fixtures.install_offline(datamanager, 50)
+
+    snapshots = []
+
+    def get_vehicle_snapshot():
+        # as if the snapshot were refreshed between every call
+        datamanager.vehicle_snapshots.clear()
+        snapshots.append(datamanager.get_vehicle_snapshot())
+        return snapshots[-1]
+
+    monkeypatch.setattr(main, 'get_vehicle_snapshot', get_vehicle_snapshot)
+    client = main.app.test_client()
+    r = client.get('/map/rapid')
+    assert r.status_code == 200
+    assert len(snapshots) == 1
+    assert f"let generation = '{snapshots[0].etag}';" in r.get_data(as_text=True)
+
+    # and the same snapshot answers a revalidation with a 304
+    monkeypatch.setattr(main, 'get_vehicle_snapshot', lambda: snapshots[0])
+    assert client.get('/map/rapid', headers={'If-None-Match': r.headers['ETag']}).status_code == 304
@@ -0,0 +1,86 @@
+import asyncio
+import threading
+
+import fixtures
+import recording
+
+
+def record(directory: str, refreshes: list):
+    # runs each refresh (route -> body of the responses it fetches) at the same time, each in its own thread
+    recorder = recording.Recorder(str(directory))
+    barrier = threading.Barrier(len(refreshes))
+
+    def refresh(responses: dict):
+        recorder.begin()
+        for route, body in responses.items():
+            # so every refresh has begun before any adds, and every one has added before any commits
+            barrier.wait()
+            recorder.add(route, 200, body)
+        barrier.wait()
+        recorder.commit()
+
+    threads = [threading.Thread(target=refresh, args=(r,)) for r in refreshes]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    recorder.close()
+
+
+def recorded(directory: str) -> list:
+    frames = recording.read_frames(str(directory))
+    return [recording.read_snapshot(path, offset).responses for path, offset, _ in frames]
+
+
+def test_concurrent_refreshes_record_their_own_snapshots(tmp_path):
+    refreshes = [{'/vehicles?a': b'{"a": 1}', '/predictions?a': b'{"a": 2}'},
+                 {'/vehicles?b': b'{"b": 1}', '/predictions?b': b'{"b": 2}'}]
+    record(tmp_path, refreshes)
+
+    snapshots = recorded(tmp_path)
+    assert sorted(map(sorted, snapshots)) == sorted(map(sorted, refreshes))
+    for snapshot in snapshots:
+        assert len({route[-1] for route in snapshot}) == 1
+
+
+def test_concurrent_tasks_record_their_own_snapshots(tmp_path):
+    recorder = recording.Recorder(str(tmp_path))
+
+    async def refresh(name: str):
+        recorder.begin()
+        await asyncio.sleep(0)
+        recorder.add(f'/vehicles?{name}', 200, name.encode())
+        await asyncio.sleep(0)
+        recorder.commit()
+
+    async def main():
+        await asyncio.gather(refresh('a'), refresh('b'))
+
+    asyncio.run(main())
+    recorder.close()
+    assert sorted(recorded(tmp_path), key=str) == [{'/vehicles?a': (200, b'a')}, {'/vehicles?b': (200, b'b')}]
+
+
+def test_async_refresh_reads_replayed_frames_off_the_event_loop(tmp_path, monkeypatch):
+    import datamanager
+
+    monkeypatch.setattr(datamanager, '_request', datamanager._request)
+    fixtures.install_offline(datamanager, 50)
+    monkeypatch.setattr(datamanager, 'LIVE_SOURCE', 'poll')
+    monkeypatch.setattr(datamanager, 'recorder', recording.Recorder(str(tmp_path)))
+    datamanager._fetch_vehicle_snapshot()
+    datamanager.recorder.close()
+    monkeypatch.setattr(datamanager, 'recorder', None)
+
+    replay = recording.Replay(str(tmp_path), speed=0)
+    begun = []
+    monkeypatch.setattr(replay, 'begin', lambda: begun.append(threading.current_thread()) or
+                        recording.Replay.begin(replay))
+    monkeypatch.setattr(datamanager, 'replay', replay)
+
+    async def fetch():
+        return threading.current_thread(), await datamanager._fetch_vehicle_snapshot_async()
+
+    loop_thread, snapshot = asyncio.run(fetch())
+    assert len(snapshot.df) == 50
+    assert len(begun) == 1 and begun[0] is not loop_thread
@@ -0,0 +1,175 @@
+import json
+import logging
+import threading
+import time
+
+import pytest
+
+import sse_replay
+import streaming
+from conftest import DATA_DIR
+from streaming import LiveStore, StreamIngester
+
+VEHICLE_TYPES = {'vehicle', 'trip', 'route'}
+
+
+def wait_for(condition, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+
+def recorded(name: str) -> list:
+    # (event, decoded data) of every event in a recording that decodes
+    events = []
+    for event, data in streaming.iter_sse(open(f'{DATA_DIR}/{name}.sse').read().splitlines()):
+        try:
+            events.append((event, json.loads(data)))
+        except ValueError:
+            pass
+    return events
+
+
+@pytest.fixture
+def replay_server():
+    # keep-alives far enough apart that a stopped ingester would still be waiting on the next one
+    server = sse_replay.serve({'/vehicles': f'{DATA_DIR}/vehicles.sse', '/predictions': f'{DATA_DIR}/predictions.sse'},
+                              port=0, keepalive=30)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+
+
+def test_store_applies_reset_add_update_remove():
+    store = LiveStore()
+    for event, data in recorded('vehicles'):
+        store.apply(event, data, VEHICLE_TYPES, source='vehicles')
+
+    assert sorted(store.vehicles) == ['R-1', 'R-3']
+    assert store.vehicles['R-1'].location == [-71.1195, 42.3960]
+    assert store.vehicles['R-3'].headsign == 'Braintree'
+
+
+def test_store_prunes_trips_of_removed_vehicles():
+    store = LiveStore()
+    for event, data in recorded('vehicles'):
+        store.apply(event, data, VEHICLE_TYPES, source='vehicles')
+
+    assert sorted(k for k in store.resources if k[0] != 'vehicle') == [('route', 'Red'), ('trip', 't1'), ('trip', 't3')]
+
+    store.apply('remove', {'type': 'vehicle', 'id': 'R-1'}, VEHICLE_TYPES, source='vehicles')
+    store.apply('remove', {'type': 'vehicle', 'id': 'R-3'}, VEHICLE_TYPES, source='vehicles')
+    assert store.resources == {}
+
+
+def test_store_keeps_last_good_version_of_malformed_resources(caplog):
+    store = LiveStore()
+    events = recorded('vehicles')
+    with caplog.at_level(logging.WARNING, logger='streaming'):
+        # up to the update that loses R-2's trip
+        for event, data in events[:5]:
+            store.apply(event, data, VEHICLE_TYPES, source='vehicles')
+
+    assert store.vehicles['R-2'].trip_id == 't2'
+    assert 'Skipping malformed vehicle R-2' in caplog.text
+
+
+def test_reset_only_replaces_its_own_streams_resources():
+    store = LiveStore()
+    reset = recorded('vehicles')[0][1]
+    store.apply('reset', reset, VEHICLE_TYPES, source='rail')
+    store.apply('reset', [], VEHICLE_TYPES, source='bus')
+    assert sorted(store.vehicles) == ['R-1', 'R-2']
+
+    store.apply('reset', [], VEHICLE_TYPES, source='rail')
+    assert store.vehicles == {} and store.resources == {}
+
+
+def test_snapshot_picks_next_stop_prediction():
+    store = LiveStore()
+    for event, data in recorded('vehicles'):
+        store.apply(event, data, VEHICLE_TYPES, source='vehicles')
+    for event, data in recorded('predictions'):
+        store.apply(event, data, {'prediction'}, source='predictions')
+
+    vehicles, next_stop = store.snapshot()
+    assert sorted(v.vehicle_id for v in vehicles) == ['R-1', 'R-3']
+    # p1 was removed, and p3 has no stop_sequence so p4 is taken over it
+    assert {v: p.stop_id for v, p in next_stop.items()} == {'R-1': '70061', 'R-3': '70067'}
+    assert next_stop['R-1'].status == 'Stopped 1 stop away'
+    # the status comes from the vehicle, set on a copy rather than the store's own prediction
+    assert next_stop['R-1'].vehicle_status == 'IN_TRANSIT_TO'
+    assert next_stop['R-1'] is not store.predictions['p2']
+
+    _, next_stop = store.snapshot(route_ids=['Blue'])
+    assert next_stop == {}
+
+
+def test_ingesters_replay_recorded_streams(replay_server):
+    store = LiveStore()
+    ingesters = [StreamIngester(f'{replay_server}/vehicles', store, VEHICLE_TYPES),
+                 StreamIngester(f'{replay_server}/predictions', store, {'prediction'})]
+    for ingester in ingesters:
+        ingester.start()
+
+    try:
+        assert all(ingester.connected.wait(5) for ingester in ingesters)
+        # the removes are the last events of each recording, so once they're in everything is
+        assert wait_for(lambda: ('vehicle', 'R-2') not in store.resources and
+                        ('prediction', 'p1') not in store.resources)
+        # the malformed events were skipped without dropping the connection
+        assert all(ingester.connected.is_set() and ingester._thread.is_alive() for ingester in ingesters)
+
+        _, next_stop = store.snapshot()
+        assert sorted(store.vehicles) == ['R-1', 'R-3']
+        assert {v: p.stop_id for v, p in next_stop.items()} == {'R-1': '70061', 'R-3': '70067'}
+    finally:
+        for ingester in ingesters:
+            ingester.stop()
+
+    # stopping closes the connection rather than waiting for the next keep-alive
+    for ingester in ingesters:
+        ingester._thread.join(2)
+        assert not ingester._thread.is_alive()
+
+
+def test_ingester_reconnects_after_bad_reset():
+    connections = []
+
+    class BadReset(StreamIngester):
+        def _events(self):
+            connections.append(1)
+            yield 'reset', '{"not": "a list"}'
+
+    ingester = BadReset('bad', LiveStore(), VEHICLE_TYPES, min_backoff=0.01, max_backoff=0.02)
+    ingester.start()
+    try:
+        assert wait_for(lambda: len(connections) > 2)
+        assert not ingester.connected.is_set() and ingester._thread.is_alive()
+    finally:
+        ingester.stop()
+
+
+def test_polls_while_stream_is_disconnected(monkeypatch, caplog):
+    import datamanager
+    import stub_server
+
+    # the stub answers /vehicles with JSON rather than an event stream, so the streams never connect
+    server = stub_server.serve(stub_server.fixture_state(50))
+    monkeypatch.setattr(datamanager, 'BASE_URL', f'http://127.0.0.1:{server.server_address[1]}/')
+    monkeypatch.setattr(datamanager, 'LIVE_SOURCE', 'stream')
+    monkeypatch.setattr(datamanager, 'STREAM_CONNECT_SECONDS', 0.2)
+    try:
+        with caplog.at_level(logging.WARNING, logger='datamanager'):
+            snapshot = datamanager._fetch_vehicle_snapshot()
+        assert len(snapshot.df) == 50
+        assert 'Polling for vehicles while a stream is disconnected' in caplog.text
+        assert not any(s.connected.is_set() for s in datamanager._stream_ingesters.values())
+    finally:
+        for ingester in datamanager._stream_ingesters.values():
+            ingester.stop()
+        datamanager._stream_ingesters.clear()
+        server.shutdown()
@@ -0,0 +1,88 @@
+"""Builds the static data bundle the app starts from (see app/bundle.py) and makes it the current one.
+
+Fetches from the API, using MBTA_API_KEY and MBTA_BASE_URL from the environment or app/.env like the app does, or
+reads a GTFS zip without touching the network (see app/gtfs.py):
+
+    python tools/build_static.py [--gtfs MBTA_GTFS.zip] [--no-bus] [--version NAME] [--keep 2]
+
+and checks an existing bundle against the hashes in its manifest, and that it has the bus network (unless --no-bus),
+with:
+
+    python tools/build_static.py --verify [--version NAME] [--no-bus]
+
+Bundles that are deployed should have the bus network. Without it every instance fetches the whole of it from the API
+when it starts, which is a few dozen requests (and more pages on the real API) out of the rate limit.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+sys.path.insert(0, APP_DIR)
+
+import bundle  # noqa: E402
+
+
+def build(args):
+    import datamanager
+
+    start = time.perf_counter()
+    if args.gtfs:
+        import gtfs
+        networks, feed_info = gtfs.read_feed(args.gtfs, datamanager.all_routes, bus=not args.no_bus)
+        # no validators, so the app's first revalidation fetches the shapes and stops from the API again
+        validators = {'shapes': {}, 'stops': {}}
+        source = f"gtfs:{os.path.basename(args.gtfs)} {feed_info.get('feed_version', '')}".strip()
+    else:
+        networks, validators = datamanager.fetch_static_data(bus=not args.no_bus)
+        source = datamanager.BASE_URL
+    path = bundle.write_bundle(args.out, networks, validators, source=source, version=args.version)
+    print(f'Built {path} in {time.perf_counter() - start:.1f}s')
+
+    start = time.perf_counter()
+    manifest, networks = bundle.read_bundle(args.out)
+    print(f'Loads in {(time.perf_counter() - start) * 1000:.1f} ms')
+    for name, meta in manifest['networks'].items():
+        print(f"  {name}: {meta['shapes']} shapes, {meta['stops']} stops, "
+              f"{len(networks[name]['route_to_stops'])} routes")
+
+    if args.keep:
+        for v in bundle.prune(args.out, args.keep):
+            print(f'Deleted {v}')
+
+
+def verify(args):
+    version = args.version or bundle.current_version(args.out)
+    bad = bundle.verify_bundle(args.out, version)
+    for name in bad:
+        print(f'{name} is missing or changed')
+    print(f'{version} is {"damaged" if bad else "intact"}')
+
+    with open(os.path.join(args.out, version, 'manifest.json'), 'r') as inf:
+        no_bus = 'bus' not in json.load(inf)['networks']
+    if no_bus and not args.no_bus:
+        print(f'{version} has no bus network, rebuild it without --no-bus')
+    sys.exit(1 if bad or (no_bus and not args.no_bus) else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--out', default=os.path.join(APP_DIR, 'data', 'static'), help='directory the bundles are in')
+    parser.add_argument('--gtfs', metavar='ZIP', help='read a GTFS feed zip instead of fetching from the API')
+    parser.add_argument('--version', help='name of the bundle, defaults to when it was built')
+    parser.add_argument('--no-bus', action='store_true',
+                        help='leave out the bus network (every instance then fetches it from the API when it starts), '
+                             'or with --verify, allow it to be missing')
+    parser.add_argument('--keep', type=int, default=0, help='delete all but this many of the newest bundles')
+    parser.add_argument('--verify', action='store_true', help='check a bundle instead of building one')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    verify(args) if args.verify else build(args)
+
+
+if __name__ == '__main__':
+    main()
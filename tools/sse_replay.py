@@ -0,0 +1,89 @@
+"""Stand-in for the V3 API's streaming endpoints that replays recorded text/event-stream output.
+
+Record a stream with something like:
+
+    curl -N -H 'Accept: text/event-stream' -H "x-api-key: $MBTA_API_KEY" \\
+        'https://api-v3.mbta.com/vehicles?filter[route]=Red&include=trip,route' > vehicles.sse
+
+then replay it and point the app at it with MBTA_BASE_URL=http://127.0.0.1:8081/ MBTA_LIVE_SOURCE=stream:
+
+    python tools/sse_replay.py /vehicles=vehicles.sse /predictions=predictions.sse --interval 0.5
+"""
+import argparse
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def read_events(path: str) -> list:
+    # split a recording into raw event blocks, each one terminated by a blank line
+    with open(path, 'r', encoding='utf-8') as inf:
+        text = inf.read().replace('\r\n', '\n')
+    return [f'{block}\n\n' for block in text.split('\n\n') if block.strip()]
+
+
+def make_handler(recordings: dict, interval: float, hold: bool, keepalive: float = 5):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            path = self.path.split('?')[0].replace('//', '/')
+            events = recordings.get(path)
+            if events is None:
+                self.send_error(404)
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            # chunked, so clients get each event as it's sent rather than once enough has built up to fill a read
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+
+            try:
+                for e in events:
+                    self._chunk(e.encode())
+                    if interval > 0:
+                        time.sleep(interval)
+                # keep the connection open like the real API does, sending keep-alive comments
+                while hold:
+                    time.sleep(keepalive)
+                    self._chunk(b':\n\n')
+                self._chunk(b'')
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            self.close_connection = True
+
+        def _chunk(self, b: bytes):
+            self.wfile.write(f'{len(b):x}\r\n'.encode() + b + b'\r\n')
+            self.wfile.flush()
+
+        def log_message(self, fmt, *args):
+            pass
+
+    return Handler
+
+
+def serve(recordings: dict, host: str = '127.0.0.1', port: int = 8081, interval: float = 0,
+          hold: bool = True, keepalive: float = 5) -> ThreadingHTTPServer:
+    """Returns a server replaying recordings, a dict of request path to event file. Call serve_forever() on it, or
+    run that in a thread. Port 0 picks a free one, see server.server_address."""
+    events = {p: read_events(f) for p, f in recordings.items()}
+    server = ThreadingHTTPServer((host, port), make_handler(events, interval, hold, keepalive))
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('recordings', nargs='+', metavar='PATH=FILE',
+                        help='request path and the recorded stream to replay for it')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--interval', type=float, default=0, help='seconds to wait between events')
+    parser.add_argument('--close', action='store_true',
+                        help='close the connection once all events are sent, to exercise reconnects')
+    args = parser.parse_args()
+
+    rec = dict(r.split('=', 1) for r in args.recordings)
+    print(f'Replaying {", ".join(rec)} on http://{args.host}:{args.port}/')
+    serve(rec, args.host, args.port, args.interval, hold=not args.close).serve_forever()